@@ -7,118 +7,163 @@ python3 ${SCRIPTS}/round_bvals.py \
     --in ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bval \
     --out ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm_rounded.bval
 
-echo 'Fit CSA odf'
-python3 ${SCRIPTS}/fit_csa.py \
-    ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.nii.gz \
-    ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm_rounded.bval \
-    ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bvec \
-    ${DIFF_DATA_DIR}/mask.nii.gz \
-    ${ODF_DIR}/csa.nii.gz \
-    ${N_CORES} 1e-5 0.006 6
-
-
-echo 'Sharpen odf'
-mkdir -p ${ODF_DIR}/sharpen_ratios
-
-for RATIO in ${RATIOS[@]};
-do
-    echo 'Ratio '${RATIO}
+# ODF_PER_STEP=YES (SET_VARIABLES.sh) runs one script per step and writes all the per-ratio files,
+# otherwise the steps run in memory in run_odf_engine.py
+if [[ ${ODF_PER_STEP} == "YES" ]]
+then
+    echo 'Fit CSA odf'
+    python3 ${SCRIPTS}/fit_csa.py \
+        ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.nii.gz \
+        ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm_rounded.bval \
+        ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bvec \
+        ${DIFF_DATA_DIR}/mask.nii.gz \
+        ${ODF_DIR}/csa.nii.gz \
+        ${N_CORES} 1e-5 0.006 6
+
+
+    echo 'Sharpen odf'
+    mkdir -p ${ODF_DIR}/sharpen_ratios
+
+    # all ratios in one call, the input, mask and worker pool are set up once
+    declare -a SHARPODFLIST
+    for RATIO in ${RATIOS[@]};
+    do
+        SHARPODFLIST+=(${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz)
+    done
+
     python3 ${SCRIPTS}/sharpen_sh_parallel.py \
             --in ${ODF_DIR}/csa.nii.gz \
-            --out ${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz \
+            --out ${SHARPODFLIST[@]} \
             --mask ${DIFF_DATA_DIR}/mask.nii.gz \
-            --ratio ${RATIO} \
+            --ratio ${RATIOS[@]} \
             --tau 0.1 --lambda 1. --csa_norm True \
             --cores ${N_CORES}
-done
 
 
-echo 'Extracting Peaks'
-mkdir -p ${ODF_DIR}/peaks_ratios
+    echo 'Extracting Peaks'
+    mkdir -p ${ODF_DIR}/peaks_ratios
+
+    # all ratios in one call, the mask, SH matrix and worker pool are set up once
+    declare -a PEAKODFLIST
+    declare -a NUFOLIST
+    declare -a DIRLIST
+    declare -a LENLIST
+    for RATIO in ${RATIOS[@]};
+    do
+        PEAKODFLIST+=(${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz)
+        NUFOLIST+=(${ODF_DIR}/peaks_ratios/nufo_csa_sharp_r${RATIO}.nii.gz)
+        DIRLIST+=(${ODF_DIR}/peaks_ratios/dir_csa_sharp_r${RATIO}.nii.gz)
+        LENLIST+=(${ODF_DIR}/peaks_ratios/len_csa_sharp_r${RATIO}.nii.gz)
+    done
 
-for RATIO in ${RATIOS[@]};
-do
-    echo 'Extracting peaks from sharpened Ratio '${RATIO}
     python3 ${SCRIPTS}/peak_extraction.py \
-            ${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz \
-            ${ODF_DIR}/peaks_ratios/nufo_csa_sharp_r${RATIO}.nii.gz \
-            ${ODF_DIR}/peaks_ratios/dir_csa_sharp_r${RATIO}.nii.gz \
-            ${ODF_DIR}/peaks_ratios/len_csa_sharp_r${RATIO}.nii.gz \
+            --iodf ${PEAKODFLIST[@]} \
+            --onufo ${NUFOLIST[@]} \
+            --odir ${DIRLIST[@]} \
+            --olen ${LENLIST[@]} \
             --relth 0.25 --minsep 25 --maxn 10 \
-            --mask ${DIFF_DATA_DIR}/mask.nii.gz
+            --mask ${DIFF_DATA_DIR}/mask.nii.gz \
+            --cores ${N_CORES}
 
-done
 
+    echo 'Computing AIC for all peaks approximation'
+    mkdir -p ${ODF_DIR}/aic_ratios
 
-echo 'Computing AIC for all peaks approximation'
-mkdir -p ${ODF_DIR}/aic_ratios
+    # all ratios in one call, the dwi and sigma are loaded and shared once
+    declare -a OAICLIST
+    for RATIO in ${RATIOS[@]};
+    do
+        OAICLIST+=(${ODF_DIR}/aic_ratios/aic_csa_sharp_r${RATIO}.nii.gz)
+    done
 
-for RATIO in ${RATIOS[@]};
-do
-    echo 'AIC from sharpened Ratio '${RATIO}
     python3 ${SCRIPTS}/compute_aic_all_peaks.py \
             --data ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.nii.gz \
             --bval ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bval \
             --bvec ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bvec \
             --mask ${DIFF_DATA_DIR}/mask.nii.gz \
-            --inufo ${ODF_DIR}/peaks_ratios/nufo_csa_sharp_r${RATIO}.nii.gz \
-            --idirs ${ODF_DIR}/peaks_ratios/dir_csa_sharp_r${RATIO}.nii.gz \
-            --ilen ${ODF_DIR}/peaks_ratios/len_csa_sharp_r${RATIO}.nii.gz \
+            --inufo ${NUFOLIST[@]} \
+            --idirs ${DIRLIST[@]} \
+            --ilen ${LENLIST[@]} \
             --sigma ${NOISEMAP_DIR}/sigma_norm.nii.gz \
-            --ratio ${RATIO} \
-            --oaic ${ODF_DIR}/aic_ratios/aic_csa_sharp_r${RATIO}.nii.gz \
+            --ratio ${RATIOS[@]} \
+            --oaic ${OAICLIST[@]} \
             --cores ${N_CORES}
-done
-
-
-# stack odf and aic filename in a list, in order of increasing ratios
-declare -a ODFFILELIST
-declare -a AICFILELIST
-for RATIO in ${RATIOS[@]};
-do
-    TMPODFFILE=${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz;
-    ODFFILELIST[${#ODFFILELIST[@]}+1]=$TMPODFFILE;
-    TMPAICFILE=${ODF_DIR}/aic_ratios/aic_csa_sharp_r${RATIO}.nii.gz;
-    AICFILELIST[${#AICFILELIST[@]}+1]=$TMPAICFILE;
-done
 
 
-# # Picks the ratio with lowest AIC for each voxel
-# python3 ${SCRIPTS}/combine_aic.py \
-#         --iaic ${AICFILELIST[@]} \
-#         --iodf ${ODFFILELIST[@]} \
-#         --mask ${DIFF_DATA_DIR}/mask.nii.gz \
-#         --ratios ${RATIOS[@]} \
-#         --oodf ${ODF_DIR}/best_voxelwise_aic_odf.nii.gz \
-#         --oaic ${ODF_DIR}/aic_ratios/best_voxelwise_aic_aic.nii.gz \
-#         --oratio ${ODF_DIR}/best_voxelwise_aic_ratio.nii.gz
+    # stack odf and aic filename in a list, in order of increasing ratios
+    declare -a ODFFILELIST
+    declare -a AICFILELIST
+    for RATIO in ${RATIOS[@]};
+    do
+        TMPODFFILE=${ODF_DIR}/sharpen_ratios/csa_sharp_r${RATIO}.nii.gz;
+        ODFFILELIST[${#ODFFILELIST[@]}+1]=$TMPODFFILE;
+        TMPAICFILE=${ODF_DIR}/aic_ratios/aic_csa_sharp_r${RATIO}.nii.gz;
+        AICFILELIST[${#AICFILELIST[@]}+1]=$TMPAICFILE;
+    done
 
 
+    # # Picks the ratio with lowest AIC for each voxel
+    # python3 ${SCRIPTS}/combine_aic.py \
+    #         --iaic ${AICFILELIST[@]} \
+    #         --iodf ${ODFFILELIST[@]} \
+    #         --mask ${DIFF_DATA_DIR}/mask.nii.gz \
+    #         --ratios ${RATIOS[@]} \
+    #         --oodf ${ODF_DIR}/best_voxelwise_aic_odf.nii.gz \
+    #         --oaic ${ODF_DIR}/aic_ratios/best_voxelwise_aic_aic.nii.gz \
+    #         --oratio ${ODF_DIR}/best_voxelwise_aic_ratio.nii.gz \
+    #         --stream
 
-# Picks the ratio with lowest AIC for each voxel in neighborhood
-python3 ${SCRIPTS}/combine_aic_neigh.py \
-        --iaic ${AICFILELIST[@]} \
-        --iodf ${ODFFILELIST[@]} \
-        --mask ${DIFF_DATA_DIR}/mask.nii.gz \
-        --ratios ${RATIOS[@]} \
-        --oodf ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
-        --oaic ${ODF_DIR}/aic_neighborhood_aic.nii.gz \
-        --oratio ${ODF_DIR}/ratio_best_neighborhood_aic.nii.gz
 
 
-echo 'Extracting peaks from best AIC ODFs'
-python3 ${SCRIPTS}/peak_extraction.py \
-        ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
-        ${ODF_DIR}/nufo_best_neighborhood_aic.nii.gz \
-        ${ODF_DIR}/dir_best_neighborhood_aic.nii.gz \
-        ${ODF_DIR}/len_best_neighborhood_aic.nii.gz \
-        --relth 0.25 --minsep 25 --maxn 10 \
-        --mask ${DIFF_DATA_DIR}/mask.nii.gz
-
-
-echo 'Normalize ODF'
-python3 ${SCRIPTS}/sh_odf_normalize.py \
-        ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
-        ${ODF_DIR}/odf_norm_best_neighborhood_aic.nii.gz
+    # Picks the ratio with lowest AIC for each voxel in neighborhood
+    python3 ${SCRIPTS}/combine_aic_neigh.py \
+            --iaic ${AICFILELIST[@]} \
+            --iodf ${ODFFILELIST[@]} \
+            --mask ${DIFF_DATA_DIR}/mask.nii.gz \
+            --ratios ${RATIOS[@]} \
+            --oodf ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
+            --oaic ${ODF_DIR}/aic_neighborhood_aic.nii.gz \
+            --oratio ${ODF_DIR}/ratio_best_neighborhood_aic.nii.gz \
+            --stream \
+            --cores ${N_CORES}
 
 
+    echo 'Extracting peaks from best AIC ODFs and normalize ODF'
+    python3 ${SCRIPTS}/peak_extraction.py \
+            ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
+            ${ODF_DIR}/nufo_best_neighborhood_aic.nii.gz \
+            ${ODF_DIR}/dir_best_neighborhood_aic.nii.gz \
+            ${ODF_DIR}/len_best_neighborhood_aic.nii.gz \
+            --onorm ${ODF_DIR}/odf_norm_best_neighborhood_aic.nii.gz \
+            --relth 0.25 --minsep 25 --maxn 10 \
+            --mask ${DIFF_DATA_DIR}/mask.nii.gz \
+            --cores ${N_CORES}
+else
+    # CSA fit, sharpening, peaks, AIC and neighborhood best ratio selection in a single process,
+    # the ratios are streamed in memory, add --intermediates ${ODF_DIR} to also write
+    # the per-ratio sharpen_ratios/, peaks_ratios/ and aic_ratios/ files
+    # (--voxelwise picks the lowest AIC of each voxel instead, as combine_aic.py,
+    # --search adaptive only evaluates a few ratios per voxel, --compare reports the
+    # voxels ending up at a different ratio than the exhaustive search)
+    echo 'Fit CSA, sharpen, extract peaks, compute AIC and pick best ratio'
+    python3 ${SCRIPTS}/run_odf_engine.py \
+            --data ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.nii.gz \
+            --bval ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bval \
+            --bval_csa ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm_rounded.bval \
+            --bvec ${DIFF_DATA_NORM_RELEASE_DIR}/data_norm.bvec \
+            --mask ${DIFF_DATA_DIR}/mask.nii.gz \
+            --sigma ${NOISEMAP_DIR}/sigma_norm.nii.gz \
+            --ratios ${RATIOS[@]} \
+            --shmax 6 --csa_tau 1e-5 --csa_lambda 0.006 \
+            --tau 0.1 --lambda 1. \
+            --relth 0.25 --minsep 25 --maxn 10 \
+            --ocsa ${ODF_DIR}/csa.nii.gz \
+            --oodf ${ODF_DIR}/odf_best_neighborhood_aic.nii.gz \
+            --oaic ${ODF_DIR}/aic_neighborhood_aic.nii.gz \
+            --oratio ${ODF_DIR}/ratio_best_neighborhood_aic.nii.gz \
+            --onufo ${ODF_DIR}/nufo_best_neighborhood_aic.nii.gz \
+            --odir ${ODF_DIR}/dir_best_neighborhood_aic.nii.gz \
+            --olen ${ODF_DIR}/len_best_neighborhood_aic.nii.gz \
+            --onorm ${ODF_DIR}/odf_norm_best_neighborhood_aic.nii.gz \
+            --cores ${N_CORES}
+fi
@@ -66,6 +66,9 @@ PE_DIRECTION="1"
 # Kernel ratio for the deconvolution
 RATIOS=(1.1 1.2 1.4 1.6 1.8 2.0 2.2 2.4 2.6 2.8 3.0 3.5 4.0 4.5 5.0 5.5 6.0)
 
+# Run the ODF steps one script per step with the per-ratio files instead of run_odf_engine.py
+ODF_PER_STEP= #YES/NO
+
 
 # Fetch file directory as Variable
 LOCAL_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
@@ -1,16 +1,19 @@
 import numpy as np
 
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count
 
 from dipy.core.geometry import cart2sphere
-from dipy.core.ndindex import ndindex
 
 from dipy.reconst.shm import sph_harm_lookup
-from dipy.reconst.csdeconv import forward_sdt_deconv_mat, odf_deconv
+from dipy.reconst.csdeconv import forward_sdt_deconv_mat
+
+from sphere_utils import hemisphere_indices
+from matrix_cache import cached
+from shared_array import SharedArrays, attach_shared_arrays, chunk_bounds, start_pool
 
 
 def odf_sh_to_sharp_parallel(odfs_sh, sphere, mask=None, basis=None, ratio=3 / 15., sh_order=8,
-                    lambda_=1., tau=0.1, r2_term=False, maxprocess=1):
+                    lambda_=1., tau=0.1, r2_term=False, maxprocess=1, block_size=1024, chunks_per_process=4):
     r""" Sharpen odfs using the sharpening deconvolution transform [2]_
 
     This function can be used to sharpen any smooth ODF spherical function. In
@@ -53,6 +56,13 @@ def odf_sh_to_sharp_parallel(odfs_sh, sphere, mask=None, basis=None, ratio=3 / 1
          GQI, SHORE, CSA, Tensor, Multi-tensor ODFs, should now be deconvolved
          with the r2_term=True.
 
+    maxprocess : int
+        number of processes
+    block_size : int
+        number of voxels deconvolved together (see SDTDeconvolver)
+    chunks_per_process : int
+        minimum number of chunks of voxels per process, for load balancing
+
     Returns
     -------
     fodf_sh : ndarray
@@ -74,47 +84,211 @@ def odf_sh_to_sharp_parallel(odfs_sh, sphere, mask=None, basis=None, ratio=3 / 1
 
     """
 
-    nprocess = min(maxprocess, cpu_count())
-
     if mask is None:
         mask = np.ones(odfs_sh.shape[:3], dtype=np.bool)
 
-    r, theta, phi = cart2sphere(sphere.x, sphere.y, sphere.z)
-    real_sym_sh = sph_harm_lookup[basis]
-
-    B_reg, m, n = real_sym_sh(sh_order, theta, phi)
-    R, P = forward_sdt_deconv_mat(ratio, n, r2_term=r2_term)
-
-    # scale lambda to account for differences in the number of
-    # SH coefficients and number of mapped directions
-    lambda_ = lambda_ * R.shape[0] * R[0, 0] / B_reg.shape[0]
-
-
-    global _odf_deconv # this is a hack to make the local function pickleable
-    def _odf_deconv(odf_sh):
-        fodf_sh, _ = odf_deconv(odf_sh, R, B_reg,
-                                lambda_=lambda_, tau=tau,
-                                r2_term=r2_term)
-        return fodf_sh
-
-    fodf_sh = np.zeros(odfs_sh.shape)
-
-    # maybe need chucksize
-    with Pool(processes=nprocess) as pool:
-        fodf_sh[mask] = pool.map(_odf_deconv, odfs_sh[mask])
-
+    with SDTSharpener(sphere, mask, odfs_sh.shape[-1], basis=basis, sh_order=sh_order, lambda_=lambda_, tau=tau, r2_term=r2_term,
+                      nbr_processes=maxprocess, block_size=block_size, chunks_per_process=chunks_per_process) as sharpener:
+        sharpener.load(odfs_sh[mask])
+        fodf_sh = sharpener(ratio)
 
     return fodf_sh
 
 
+class SDTSharpener(object):
+    """Persistent SDT sharpening of the voxels of a mask, for any number of ratios.
 
+    The regularization matrix, the masked odfs, the output buffer (both in
+    shared memory) and the worker pool are set up once. Each call only builds
+    the ratio dependent forward_sdt_deconv_mat and sends it with the
+    (start, stop) chunks to the workers, which deconvolve in place.
+    With pool (a shared_array.WorkerPool), its processes are used instead of a pool of its own.
+    Use as a context manager, the pool and the shared memory are released on exit.
+    """
 
+    def __init__(self, sphere, mask, Ncoef, basis=None, sh_order=8, lambda_=1., tau=0.1, r2_term=False,
+                 nbr_processes=1, block_size=1024, chunks_per_process=4, pool=None):
+        self.mask = mask
+        self.lambda_ = lambda_
+        self.r2_term = r2_term
+        self.nbr_processes = max(1, min(nbr_processes, cpu_count()))
+
+        def build_reg():
+            r, theta, phi = cart2sphere(sphere.x, sphere.y, sphere.z)
+            B_reg, m, n = sph_harm_lookup[basis](sh_order, theta, phi)
+            return B_reg, n
+        self.basis = basis
+        self.sh_order = sh_order
+        B_reg, self.n = cached('sdt_B_reg', build_reg, basis=basis, lmax=sh_order, sphere=sphere)
+        # the lambda scaling uses the number of directions of the full sphere
+        self.Nreg = B_reg.shape[0]
+
+        # the even order SH rows of antipodal vertices are equal, on a symmetric sphere
+        # every constraint row appears twice, keep one per pair (multiplicity 2)
+        hemi_idx, _ = hemisphere_indices(sphere)
+        multiplicity = 1
+        if hemi_idx is not None:
+            B_reg = B_reg[hemi_idx]
+            multiplicity = 2
+        deconv = SDTDeconvolver(B_reg, tau=tau, r2_term=r2_term, multiplicity=multiplicity)
+
+        # masked odfs and sharpened output live in shared memory, workers deconvolve (start, stop) chunks in place
+        Nvox = int(mask.sum())
+        self.shared = SharedArrays()
+        self.shared.create('odf', (Nvox, Ncoef))
+        self.shared.create('fodf', (Nvox, Ncoef))
+        self.block_size = block_size
+        self.chunks_per_process = chunks_per_process
+        self.Nloaded = Nvox
+        self.chunks = self._chunks(Nvox)
+
+        self.pool, self.own_pool = start_pool(self.shared, _init_deconv_worker, (deconv, block_size), self.nbr_processes, pool)
+
+    def _chunks(self, Nvox):
+        return chunk_bounds(Nvox, min(self.nbr_processes * self.chunks_per_process, int(np.ceil(Nvox / float(self.block_size)))))
+
+    def load(self, odfs_sh_masked):
+        # (Nmask, Ncoef) odfs to sharpen, or the odfs of a subset of the masked voxels (masked calls only)
+        Nvox = odfs_sh_masked.shape[0]
+        self.shared['odf'][:Nvox] = odfs_sh_masked
+        if Nvox != self.Nloaded:
+            self.Nloaded = Nvox
+            self.chunks = self._chunks(Nvox)
+
+    def response(self, ratio):
+        R, P = cached('forward_sdt_deconv_mat', lambda: forward_sdt_deconv_mat(ratio, self.n, r2_term=self.r2_term),
+                      basis=self.basis, lmax=self.sh_order, ratio=ratio, r2_term=self.r2_term)
+
+        # scale lambda to account for differences in the number of
+        # SH coefficients and number of mapped directions
+        lambda_ = self.lambda_ * R.shape[0] * R[0, 0] / self.Nreg
+        return R, lambda_
+
+    def __call__(self, ratio, masked=False):
+        # ratio of the smallest vs the largest eigenvalue of the response, returns the fodf_sh volume
+        # or with masked, a copy of the (Nmask, Ncoef) sharpened odfs
+        R, lambda_ = self.response(ratio)
+        tasks = [(bounds, R, lambda_) for bounds in self.chunks]
+        if self.pool is None:
+            for task in tasks:
+                _deconv_chunk(task)
+        else:
+            for _ in self.pool.imap_unordered(_deconv_chunk, tasks):
+                pass
+
+        if masked:
+            return self.shared['fodf'][:self.Nloaded].copy()
+        if self.Nloaded != self.shared['fodf'].shape[0]:
+            raise ValueError('Only a subset of the masked voxels is loaded, use masked=True')
+        fodf_sh = np.zeros(self.mask.shape + self.shared['fodf'].shape[1:])
+        fodf_sh[self.mask] = self.shared['fodf']
+        return fodf_sh
 
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+        elif self.pool is None:
+            _deconv_worker.clear()
+        self.pool = None
+        self.own_pool = False
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SDTDeconvolver(object):
+    """Batched version of dipy.reconst.csdeconv.odf_deconv.
+
+    Solves the constrained-regularized SDT for a block of voxels at once.
+    The per-voxel least-squares problem [R; lambda B_reg[k]] fodf = [odf; 0]
+    is solved through its normal equations
+        (R^T R + lambda^2 sum_{v in k} b_v b_v^T) fodf = R^T odf
+    where the outer products b_v b_v^T are computed once and R^T R, R^T once per
+    response (set_response), the system matrices of a whole block are then a single
+    (Nvox, Nvert) x (Nvert, Ncoef^2) product of the active constraint masks.
+    Each iteration only re-solves the voxels whose set of negative directions k
+    changed, as odf_deconv stops a voxel as soon as k is the same for two
+    consecutive iterations.
+    With multiplicity m, each row of B_reg stands for m identical rows of the
+    full regularization matrix (m = 2 for a hemisphere, see sphere_utils),
+    lambda is scaled by sqrt(m) and the norm of the q-ball ODF as well,
+    so the result is the one of the full matrix.
+    """
 
+    def __init__(self, B_reg, R=None, lambda_=1., tau=0.1, r2_term=False, convergence=50, multiplicity=1):
+        self.B_reg = B_reg
+        self.tau = tau
+        self.r2_term = r2_term
+        self.convergence = convergence
+        self.multiplicity = multiplicity
+        Ncoef = B_reg.shape[1]
+        self.B_outer = (B_reg[:, :, None] * B_reg[:, None, :]).reshape(B_reg.shape[0], Ncoef * Ncoef)
+        if R is not None:
+            self.set_response(R, lambda_)
+
+    def set_response(self, R, lambda_):
+        # initial estimate lstsq(R, odf), R is the same for every voxel
+        self.R_pinv = np.linalg.pinv(R)
+        self.RtR = R.T.dot(R)
+        self.Rt = R.T
+        self.lambda2 = self.multiplicity * lambda_ ** 2
+
+    def __call__(self, odfs_sh):
+        # odfs_sh (Nvox, Ncoef), returns fodf_sh (Nvox, Ncoef)
+        Nvox, Ncoef = odfs_sh.shape
+        fodf_sh = np.zeros((Nvox, Ncoef))
+
+        # odf_deconv returns zeros for NaN odfs
+        valid = ~np.isnan(odfs_sh).any(axis=1)
+        odfs_sh = odfs_sh[valid]
+
+        # initial fODF estimate, the ODF truncated at SH order 4
+        fodf = odfs_sh.dot(self.R_pinv.T)
+        fodf[:, 15:] = 0
+        if not self.r2_term:
+            Z = np.sqrt(self.multiplicity) * np.linalg.norm(fodf.dot(self.B_reg.T), axis=1)
+            fodf /= Z[:, None]
+        threshold = self.tau * np.max(fodf.dot(self.B_reg.T), axis=1)
+        rhs = odfs_sh.dot(self.Rt.T)
+
+        active = np.arange(odfs_sh.shape[0])
+        k = None
+        for num_it in range(1, self.convergence + 1):
+            k2 = fodf[active].dot(self.B_reg.T) < threshold[active, None]
+            if k is not None:
+                changed = (k != k2).any(axis=1)
+                active, k2 = active[changed], k2[changed]
+            if active.shape[0] == 0:
+                break
+            k = k2
+            M = self.RtR + self.lambda2 * k.astype(np.float64).dot(self.B_outer).reshape(-1, Ncoef, Ncoef)
+            fodf[active] = np.linalg.solve(M, rhs[active][:, :, None])[:, :, 0]
+
+        fodf_sh[valid] = fodf
+        return fodf_sh
 
 
+_deconv_worker = {}
 
 
+def _init_deconv_worker(specs, deconv, block_size):
+    _deconv_worker['arrays'] = attach_shared_arrays(specs)
+    _deconv_worker['deconv'] = deconv
+    _deconv_worker['block_size'] = block_size
 
 
-
+def _deconv_chunk(task):
+    bounds, R, lambda_ = task
+    arrays = _deconv_worker['arrays']
+    deconv = _deconv_worker['deconv']
+    block_size = _deconv_worker['block_size']
+    deconv.set_response(R, lambda_)
+    for block_start in range(bounds[0], bounds[1], block_size):
+        block_stop = min(block_start + block_size, bounds[1])
+        arrays['fodf'][block_start:block_stop] = deconv(arrays['odf'][block_start:block_stop])
+    return bounds
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import argparse
+
+from time import time
+
+import nibabel as nib
+import numpy as np
+
+from dipy.data import get_sphere
+from dipy.reconst.shm import real_sh_tournier, order_from_ncoef
+
+from odf_utils import PeakExtractor
+from sphere_utils import sh_matrix
+
+
+DESCRIPTION = """
+Benchmark the coarse sphere + SH refinement peak extraction against the
+sampled peak extraction on repulsion724.
+Reports timings and the angular difference between the peaks of both methods,
+as well as the grid error of the 724 points path (angle between its peaks and
+the same peaks refined on the SH).
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(
+        description=DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    p.add_argument('input', metavar='input',
+                   help='Path of the input odf SH volume (tournier07).')
+    p.add_argument('--mask', dest='mask', metavar='mask',
+                    help='Path to a binary mask.')
+    p.add_argument('--coarse', dest='coarse', metavar='coarse', type=str, default='repulsion100',
+                    help='Name of the coarse dipy sphere.')
+    p.add_argument('--relth', dest='relth', metavar='relth', type=float, default=0.25,
+                    help='Relative threshold for peak extraction.')
+    p.add_argument('--minsep', dest='minsep', metavar='minsep', type=float, default=25,
+                    help='Minimum separation angle in degree for peak extraction.')
+    p.add_argument('--maxn', dest='maxn', metavar='maxn', type=int, default=10,
+                    help='Maximum number of peak extracted per ODF.')
+    p.add_argument('--nvox', dest='nvox', metavar='nvox', type=int, default=0,
+                    help='Use a random subset of nvox masked voxels (0 for all).')
+    p.add_argument('--cores', dest='cores', metavar='cores', type=int, default=1,
+                    help='Number of processes.')
+    return p
+
+
+def run_peaks(odf_sh, sphere_name, sh_order, args, refine):
+    sphere = get_sphere(sphere_name)
+    B = sh_matrix(sphere, sh_order, real_sh_tournier)
+    mask = np.ones((odf_sh.shape[0], 1, 1), dtype=bool)
+    with PeakExtractor(B, sphere, mask, odf_sh.shape[-1], relative_peak_threshold=args.relth, min_separation_angle=args.minsep, Npeaks=args.maxn, nbr_processes=args.cores, sh_func=real_sh_tournier if refine else None) as extractor:
+        start_time = time()
+        peak_dir, peak_val, _ = extractor(odf_sh)
+        elapsed = time() - start_time
+        peak_dir, peak_val = peak_dir[:, 0, 0].copy(), peak_val[:, 0, 0].copy()
+    return peak_dir, peak_val, elapsed
+
+
+def angular_difference(ref_dir, ref_val, test_dir, test_val):
+    # angle in degree between each reference peak and the closest test peak (antipodally symmetric)
+    cos = np.abs(np.einsum('vij,vkj->vik', ref_dir, test_dir))
+    cos[np.broadcast_to((test_val <= 0)[:, None, :], cos.shape)] = 0
+    angles = np.rad2deg(np.arccos(np.clip(cos.max(axis=2), 0, 1)))
+    return angles[ref_val > 0]
+
+
+def report(name, angles, ref_val, test_val, minsep):
+    nufo_ref = (ref_val > 0).sum(axis=1)
+    nufo_test = (test_val > 0).sum(axis=1)
+    print(name)
+    print('    same nufo in {:.2f} % of voxels'.format(100 * np.mean(nufo_ref == nufo_test)))
+    print('    angular difference (deg): mean {:.3f}, median {:.3f}, 95th perc. {:.3f}, max {:.3f}'.format(angles.mean(), np.median(angles), np.percentile(angles, 95), angles.max()))
+    print('    peaks without match within {:.1f} deg: {:.2f} %'.format(minsep / 2., 100 * np.mean(angles > minsep / 2.)))
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+
+    odf_img = nib.load(args.input)
+    odf_sh = odf_img.get_fdata()
+    if args.mask is None:
+        mask = np.ones(odf_sh.shape[:3], dtype=bool)
+    else:
+        mask = nib.load(args.mask).get_fdata().astype(bool)
+    odf_sh = odf_sh[mask]
+    if args.nvox > 0 and args.nvox < odf_sh.shape[0]:
+        odf_sh = odf_sh[np.sort(np.random.default_rng(0).choice(odf_sh.shape[0], args.nvox, replace=False))]
+    sh_order = int(order_from_ncoef(odf_sh.shape[-1], full_basis=False))
+    print('{} voxels, lmax = {}'.format(odf_sh.shape[0], sh_order))
+
+    dir_724, val_724, time_724 = run_peaks(odf_sh, 'repulsion724', sh_order, args, refine=False)
+    dir_coarse, val_coarse, time_coarse = run_peaks(odf_sh, args.coarse, sh_order, args, refine=True)
+    dir_724_ref, val_724_ref, time_724_ref = run_peaks(odf_sh, 'repulsion724', sh_order, args, refine=True)
+
+    print('repulsion724 sampled           : {:.2f} s'.format(time_724))
+    print('{:} + SH refinement : {:.2f} s (x{:.2f})'.format(args.coarse.ljust(12), time_coarse, time_724 / time_coarse))
+    print('repulsion724 + SH refinement   : {:.2f} s'.format(time_724_ref))
+
+    report('{} + refinement vs repulsion724 sampled'.format(args.coarse),
+           angular_difference(dir_724, val_724, dir_coarse, val_coarse), val_724, val_coarse, args.minsep)
+    report('{} + refinement vs repulsion724 + refinement'.format(args.coarse),
+           angular_difference(dir_724_ref, val_724_ref, dir_coarse, val_coarse), val_724_ref, val_coarse, args.minsep)
+    report('repulsion724 sampled vs repulsion724 + refinement (grid error)',
+           angular_difference(dir_724_ref, val_724_ref, dir_724, val_724), val_724_ref, val_724, args.minsep)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,13 @@ from __future__ import division, print_function
 
 import argparse
 
-from time import time
-
 # import pylab as pl
 import nibabel as nib
 import numpy as np
 
+from crop_utils import GridCrop
+from combine_utils import gather_best, gather_best_odf, load_odf_stack, stream_best_odf, best_idx_labels
+
 
 
 
@@ -52,7 +53,19 @@ def buildArgsParser():
                              help='Path of the output best AICs.')
 
     p.add_argument('--oratio', type=str,
-                             help='Path of the output best ratios.')
+                             help='Path of the output best ratios.\n0 outside of mask, not the first ratio: 0 marks voxels without a selection.')
+
+    p.add_argument('--stream', action='store_true',
+                             help='Select the ODFs one ratio at a time instead of loading all of them.\nThe ODFs are read in a single forward pass, .nii and .nii.gz both work.')
+
+    p.add_argument('--slab', type=int, default=0,
+                             help='With --stream, read the ODFs by slabs of that many Z slices (0 for whole volumes).')
+
+    p.add_argument('--crop', action='store_true',
+                             help='Only load the bounding box of the mask (needs --mask).')
+
+    p.add_argument('--oidx', type=str,
+                             help='Optional: Path of the output uint8 label map of the best ratio\n(1 + index in --iodf, 0 outside of mask).')
 
     return p
 
@@ -90,16 +103,36 @@ def main():
     if (args.oodf is None) or (args.oaic is None) or (args.oratio is None):
         print('Need output name(s)')
         return None
+    if args.crop and len(args.mask) == 0:
+        parser.error('--crop needs --mask')
+
+
+
+    # load and multiply all the mask
+    print('Loading Mask')
+    img = nib.load(args.iaic[0])
+    affine = img.affine
+    mask = np.ones(img.shape[:3], dtype=bool)
+    mask_data = [nib.load(fname).get_fdata().astype(bool) for fname in args.mask]
+    for tmp in mask_data:
+        mask = np.logical_and(mask, tmp)
+    print('Final mask has {:} voxels ({:.1f} % of total)'.format(mask.sum(), 100*mask.sum()/np.prod(mask.shape)))
+    del mask_data
 
+    # the outputs are 0 outside of the mask, computing on its box gives the same results
+    if args.crop:
+        crop = GridCrop.from_mask(mask, affine)
+        print(crop)
+    else:
+        crop = GridCrop.full(mask.shape, affine)
+    mask = crop.crop(mask)
 
 
     # load and concatenate all the data
     print('Loading AIC data')
-    data_img = [nib.load(fname) for fname in args.iaic]
-    affine = data_img[0].affine
     data_data = []
-    for img in data_img:
-        tmp = img.get_fdata()
+    for fname in args.iaic:
+        tmp = crop.load(fname)
         # print('data shape = {:}'.format(tmp.shape))
         # need 4D data for the concatenate
         if tmp.ndim == 3:
@@ -111,31 +144,11 @@ def main():
 
 
     # load and concatenate all the data
-    print('Loading ODF data')
-    data_img = [nib.load(fname) for fname in args.iodf]
-    # affine = data_img[0].affine
-    data_data = []
-    for img in data_img:
-        tmp = img.get_fdata()
-        # print('data shape = {:}'.format(tmp.shape))
-        # need 5D data for the concatenate
-        if tmp.ndim == 4:
-            tmp = tmp[..., None]
-        data_data.append(tmp)
-    data_odfs = np.concatenate(data_data, axis=4)
-    print('Full data shape = {:}'.format(data_odfs.shape))
-    del data_data
-
-
+    if not args.stream:
+        print('Loading ODF data')
+        data_odfs = load_odf_stack(args.iodf, crop=crop)
+        print('Full data shape = {:}'.format(data_odfs.shape))
 
-    # load and multiply all the mask
-    print('Loading Mask')
-    mask = np.ones(data_aics.shape[:3], dtype=np.bool)
-    mask_data = [nib.load(fname).get_fdata().astype(np.bool) for fname in args.mask]
-    for tmp in mask_data:
-        mask = np.logical_and(mask, tmp)
-    print('Final mask has {:} voxels ({:.1f} % of total)'.format(mask.sum(), 100*mask.sum()/np.prod(data_aics.shape[:3])))
-    del mask_data
 
     
     ratios = np.array(args.ratios)
@@ -146,19 +159,20 @@ def main():
     best_idx = np.argmin(data_aics, axis=3)
 
 
-    best_aic = np.zeros(mask.shape)
-    best_ratio = np.zeros(mask.shape)
-    best_odf = np.zeros(mask.shape+(data_odfs.shape[3],))
     # repack everything
-    for xyz in np.ndindex(mask.shape):
-        best_aic[xyz] = data_aics[xyz][best_idx[xyz]]
-        best_ratio[xyz] = ratios[best_idx[xyz]]
-        best_odf[xyz] = data_odfs[xyz][:, best_idx[xyz]]
-
-
-    nib.Nifti1Image(best_aic, affine).to_filename(args.oaic)
-    nib.Nifti1Image(best_ratio, affine).to_filename(args.oratio)
-    nib.Nifti1Image(best_odf, affine).to_filename(args.oodf)
+    best_aic, best_ratio = gather_best(best_idx, mask, data_aics, ratios)
+    if args.stream:
+        print('Streaming ODF data')
+        best_odf = stream_best_odf(best_idx, mask, args.iodf, slab=args.slab, crop=crop)
+    else:
+        best_odf = gather_best_odf(best_idx, mask, data_odfs)
+        del data_odfs
+
+    crop.save(best_aic, args.oaic)
+    crop.save(best_ratio, args.oratio)
+    crop.save(best_odf, args.oodf)
+    if args.oidx is not None:
+        crop.save(best_idx_labels(best_idx, mask), args.oidx)
 
 
 
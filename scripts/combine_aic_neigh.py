@@ -11,7 +11,8 @@ from time import time
 import nibabel as nib
 import numpy as np
 
-from odf_utils import extract_patches
+from crop_utils import GridCrop
+from combine_utils import neighbourhood_kernel, neighbourhood_aic, gather_best, gather_best_odf, load_odf_stack, stream_best_odf, best_idx_labels
 
 
 
@@ -54,7 +55,31 @@ def buildArgsParser():
                              help='Path of the output best AICs.')
 
     p.add_argument('--oratio', type=str,
-                             help='Path of the output best ratios.')
+                             help='Path of the output best ratios.\n0 outside of mask, not the first ratio: 0 marks voxels without a selection.')
+
+    p.add_argument('--stream', action='store_true',
+                             help='Select the ODFs one ratio at a time instead of loading all of them.\nThe ODFs are read in a single forward pass, .nii and .nii.gz both work.')
+
+    p.add_argument('--slab', type=int, default=0,
+                             help='With --stream, read the ODFs by slabs of that many Z slices (0 for whole volumes).')
+
+    p.add_argument('--crop', action='store_true',
+                             help='Only load the bounding box of the mask (needs --mask).')
+
+    p.add_argument('--oidx', type=str,
+                             help='Optional: Path of the output uint8 label map of the best ratio\n(1 + index in --iodf, 0 outside of mask).')
+
+    p.add_argument('--kernel_size', type=int, default=3,
+                             help='Size (odd) in voxels of the neighborhood kernel.')
+
+    p.add_argument('--kernel_width', type=float, default=0.5,
+                             help='Width of the neighborhood kernel.')
+
+    p.add_argument('--kernel_shape', type=str, default='exponential', choices=['exponential', 'gaussian'],
+                             help='exponential: exp(-1/2 (r^2/width)^(1/2)), gaussian: exp(-1/2 r^2/width) (separable).')
+
+    p.add_argument('--cores', type=int, default=1,
+                             help='Number of processes (one ratio per process).')
 
     return p
 
@@ -92,16 +117,36 @@ def main():
     if (args.oodf is None) or (args.oaic is None) or (args.oratio is None):
         print('Need output name(s)')
         return None
+    if args.crop and len(args.mask) == 0:
+        parser.error('--crop needs --mask')
 
 
 
+    # load and multiply all the mask
+    print('Loading Mask')
+    img = nib.load(args.iaic[0])
+    affine = img.affine
+    mask = np.ones(img.shape[:3], dtype=bool)
+    mask_data = [nib.load(fname).get_fdata().astype(bool) for fname in args.mask]
+    for tmp in mask_data:
+        mask = np.logical_and(mask, tmp)
+    print('Final mask has {:} voxels ({:.1f} % of total)'.format(mask.sum(), 100*mask.sum()/np.prod(mask.shape)))
+    del mask_data
+
+    # the outputs are 0 outside of the mask, computing on its box gives the same results
+    if args.crop:
+        crop = GridCrop.from_mask(mask, affine)
+        print(crop)
+    else:
+        crop = GridCrop.full(mask.shape, affine)
+    mask = crop.crop(mask)
+
+
     # load and concatenate all the data
     print('Loading AIC data')
-    data_img = [nib.load(fname) for fname in args.iaic]
-    affine = data_img[0].affine
     data_data = []
-    for img in data_img:
-        tmp = img.get_fdata()
+    for fname in args.iaic:
+        tmp = crop.load(fname)
         # print('data shape = {:}'.format(tmp.shape))
         # need 4D data for the concatenate
         if tmp.ndim == 3:
@@ -113,63 +158,26 @@ def main():
 
 
     # load and concatenate all the data
-    print('Loading ODF data')
-    data_img = [nib.load(fname) for fname in args.iodf]
-    # affine = data_img[0].affine
-    data_data = []
-    for img in data_img:
-        tmp = img.get_fdata()
-        # print('data shape = {:}'.format(tmp.shape))
-        # need 5D data for the concatenate
-        if tmp.ndim == 4:
-            tmp = tmp[..., None]
-        data_data.append(tmp)
-    data_odfs = np.concatenate(data_data, axis=4)
-    print('Full data shape = {:}'.format(data_odfs.shape))
-    del data_data
-
+    if not args.stream:
+        print('Loading ODF data')
+        data_odfs = load_odf_stack(args.iodf, crop=crop)
+        print('Full data shape = {:}'.format(data_odfs.shape))
 
 
-    # load and multiply all the mask
-    print('Loading Mask')
-    mask = np.ones(data_aics.shape[:3], dtype=np.bool)
-    mask_data = [nib.load(fname).get_fdata().astype(np.bool) for fname in args.mask]
-    for tmp in mask_data:
-        mask = np.logical_and(mask, tmp)
-    print('Final mask has {:} voxels ({:.1f} % of total)'.format(mask.sum(), 100*mask.sum()/np.prod(data_aics.shape[:3])))
-    del mask_data
-
     
     ratios = np.array(args.ratios)
 
 
-    # build 3x3x3 damped kernel
-    kn = 3
-    padsize = int((kn-1)/2)
-    XX,YY,ZZ = np.meshgrid(range(kn), range(kn), range(kn))
-    sigma_kernel = 0.5
-    kernel = np.exp(-(1/2)*((((XX-(padsize))**2 + (YY-(padsize))**2 + (ZZ-(padsize))**2)/sigma_kernel)**0.5))/ (sigma_kernel*np.sqrt(2*np.pi))
-    kernel = kernel[..., None] / kernel.sum() # sum = 1
-
-
-    # computed kernel aic maps
-    dataloop = np.pad(data_aics, ((padsize,), (padsize,), (padsize,), (0,)))    
-    maskloop = np.pad(mask, padsize)
-
-    neigh_sum_aic = np.zeros(data_aics.shape)
-
-    data_patches = extract_patches(dataloop, (kn,kn,kn,ratios.shape[0]), (1,1,1,1), flatten=False)
-    mask_patches = extract_patches(maskloop, (kn,kn,kn), (1,1,1), flatten=False)
-
-    for xyz in np.ndindex(data_aics.shape[:3]):
-        if mask[xyz]:
-            datablock = data_patches[xyz+(0,)] * kernel
-            maskblock = mask_patches[xyz]
-
-            neigh_sum_aic[xyz] = np.sum(datablock[maskblock], axis=0)
-
+    # build damped kernel
+    if args.kernel_size % 2 == 0:
+        parser.error('--kernel_size must be odd')
+    kernel, factors = neighbourhood_kernel(args.kernel_size, args.kernel_width, args.kernel_shape)
 
 
+    # computed kernel aic maps, masked correlation of each ratio channel
+    start_time = time()
+    neigh_sum_aic = neighbourhood_aic(data_aics, mask, kernel, factors, nbr_processes=args.cores)
+    print('Elapsed time (neighborhood AIC) = {:.2f} s'.format(time() - start_time))
 
 
     # find best aic
@@ -177,19 +185,20 @@ def main():
     best_idx = np.argmin(neigh_sum_aic, axis=3)
 
 
-    best_aic = np.zeros(mask.shape)
-    best_ratio = np.zeros(mask.shape)
-    best_odf = np.zeros(mask.shape+(data_odfs.shape[3],))
     # repack everything
-    for xyz in np.ndindex(mask.shape):
-        best_aic[xyz] = data_aics[xyz][best_idx[xyz]]
-        best_ratio[xyz] = ratios[best_idx[xyz]]
-        best_odf[xyz] = data_odfs[xyz][:, best_idx[xyz]]
-
-
-    nib.Nifti1Image(best_aic, affine).to_filename(args.oaic)
-    nib.Nifti1Image(best_ratio, affine).to_filename(args.oratio)
-    nib.Nifti1Image(best_odf, affine).to_filename(args.oodf)
+    best_aic, best_ratio = gather_best(best_idx, mask, data_aics, ratios)
+    if args.stream:
+        print('Streaming ODF data')
+        best_odf = stream_best_odf(best_idx, mask, args.iodf, slab=args.slab, crop=crop)
+    else:
+        best_odf = gather_best_odf(best_idx, mask, data_odfs)
+        del data_odfs
+
+    crop.save(best_aic, args.oaic)
+    crop.save(best_ratio, args.oratio)
+    crop.save(best_odf, args.oodf)
+    if args.oidx is not None:
+        crop.save(best_idx_labels(best_idx, mask), args.oidx)
 
 
 
@@ -0,0 +1,167 @@
+import numpy as np
+import nibabel as nib
+
+from scipy.ndimage import correlate, correlate1d
+from scipy.signal import fftconvolve
+
+from shared_array import SharedArrays, SharedPool, attach_shared_arrays
+
+
+## NEIGHBOURHOOD AIC
+# The neighbourhood AIC of a voxel is the kernel weighted sum of the AIC of
+# the masked voxels around it, i.e. the correlation of aic*mask with the kernel.
+# Dividing by the correlation of the mask would give a weighted mean, but the
+# weight is the same for every ratio and doesn't change the best ratio.
+
+def neighbourhood_kernel(size=3, width=0.5, shape='exponential'):
+    # normalized (sum = 1) isotropic kernel of size^3 voxels (size odd)
+    # exponential: exp(-1/2 (r^2/width)^(1/2)), the original 3x3x3 kernel of combine_aic_neigh
+    # gaussian: exp(-1/2 r^2/width), separable
+    # returns the 3D kernel and its 1D factors (None if not separable)
+    half = (size - 1) // 2
+    x = np.arange(size) - half
+    r2 = x[:, None, None]**2 + x[None, :, None]**2 + x[None, None, :]**2
+    if shape == 'exponential':
+        kernel = np.exp(-(1/2)*((r2/width)**0.5))
+        factors = None
+    elif shape == 'gaussian':
+        factor = np.exp(-(1/2)*(x**2/width))
+        factor /= factor.sum()
+        kernel = np.exp(-(1/2)*(r2/width))
+        factors = [factor] * 3
+    else:
+        raise ValueError('Unknown kernel shape {:}'.format(shape))
+    return kernel / kernel.sum(), factors
+
+
+def masked_correlate(volume, mask, kernel, factors=None, direct_max_size=5):
+    # correlation of volume*mask with kernel, zero outside of the volume
+    # separable kernels use 3 1D passes, small kernels a direct correlation,
+    # larger ones an FFT so the cost doesn't grow with the cube of the kernel size
+    masked = volume * mask
+    if factors is not None:
+        for axis, factor in enumerate(factors):
+            masked = correlate1d(masked, factor, axis=axis, mode='constant', cval=0.)
+        return masked
+    if max(kernel.shape) <= direct_max_size:
+        return correlate(masked, kernel, mode='constant', cval=0.)
+    # correlation is the convolution with the flipped kernel
+    return fftconvolve(masked, kernel[::-1, ::-1, ::-1], mode='same')
+
+
+_neigh_worker = {}
+
+
+def _init_neigh_worker(specs, kernel, factors):
+    _neigh_worker['arrays'] = attach_shared_arrays(specs)
+    _neigh_worker['kernel'] = (kernel, factors)
+
+
+def _neigh_channel(channel):
+    arrays = _neigh_worker['arrays']
+    kernel, factors = _neigh_worker['kernel']
+    arrays['neigh'][channel] = masked_correlate(arrays['aic'][channel], arrays['mask'], kernel, factors)
+    arrays['neigh'][channel][~arrays['mask']] = 0
+    return channel
+
+
+def neighbourhood_aic(aics, mask, kernel, factors=None, nbr_processes=1):
+    # aics (X, Y, Z, Nratio), returns the neighbourhood AIC (X, Y, Z, Nratio), 0 outside of mask
+    # the ratio channels are smoothed in parallel, in shared memory
+    with SharedArrays() as shared:
+        shared.share('aic', np.moveaxis(aics, 3, 0))
+        shared.share('mask', mask)
+        shared.create('neigh', shared['aic'].shape)
+        with SharedPool(shared, _init_neigh_worker, (kernel, factors), nbr_processes=min(nbr_processes, aics.shape[3])) as pool:
+            pool.map(_neigh_channel, range(aics.shape[3]))
+        _neigh_worker.clear()
+        neigh = np.moveaxis(shared['neigh'], 0, 3).copy()
+    return neigh
+
+
+## BEST RATIO SELECTION
+# best_idx is only meaningful inside the mask, the outputs are gathered
+# for the masked voxels only and left at 0 elsewhere.
+# The ODFs are either gathered from the 5D (X, Y, Z, Ncoef, Nratio) stack
+# or streamed one ratio at a time (peak memory of about two ODF volumes).
+
+def gather_best(best_idx, mask, data_aics, ratios):
+    # best_idx (X, Y, Z) index of the best ratio, data_aics (X, Y, Z, Nratio)
+    # returns best_aic (X, Y, Z), best_ratio (X, Y, Z)
+    idx = best_idx[mask]
+    best_aic = np.zeros(mask.shape)
+    best_ratio = np.zeros(mask.shape)
+    best_aic[mask] = np.take_along_axis(data_aics[mask], idx[:, None], axis=1)[:, 0]
+    best_ratio[mask] = np.asarray(ratios)[idx]
+    return best_aic, best_ratio
+
+
+def gather_best_odf(best_idx, mask, data_odfs):
+    # data_odfs (X, Y, Z, Ncoef, Nratio), returns best_odf (X, Y, Z, Ncoef)
+    best_odf = np.zeros(mask.shape+(data_odfs.shape[3],))
+    # the advanced indices (voxel coordinates and ratio) come first, (Nmask, Ncoef)
+    best_odf[mask] = data_odfs[np.nonzero(mask) + (slice(None), best_idx[mask])]
+    return best_odf
+
+
+def load_odf_stack(fnames, crop=None):
+    # (X, Y, Z, Ncoef, Nratio) stack of all the ODFs, of the box of crop (GridCrop) if given
+    data_data = []
+    for fname in fnames:
+        tmp = nib.load(fname).get_fdata() if crop is None else crop.load(fname)
+        # print('data shape = {:}'.format(tmp.shape))
+        # need 5D data for the concatenate
+        if tmp.ndim == 4:
+            tmp = tmp[..., None]
+        data_data.append(tmp)
+    data_odfs = np.concatenate(data_data, axis=4)
+    return data_odfs
+
+
+def stream_best_odf(best_idx, mask, fnames, slab=0, crop=None):
+    # best_odf (X, Y, Z, Ncoef) without the 5D stack, the ODF of each ratio is read one
+    # coefficient volume (or slab of slab Z slices of it) at a time and only the masked voxels
+    # that picked it are scattered in the output, ratios picked by no voxel are not read at all
+    # the reads are in increasing file offset on a handle kept open, so a .nii.gz is
+    # decompressed once in a single forward pass instead of from the start at every read
+    # with crop (GridCrop), best_idx and mask are those of the box and only the box is read
+    if crop is None:
+        xy, z_start = (slice(None), slice(None)), 0
+    else:
+        xy, z_start = crop.slices[:2], crop.slices[2].start
+    best_odf = None
+    for i, fname in enumerate(fnames):
+        select = np.logical_and(mask, best_idx == i)
+        if not select.any():
+            continue
+        img = nib.load(fname, keep_file_open=True)
+        Ncoef = img.shape[3]
+        if best_odf is None:
+            best_odf = np.zeros(mask.shape+(Ncoef,))
+        Nz = mask.shape[2]
+        step = slab if slab > 0 else Nz
+        # the coefficient is the slowest axis on disk
+        for c in range(Ncoef):
+            for z0 in range(0, Nz, step):
+                z1 = min(z0 + step, Nz)
+                select_slab = select[:, :, z0:z1]
+                if not select_slab.any():
+                    continue
+                odf_slab = np.asarray(img.dataobj[xy + (slice(z_start + z0, z_start + z1), c)], dtype=np.float64).reshape(select_slab.shape)
+                best_odf[:, :, z0:z1, c][select_slab] = odf_slab[select_slab]
+                del odf_slab
+        # the kept open handle is closed with the proxy
+        del img
+    if best_odf is None:
+        # empty mask
+        best_odf = np.zeros(mask.shape+(nib.load(fnames[0]).shape[3],))
+    return best_odf
+
+
+def best_idx_labels(best_idx, mask):
+    # uint8 label map of the selected ratio, 1 + index in the input list, 0 outside of mask
+    if best_idx.max(initial=0) >= 255:
+        raise ValueError('Too many ratios for a uint8 label map')
+    labels = np.zeros(mask.shape, dtype=np.uint8)
+    labels[mask] = best_idx[mask] + 1
+    return labels
@@ -8,16 +8,18 @@ from time import time
 from dipy.io import read_bvals_bvecs
 # from dipy.core.sphere import HemiSphere
 from dipy.core.gradients import gradient_table
-from dipy.sims.voxel import multi_tensor
 
 from odf_utils import true_MD_func
+from peak_store import PeakStore, peak_store_shape
 
 from dipy.reconst.shm import real_sh_descoteaux
 
 # from dipy.data import get_sphere
 # reg_sphere = get_sphere('symmetric362')
 
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count
+
+from shared_array import SharedArrays, SharedPool, attach_shared_arrays, chunk_bounds
 
 from itertools import combinations as comb
 
@@ -38,18 +40,21 @@ def buildArgsParser():
                             help='Name of the input bvec')
     p.add_argument('--mask', type=str,
                             help='Optional: Name of mask nii file')
-    p.add_argument('--idirs', type=str,
-                            help='Name of the input peak dirs')
-    p.add_argument('--ilen', type=str,
-                            help='Name of the input peak len')
-    p.add_argument('--inufo', type=str,
-                            help='Name of the input nufo')
+    p.add_argument('--idirs', type=str, nargs='+',
+                            help='Name of the input peak dirs, one per ratio')
+    p.add_argument('--ilen', type=str, nargs='+',
+                            help='Name of the input peak len, one per ratio')
+    p.add_argument('--ipeaks', type=str, nargs='+',
+                            help='Name of the input sparse peak files (peak_extraction.py --opeaks), one per ratio,\n'
+                                 'instead of --idirs and --ilen')
+    p.add_argument('--inufo', type=str, nargs='+',
+                            help='Name of the input nufo (unused, the number of peaks is taken from len)')
     p.add_argument('--sigma', type=str,
                             help='Name of the input sigma map')
-    p.add_argument('--ratio', type=float, default = 2., 
-                            help='ratio of ODF sharpening')
-    p.add_argument('--oaic', type=str,
-                            help='Name of the output aic value')
+    p.add_argument('--ratio', type=float, nargs='+', default = [2.], 
+                            help='ratio(s) of ODF sharpening, the dwi and sigma are shared by all ratios')
+    p.add_argument('--oaic', type=str, nargs='+',
+                            help='Name of the output aic value, one per ratio')
     p.add_argument('--cores', type=int, default = 1, 
                             help='Number of processes')
 
@@ -67,11 +72,96 @@ def multigaussian_log_likelihood(diffs, sigma):
     return np.sum(gaussian_log_likelihood(diffs, sigma))
 
 
+def multi_axial_signal(bvals, bvecs, dirs, fractions, lambda_par, lambda_perp):
+    # noiseless signal (S0=1) of a sum of axially symmetric tensors, closed form of dipy multi_tensor
+    # g^T D g = lambda_perp |g|^2 + (lambda_par - lambda_perp) (g.u)^2 for a tensor of main axis u
+    # bvals (Ngrad,), bvecs (Ngrad, 3), dirs (Nvox, Npeaks, 3) unit vectors,
+    # fractions (Nvox, Npeaks) summing to 1, lambda_par and lambda_perp (Nvox,)
+    # returns (Nvox, Ngrad)
+    gu2 = np.einsum('vpj,gj->vpg', dirs, bvecs)**2
+    g2 = (bvecs**2).sum(axis=1)
+    gDg = lambda_perp[:, None, None] * g2 + (lambda_par - lambda_perp)[:, None, None] * gu2
+    return np.einsum('vp,vpg->vg', fractions, np.exp(-bvals * gDg))
+
+
+def aic_block(data, peak_dir, peak_len, sigma, MD_est, ratio, bvals, bvecs):
+    # AIC of the all peaks model for a block of voxels
+    # data (Nvox, Ndwi), peak_dir (Nvox, Npeaks, 3), peak_len (Nvox, Npeaks), sigma (Nvox,)
+    # MD_est (Nvox,) kernel MD estimated from the spherical mean of data (see true_MD_func)
+    # bvals (Ndwi,) and bvecs (Ndwi, 3) of the dwi volumes
+    # voxels are grouped by number of peaks, each group is evaluated in a few array operations
+
+    # kernel eigenvalues [1, 1/ratio, 1/ratio] * K
+    K = MD_est / ((1+2/ratio)/3)
+
+    # use all peaks
+    nufo = (peak_len>0).sum(axis=1)
+
+    aic_value = np.zeros(data.shape[0])
+    for Npeaks in np.unique(nufo):
+        idx = np.flatnonzero(nufo == Npeaks)
+
+        lens = peak_len[idx, :Npeaks]
+        vol_frac = lens / lens.sum(axis=1, keepdims=True)
+        # no peaks, no signal
+        noiseless_signal = multi_axial_signal(bvals, bvecs, peak_dir[idx, :Npeaks], vol_frac, K[idx], K[idx]/ratio)
+
+        diffs = data[idx] - noiseless_signal
+
+        loglikelihood = gaussian_log_likelihood(diffs, sigma[idx, None]).sum(axis=1)
+        aic_value[idx] = aic(loglikelihood, dof=3*Npeaks)
+
+    return aic_value
+
+
+_aic_worker = {}
+
+
+def _init_aic_worker(specs, bvals, bvecs, block_size):
+    _aic_worker['arrays'] = attach_shared_arrays(specs)
+    _aic_worker['gradients'] = (bvals, bvecs)
+    _aic_worker['block_size'] = block_size
+
+
+def _aic_chunk(task):
+    bounds, ratio = task
+    arrays = _aic_worker['arrays']
+    block_size = _aic_worker['block_size']
+    for start in range(bounds[0], bounds[1], block_size):
+        stop = min(start + block_size, bounds[1])
+        arrays['aic'][start:stop] = aic_block(arrays['data'][start:stop], arrays['dirs'][start:stop], arrays['lens'][start:stop], arrays['sigma'][start:stop], arrays['md'][start:stop], ratio, *_aic_worker['gradients'])
+    return bounds
+
+
 def main():
 
     parser = buildArgsParser()
     args = parser.parse_args()
 
+    if args.ipeaks is not None:
+        if args.idirs is not None or args.ilen is not None:
+            parser.error('--ipeaks replaces --idirs and --ilen')
+        if not (len(args.ipeaks) == len(args.ratio) == len(args.oaic)):
+            parser.error('--ipeaks, --ratio and --oaic need the same number of values')
+    elif args.idirs is None or args.ilen is None or not (len(args.idirs) == len(args.ilen) == len(args.ratio) == len(args.oaic)):
+        parser.error('--idirs, --ilen, --ratio and --oaic need the same number of values')
+
+    # the peaks of every ratio must be on the dwi grid, checked before any work
+    # so that no AIC map is left missing or stale
+    grid = nib.load(args.data).shape[:3]
+    if args.ipeaks is None:
+        dirs_shape = nib.load(args.idirs[0]).shape
+        if dirs_shape[:3] != grid or len(dirs_shape) != 5:
+            parser.error('{:} has shape {:}, expected {:} + (Npeaks, 3)'.format(args.idirs[0], dirs_shape, grid))
+        expected = [(fname, dirs_shape) for fname in args.idirs] + [(fname, dirs_shape[:4]) for fname in args.ilen]
+        for fname, shape in expected:
+            if nib.load(fname).shape != shape:
+                parser.error('{:} has shape {:}, expected {:}'.format(fname, nib.load(fname).shape, shape))
+    else:
+        for fname in args.ipeaks:
+            if peak_store_shape(fname) != grid:
+                parser.error('{:} has grid {:}, expected {:}'.format(fname, peak_store_shape(fname), grid))
+
     print('Load data')
     data_img = nib.load(args.data)
     data = data_img.get_fdata()
@@ -83,15 +173,11 @@ def main():
     gtab = gradient_table(bvals, bvecs)
 
     if args.mask is None:
-        mask = np.ones(data.shape[:3], dtype=np.bool)
+        mask = np.ones(data.shape[:3], dtype=bool)
     else:
-        mask = nib.load(args.mask).get_fdata().astype(np.bool)
+        mask = nib.load(args.mask).get_fdata().astype(bool)
 
 
-    print('Load peak extraction')
-    dirs = nib.load(args.idirs).get_fdata()
-    lens = nib.load(args.ilen).get_fdata()
-    nufo = nib.load(args.inufo).get_fdata()
     sigma = nib.load(args.sigma).get_fdata()
 
 
@@ -119,7 +205,6 @@ def main():
 
 
 
-    ratio = args.ratio
     NCORE = min(args.cores, cpu_count())
 
 
@@ -127,67 +212,66 @@ def main():
     N_data = data.shape[3]
     N_b0s = gtab.b0s_mask.sum()
     N_dwi = N_data - N_b0s
-    N_dirs = dirs.shape[3]
-
-    # build a function to estimate kernel MD from signal SM
-    MD_from_SM = true_MD_func(meanbval=gtab.bvals[~gtab.b0s_mask].mean(), ratio=ratio, minMD=0.01e-3, maxMD=3e-3, N_MD=3000)
-
-    global _aic_loop # this is a hack to make the local function pickleable
-    def _aic_loop(data):
-        # GTAB is defined outside the function because bad code
-        data_vox = data[:N_dwi]
-        peak_dir_vox = data[N_dwi:N_dwi+3*N_dirs].reshape((-1, 3))
-        peak_len_vox = data[N_dwi+3*N_dirs:N_dwi+4*N_dirs]
-        sigma = data[N_dwi+4*N_dirs]
-        ratio = data[N_dwi+4*N_dirs+1]
-
-        
-        # mean_bval = gtab.bvals[~gtab.b0s_mask].mean()
-        # MD_est = np.log(data_vox.mean())/(-mean_bval)
-        MD_est = MD_from_SM(data_vox.mean())
-
-        meval = np.array([1.0, 1/ratio, 1/ratio])
-        K = MD_est / ((1+2/ratio)/3)
-        meval *= K
-
-        vox_npeak = (peak_len_vox>0).sum()
-
-        # use all peaks
-        Npeaks = vox_npeak
-
-
-        mevals = np.repeat(meval[None, :], Npeaks, axis=0)
-
-        dirss = peak_dir_vox[:Npeaks]
-        vol_frac = peak_len_vox[:Npeaks]
-        vol_frac /= vol_frac.sum()
-
-        noiseless_signal, _ = multi_tensor(gtab, mevals=mevals, S0=1, angles=dirss, fractions=100*vol_frac, snr=None)
-
-        diffs = data_vox - noiseless_signal[~gtab.b0s_mask]
-
-        loglikelihood = multigaussian_log_likelihood(diffs, sigma)
-        criteria_value = aic(loglikelihood, dof=3*Npeaks)
-
-        return criteria_value
-
-
-    print('Concat data')
-    concat_data = np.concatenate((data[..., ~gtab.b0s_mask], dirs.reshape(dirs.shape[:3]+(3*dirs.shape[3],)), lens, sigma[..., None], ratio*np.ones(dirs.shape[:3]+(1,))), axis=3)
-    print(concat_data.shape)
-
-    print('Starting AIC all peaks')
-    aic_value = np.zeros(concat_data.shape[:3])
-    #
-    start_time = time()
-    # maybe need chucksize
-    with Pool(processes=NCORE) as pool:
-        aic_value[mask] = pool.map(_aic_loop, concat_data[mask])
-    end_time = time()
-    print('Elapsed time  = {:.2f} s'.format(end_time - start_time))
-
-    # save AIC values
-    nib.Nifti1Image(aic_value.astype(np.float), affine).to_filename(args.oaic)
+    meanbval = gtab.bvals[~gtab.b0s_mask].mean()
+
+    # masked dwi and sigma are published once in shared memory and stay there for all ratios,
+    # for each ratio the peaks are loaded in the shared buffers and the persistent workers
+    # compute the AIC of (start, stop) chunks in place
+    print('Share data')
+    Nvox = int(mask.sum())
+    with SharedArrays() as shared:
+        shared_data = shared.create('data', (Nvox, N_dwi))
+        for i, vol in enumerate(np.flatnonzero(~gtab.b0s_mask)):
+            shared_data[:, i] = data[..., vol][mask]
+        del shared_data, data
+        shared.share('sigma', sigma[mask])
+        # the spherical mean does not depend on the ratio
+        SM = shared['data'].mean(axis=1)
+
+        if args.ipeaks is None:
+            N_dirs = dirs_shape[3]
+            peak_inputs = list(zip(args.idirs, args.ilen))
+        else:
+            N_dirs = PeakStore(args.ipeaks[0]).max_peaks
+            peak_inputs = [(ipeaks, None) for ipeaks in args.ipeaks]
+        shared.create('dirs', (Nvox, N_dirs, 3))
+        shared.create('lens', (Nvox, N_dirs))
+        shared.create('md', (Nvox,))
+        shared.create('aic', (Nvox,))
+
+        chunks = chunk_bounds(Nvox, 4 * NCORE)
+        with SharedPool(shared, _init_aic_worker, (gtab.bvals[~gtab.b0s_mask], gtab.bvecs[~gtab.b0s_mask], 1024), nbr_processes=NCORE) as pool:
+            for (idirs, ilen), ratio, oaic in zip(peak_inputs, args.ratio, args.oaic):
+                print('AIC from sharpened Ratio {:}'.format(ratio))
+
+                print('Load peak extraction')
+                if ilen is None:
+                    # sparse peaks, straight into the shared buffers
+                    store = PeakStore(idirs)
+                    store.fill(mask, shared['dirs'], shared['lens'])
+                    del store
+                else:
+                    shared['dirs'][...] = nib.load(idirs).get_fdata()[mask].reshape((Nvox, N_dirs, 3))
+                    shared['lens'][...] = nib.load(ilen).get_fdata()[mask]
+
+                # build a function to estimate kernel MD from signal SM
+                # and evaluate it for every voxel in one call
+                # mean_bval = gtab.bvals[~gtab.b0s_mask].mean()
+                # MD_est = np.log(data_vox.mean())/(-mean_bval)
+                MD_from_SM = true_MD_func(meanbval=meanbval, ratio=ratio, minMD=0.01e-3, maxMD=3e-3, N_MD=3000)
+                shared['md'][...] = MD_from_SM(SM)
+
+                print('Starting AIC all peaks')
+                start_time = time()
+                pool.map(_aic_chunk, [(bounds, ratio) for bounds in chunks])
+                end_time = time()
+                print('Elapsed time  = {:.2f} s'.format(end_time - start_time))
+
+                aic_value = np.zeros(mask.shape)
+                aic_value[mask] = shared['aic']
+
+                # save AIC values
+                nib.Nifti1Image(aic_value.astype(np.float64), affine).to_filename(oaic)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import numpy as np
+import nibabel as nib
+
+
+## MASK BOUNDING BOX CROP
+# The post-mortem blocks fill a small part of the field of view, the heavy
+# scripts can work on the bounding box of the mask only (--crop).
+# The volumes are read through the nibabel array proxy (img.dataobj), only
+# the box is kept in memory, and the results are padded back to the full grid,
+# with the original affine, when written. Outside of the box the outputs are 0.
+# Without --crop the same code runs on the full grid (GridCrop.full).
+
+
+class GridCrop(object):
+    """Box (3 slices) of a grid of shape (X, Y, Z) and affine."""
+
+    def __init__(self, shape, affine, slices=None):
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.affine = affine
+        if slices is None:
+            slices = tuple(slice(0, s) for s in self.shape)
+        self.slices = tuple(slices)
+
+    @classmethod
+    def full(cls, shape, affine):
+        return cls(shape, affine)
+
+    @classmethod
+    def from_mask(cls, mask, affine, margin=0):
+        # smallest box containing the mask, grown by margin voxels
+        if not mask.any():
+            raise ValueError('Empty mask, nothing to crop to')
+        slices = []
+        for axis in range(3):
+            other = tuple(a for a in range(3) if a != axis)
+            idx = np.flatnonzero(mask.any(axis=other))
+            slices.append(slice(int(max(idx[0] - margin, 0)), int(min(idx[-1] + 1 + margin, mask.shape[axis]))))
+        return cls(mask.shape, affine, slices)
+
+    @property
+    def cropped_shape(self):
+        return tuple(s.stop - s.start for s in self.slices)
+
+    @property
+    def cropped_affine(self):
+        # the voxel (0, 0, 0) of the box is the voxel (start) of the grid
+        affine = np.array(self.affine, dtype=np.float64)
+        start = np.array([s.start for s in self.slices], dtype=np.float64)
+        affine[:3, 3] = affine[:3, :3].dot(start) + affine[:3, 3]
+        return affine
+
+    @property
+    def is_full(self):
+        return self.cropped_shape == self.shape
+
+    def __str__(self):
+        Nfull = np.prod(self.shape)
+        Ncrop = np.prod(self.cropped_shape)
+        return 'Crop {:} -> {:} ({:.1f} % of the voxels)'.format(self.shape, self.cropped_shape, 100 * Ncrop / Nfull)
+
+    def crop(self, array):
+        return array[self.slices]
+
+    def load(self, fname, dtype=np.float64):
+        # the box of a (X, Y, Z, ...) NIfTI, read through the array proxy
+        img = nib.load(fname)
+        if tuple(img.shape[:3]) != self.shape:
+            raise ValueError('{:} has shape {:}, expected {:}'.format(fname, img.shape, self.shape))
+        return np.asarray(img.dataobj[self.slices], dtype=dtype)
+
+    def uncrop(self, array, fill=0):
+        # (X', Y', Z', ...) box back to the (X, Y, Z, ...) grid
+        if self.is_full:
+            return array
+        full = np.full(self.shape + array.shape[3:], fill, dtype=array.dtype)
+        full[self.slices] = array
+        return full
+
+    def save(self, array, fname, fill=0):
+        nib.Nifti1Image(self.uncrop(array, fill), self.affine).to_filename(fname)
@@ -5,7 +5,8 @@ import argparse
 import nibabel as nib
 import numpy as np
 import os
-from scipy import interp
+
+from crop_utils import GridCrop
 
 
 DESCRIPTION =   'Drift Correction of dMRI Data, Based on Linear Interpolation Between b0s. Cornelius Eichner 2021'
@@ -24,6 +25,9 @@ def buildArgsParser():
     p.add_argument('--out', dest='out', action='store', type=str,
                             help='Output Path')
 
+    p.add_argument('--crop', dest='crop', action='store_true',
+                            help='Only load and correct the bounding box of the mask, 0 outside of it')
+
     return p
 
 
@@ -41,12 +45,20 @@ def main():
 
     # Load Data
     print('Loading Data')
-    data = nib.load(PATH_IN).get_fdata().astype(np.float32)
-    aff = nib.load(PATH_IN).affine
+    img = nib.load(PATH_IN)
+    aff = img.affine
+
+    mask = nib.load(PATH_MASK).get_fdata().astype(bool)
+
+    if args.crop:
+        crop = GridCrop.from_mask(mask, aff)
+        print(crop)
+    else:
+        crop = GridCrop.full(img.shape, aff)
+    data = crop.load(PATH_IN, dtype=np.float32)
+    mask = crop.crop(mask)
     dims = data.shape
 
-    mask = nib.load(PATH_MASK).get_fdata().astype(np.bool)
-
     bvals = np.round(np.genfromtxt(PATH_BVAL), -3).squeeze()
 
 
@@ -60,8 +72,8 @@ def main():
     b0_mean = data_mean[b0_mask].mean()
 
     # Interpolate between b0 images
-    data_idx = np.linspace(0, data_mean.shape[0]-1, data_mean.shape[0], dtype = np.int) 
-    b0_interp = interp(x = data_idx, xp = b0_idx, fp = data_mean[b0_idx])
+    data_idx = np.linspace(0, data_mean.shape[0]-1, data_mean.shape[0], dtype = int) 
+    b0_interp = np.interp(x = data_idx, xp = b0_idx, fp = data_mean[b0_idx])
 
     data_drift_corr = b0_mean * ( data[..., :] / b0_interp )
 
@@ -69,7 +81,7 @@ def main():
     # Save Data
     print('Saving Data')
 
-    nib.save(nib.Nifti1Image(np.clip(data_drift_corr, 0, np.inf), aff), PATH_OUT)
+    crop.save(np.clip(data_drift_corr, 0, np.inf), PATH_OUT)
 
 
 if __name__ == '__main__':
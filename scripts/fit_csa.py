@@ -10,9 +10,46 @@ from time import time
 from dipy.data import get_sphere
 from dipy.core.gradients import gradient_table
 from dipy.io.gradients import read_bvals_bvecs
-from dipy.reconst.shm import CsaOdfModel
+from dipy.reconst.shm import CsaOdfModel, order_from_ncoef
 
-from shconv import convert_sh_basis
+from shconv import sh_basis_conversion_matrix
+from shared_array import SharedArrays, attach_shared_arrays, chunk_bounds, shared_map
+
+
+def csa_tournier_matrix(csa_model, sphere_conv):
+	# fold the descoteaux07 -> tournier07 conversion into the CSA fitting matrix
+	# sh_tournier = loglog_data.dot(W) + offset, with the constant term of the CSA
+	# (coef[..., 0] = 0.5/sqrt(pi) in descoteaux07) moved to offset
+	fit_matrix = csa_model._fit_matrix.copy()
+	fit_matrix[0] = 0
+	sh_order = order_from_ncoef(fit_matrix.shape[0])
+	M = sh_basis_conversion_matrix(sh_order, sphere_conv, input_basis='descoteaux07')
+	W = fit_matrix.T.dot(M)
+	offset = csa_model._n0_const * M[0]
+	return W, offset
+
+
+_csa_worker = {}
+
+
+def _init_csa_worker(specs, where_b0s, where_dwi, min_signal, W, offset, block_size):
+	_csa_worker['arrays'] = attach_shared_arrays(specs)
+	_csa_worker['params'] = (where_b0s, where_dwi, min_signal, W, offset, block_size)
+
+
+def _csa_chunk(bounds):
+	# same steps as CsaOdfModel.fit (normalize_data and _get_shm_coef) in float32,
+	# on the masked voxels [start, stop)
+	arrays = _csa_worker['arrays']
+	where_b0s, where_dwi, min_signal, W, offset, block_size = _csa_worker['params']
+	for start in range(bounds[0], bounds[1], block_size):
+		stop = min(start + block_size, bounds[1])
+		data = arrays['dwi'][start:stop].clip(min_signal)
+		data /= data[:, where_b0s].mean(-1)[:, None]
+		data = data[:, where_dwi].clip(CsaOdfModel.min, CsaOdfModel.max)
+		loglog_data = np.log(-np.log(data))
+		arrays['sh'][start:stop] = np.dot(loglog_data, W) + offset
+	return bounds
 
 
 def main(dwipath, bvalpath, bvecpath, maskpath, outputpath, NCORE=1, tau=1e-5, lambda_=0.006, shmax=6):
@@ -51,7 +88,8 @@ def main(dwipath, bvalpath, bvecpath, maskpath, outputpath, NCORE=1, tau=1e-5, l
 	gtab = gradient_table(bvals, bvecs)
 
 	data_img = nib.load(dwipath)
-	data = data_img.get_fdata()
+	# normalize_data works in float32 anyway
+	data = data_img.get_fdata(dtype=np.float32)
 	affine = data_img.affine
 	print('This script expect normalized dwi data')
 
@@ -70,16 +108,25 @@ def main(dwipath, bvalpath, bvecpath, maskpath, outputpath, NCORE=1, tau=1e-5, l
 
 	print('Starting fitting')
 	csa_model = CsaOdfModel(gtab, sh_order=shmax, min_signal=tau, smooth=lambda_, assume_normed=False)
+	W, offset = csa_tournier_matrix(csa_model, sphere_conv)
+
+	# masked dwi (float32 like normalize_data) and tournier07 coefficients in shared memory,
+	# the workers fit chunks of voxels in place, a single full volume is built for saving
 	start_time = time()
-	csa_fit = csa_model.fit(data, mask=mask)
+	Nvox = int(mask.sum())
+	with SharedArrays() as shared:
+		shared.share('dwi', data[mask])
+		del data
+		shared.create('sh', (Nvox, W.shape[1]))
+		chunks = chunk_bounds(Nvox, 4 * NCORE)
+		shared_map(_csa_chunk, chunks, shared, _init_csa_worker, (csa_model._where_b0s, csa_model._where_dwi, csa_model.min_signal, W, offset, 4096), nbr_processes=NCORE)
+
+		tournier_sh = np.zeros(mask.shape + (W.shape[1],))
+		tournier_sh[mask] = shared['sh']
 	end_time = time()
-	print('Elapsed time = {:.2f} s'.format(end_time - start_time))
+	print('Elapsed time (fit, {} cores) = {:.2f} s'.format(NCORE, end_time - start_time))
 
-	start_time = time()
-	tournier_sh = convert_sh_basis(csa_fit.shm_coeff, sphere_conv, input_basis='descoteaux07', nbr_processes=NCORE)
 	nib.Nifti1Image(tournier_sh, affine).to_filename(outputpath)
-	end_time = time()
-	print('Elapsed time (conversion({} cores)) = {:.2f} s'.format(NCORE, end_time - start_time))
 
 
 
@@ -91,7 +138,7 @@ if __name__ == "__main__":
     # bvalpath is path to rounded bvals
     # bvecpath is path to normalized bvecs
     # outputpath is path to save tournier format SH
-    # NCORE is the nuber of core used ONLY FOR THE CONVERSION TO TOURNIER SH
+    # NCORE is the nuber of core used for the fit
     # tau is the minimal signal cutoff
     # lambda_ is the laplace-beltrami normalization weight
     # shmax is the spherical harmonic maximum order
@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import numbers
+import tempfile
+import numpy as np
+
+from collections import OrderedDict
+
+import dipy
+
+
+# Cache of the deterministic matrices of the ODF scripts (SH to SF matrices,
+# basis conversion, SDT regularization and response, SM(MD) tables).
+# An entry is identified by its kind and a key of plain values (basis, lmax,
+# sphere, ratio, r2_term, bvals, ...), spheres and arrays enter the key
+# through a hash of their values.
+# Entries are kept in an in-process LRU. The versioned store of .npz files
+# on disk, shared by all the runs and subjects, is opt-in: it is only used
+# when $EBC_MATRIX_CACHE is set to its directory (e.g. ~/.cache/ebc_dmri/matrices),
+# in a folder per cache format and dipy version, the least recently used
+# files are removed above max_disk_mb.
+# The cached arrays are read-only, copy them before modifying them.
+
+CACHE_VERSION = 1
+
+
+def _hash_array(array):
+    array = np.ascontiguousarray(array, dtype=np.float64)
+    return 'sha1:{:}:{:}'.format(hashlib.sha1(array.tobytes()).hexdigest()[:16], 'x'.join(str(s) for s in array.shape))
+
+
+def key_value(value):
+    """Canonical string of a key value."""
+    if value is None or isinstance(value, (bool, np.bool_, str)):
+        return str(value)
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    if hasattr(value, 'vertices'):
+        # dipy Sphere
+        return _hash_array(value.vertices)
+    return _hash_array(value)
+
+
+class MatrixCache(object):
+    """In-process LRU of max_items entries over an optional on-disk store in directory."""
+
+    def __init__(self, directory=None, max_items=128, max_disk_mb=256):
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_mb * 2**20
+        self.directory = None
+        if directory:
+            self.directory = os.path.join(directory, 'v{:}-dipy{:}'.format(CACHE_VERSION, dipy.__version__))
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def get(self, kind, build, **key):
+        """Cached build(), a ndarray or a tuple of ndarrays, for kind and key."""
+        key = json.dumps({name: key_value(value) for name, value in sorted(key.items())}, sort_keys=True)
+        name = '{:}_{:}'.format(kind, hashlib.sha1(key.encode()).hexdigest()[:24])
+
+        if name in self._memory:
+            self._memory.move_to_end(name)
+            self.hits += 1
+            return self._memory[name]
+
+        value = self._load(name, key)
+        if value is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            value = build()
+            if isinstance(value, np.ndarray):
+                value = np.array(value)
+            else:
+                value = tuple(np.array(v) for v in value)
+            self._save(name, key, value)
+
+        for array in (value,) if isinstance(value, np.ndarray) else value:
+            array.flags.writeable = False
+        self._memory[name] = value
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def _load(self, name, key):
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, name + '.npz')
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if str(npz['__key__']) != key:
+                    return None
+                if bool(npz['__single__']):
+                    value = npz['arr_0']
+                else:
+                    value = tuple(npz['arr_{:}'.format(i)] for i in range(int(npz['__count__'])))
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return value
+
+    def _save(self, name, key, value):
+        if self.directory is None:
+            return
+        arrays = [value] if isinstance(value, np.ndarray) else list(value)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # written next to its final name and renamed, concurrent runs never see a partial file
+            fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __key__=np.array(key), __single__=np.array(isinstance(value, np.ndarray)),
+                         __count__=np.array(len(arrays)), **{'arr_{:}'.format(i): a for i, a in enumerate(arrays)})
+            os.replace(tmp_path, os.path.join(self.directory, name + '.npz'))
+            self._evict_disk()
+        except OSError:
+            # read-only or full disk, the entry stays in memory
+            pass
+
+    def _evict_disk(self):
+        files = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, fname))
+                files.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for _, size, _ in files)
+        for _, size, fname in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, fname))
+                self.disk_evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self, disk=False):
+        self._memory.clear()
+        if disk and self.directory is not None and os.path.isdir(self.directory):
+            for fname in os.listdir(self.directory):
+                if fname.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, fname))
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'disk_evictions': self.disk_evictions,
+                'entries': len(self._memory)}
+
+    def __str__(self):
+        return 'Matrix cache: {hits:} hits, {disk_hits:} disk hits, {misses:} misses, {evictions:} evictions, {disk_evictions:} disk evictions'.format(**self.stats())
+
+
+_default_cache = None
+
+
+def default_cache():
+    """The MatrixCache shared by the scripts of a process."""
+    global _default_cache
+    if _default_cache is None:
+        # nothing is written to disk unless asked for
+        directory = os.environ.get('EBC_MATRIX_CACHE')
+        _default_cache = MatrixCache(os.path.expanduser(directory) if directory else None)
+    return _default_cache
+
+
+def cached(kind, build, **key):
+    """default_cache().get(kind, build, **key)"""
+    return default_cache().get(kind, build, **key)
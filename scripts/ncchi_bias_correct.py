@@ -7,6 +7,9 @@ import numpy as np
 import os
 import pylab as plt
 
+from crop_utils import GridCrop
+from nifti_stream import iter_volumes, NiftiVolumeWriter
+
 
 DESCRIPTION =   'Removal of non-central chi bias with simple method of moments. Pichael Maquette 2020'
 
@@ -28,6 +31,15 @@ def buildArgsParser():
     p.add_argument('--axes', dest='axes', action='store', type=str,
                             help='Correct Sigma along which axes (e.g., 0,2)')
 
+    p.add_argument('--mask', dest='mask', action='store', type=str,
+                            help='Optional: Path of the mask nii file (for --crop)')
+
+    p.add_argument('--crop', dest='crop', action='store_true',
+                            help='Only load and debias the bounding box of the mask, 0 outside of it')
+
+    p.add_argument('--stream', dest='stream', action='store_true',
+                            help='Debias in float32 one volume at a time, each volume is written as soon as it is debiased')
+
     return p
 
 
@@ -43,22 +55,36 @@ def main():
     PATH_N      = os.path.realpath(args.N)
     AXES        = eval(args.axes) 
 
+    if args.crop and args.mask is None:
+        parser.error('--crop needs --mask')
+
 
     # Load input file and sigma
     print('Loading Input Data {}'.format(PATH_IN))
-    data = nib.load(PATH_IN).get_fdata().astype(np.float)
-    aff = nib.load(PATH_IN).affine
-    dims = data.shape
+    img = nib.load(PATH_IN)
+    aff = img.affine
+    if args.crop:
+        crop = GridCrop.from_mask(nib.load(args.mask).get_fdata().astype(bool), aff)
+        print(crop)
+    else:
+        crop = GridCrop.full(img.shape, aff)
+    if args.stream:
+        # the volumes are only read while debiasing
+        data = None
+        dims = crop.cropped_shape + img.shape[3:]
+    else:
+        data = crop.load(PATH_IN)
+        dims = data.shape
 
     print('Data Dimensions {}'.format(dims))
     
     
     print('Loading Sigma {}'.format(PATH_SIG))
-    sigma = nib.load(PATH_SIG).get_fdata().astype(np.float)
+    sigma = nib.load(PATH_SIG).get_fdata().astype(np.float64)
     print('Sigma Dimensions {}'.format(sigma.shape))
 
     print('Loading N {}'.format(PATH_N))
-    N = nib.load(PATH_N).get_fdata().astype(np.float)
+    N = nib.load(PATH_N).get_fdata().astype(np.float64)
     print('N Dimensions {}'.format(N.shape))
 
 
@@ -75,18 +101,34 @@ def main():
     for i in set([0,1,2]).difference(set(AXES)):
         broadcast_idx[i] = slice(0, None)
 
-    sigma_array = np.zeros_like(sigma)
-    sigma_array[:,:,:] = mean_sigma_along_axes[tuple(broadcast_idx)]
+    # read-only broadcast views, no 3D copies
+    sigma_array = np.broadcast_to(mean_sigma_along_axes[tuple(broadcast_idx)], sigma.shape)
 
-    N_array = np.zeros_like(N)
-    N_array[:,:,:] = mean_N_along_axes[tuple(broadcast_idx)]
+    N_array = np.broadcast_to(mean_N_along_axes[tuple(broadcast_idx)], N.shape)
 
+    # the profiles are averaged on the full maps, then cropped like the data
+    sigma_array = crop.crop(sigma_array)
+    N_array = crop.crop(N_array)
 
-    print("Debiasing Data")
-    data_debias = np.sqrt(np.abs(data**2 - 2*N_array[..., None] * sigma_array[..., None]**2))
 
-    data_debias[np.isnan(np.abs(data_debias))] = 0
-    data_debias[np.isinf(np.abs(data_debias))] = 0
+    print("Debiasing Data")
+    if args.stream:
+        # a single 3D bias, then each volume is read, debiased and written in turn
+        bias = (2*N_array * sigma_array**2).astype(np.float32)
+        with NiftiVolumeWriter(PATH_OUT, crop.shape + dims[3:], aff) as writer:
+            for t, volume in iter_volumes(PATH_IN, crop.slices):
+                volume_debias = np.sqrt(np.abs(volume**2 - bias))
+                volume_debias[~np.isfinite(volume_debias)] = 0
+                writer.write(crop.uncrop(volume_debias))
+                # the plots only show the first volume
+                if t == 0:
+                    data, data_debias = volume[..., None], volume_debias[..., None]
+        print("Debiased Data Saved")
+    else:
+        data_debias = np.sqrt(np.abs(data**2 - 2*N_array[..., None] * sigma_array[..., None]**2))
+
+        data_debias[np.isnan(np.abs(data_debias))] = 0
+        data_debias[np.isinf(np.abs(data_debias))] = 0
 
     data_vmin = 0
     data_vmax = np.percentile(data[...,0], 95)
@@ -162,8 +204,9 @@ def main():
     plt.show()
 
 
-    print("Saving Debiased Data")
-    nib.nifti1.Nifti1Image(data_debias.astype(np.float32), aff).to_filename(PATH_OUT)
+    if not args.stream:
+        print("Saving Debiased Data")
+        crop.save(data_debias.astype(np.float32), PATH_OUT)
 
 
 if __name__ == '__main__':
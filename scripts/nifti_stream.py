@@ -0,0 +1,71 @@
+import gzip
+
+import numpy as np
+import nibabel as nib
+
+
+## VOLUME BY VOLUME NIFTI I/O
+# A 4D NIfTI stores its volumes one after the other (Fortran order), so a 4D
+# series can be read and written one 3D volume at a time, in increasing order,
+# without ever holding the whole series in memory. This also works on .nii.gz:
+# the input file is kept open so each read continues the decompression where
+# the previous one stopped, the output is a single gzip stream.
+
+
+def iter_volumes(fname, slices=None, dtype=np.float32):
+    # yield (t, volume) for the volumes of a 4D NIfTI, cut to the 3 slices if given (see GridCrop)
+    img = nib.load(fname, keep_file_open=True)
+    if slices is None:
+        slices = (slice(None),) * 3
+    for t in range(img.shape[3]):
+        yield t, np.asarray(img.dataobj[tuple(slices) + (t,)], dtype=dtype)
+
+
+class NiftiVolumeWriter(object):
+    """Write a (X, Y, Z, T) NIfTI of affine one (X, Y, Z) volume at a time, in order.
+    The header is written first, each volume is appended as it is produced.
+    """
+
+    def __init__(self, fname, shape, affine, dtype=np.float32):
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.fname = fname
+        self.Nwritten = 0
+
+        # header of nib.Nifti1Image(data, affine) for the full data
+        img = nib.Nifti1Image(np.zeros((1,) * len(self.shape), dtype=self.dtype), affine)
+        img.update_header()
+        header = img.header
+        header.set_data_shape(self.shape)
+        header.set_data_dtype(self.dtype)
+
+        # compression level of nibabel
+        self._file = gzip.open(fname, 'wb', compresslevel=1) if fname.endswith('.gz') else open(fname, 'wb')
+        # 348 bytes, the empty extension flag and the data right after (vox_offset 352)
+        header.write_to(self._file)
+
+    def write(self, volume):
+        if volume.shape != self.shape[:3]:
+            raise ValueError('Volume shape {:} differs from {:}'.format(volume.shape, self.shape[:3]))
+        if self.Nwritten >= int(np.prod(self.shape[3:])):
+            raise ValueError('All the {:} volumes of {:} are already written'.format(self.Nwritten, self.fname))
+        self._file.write(np.asarray(volume, dtype=self.dtype).tobytes(order='F'))
+        self.Nwritten += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self.Nwritten != int(np.prod(self.shape[3:])):
+            raise ValueError('{:} volumes written to {:}, expected {:}'.format(self.Nwritten, self.fname, int(np.prod(self.shape[3:]))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
@@ -6,6 +6,8 @@ import nibabel as nib
 import numpy as np
 import os
 
+from crop_utils import GridCrop
+
 
 DESCRIPTION =   'DMRI Data Normalization with B0 image and calculation of Spherical Mean Image. Cornelius Eichner 2020'
 FSL_LOCAL = '/data/pt_02101_dMRI/software/fsl6/bin/'
@@ -33,6 +35,9 @@ def buildArgsParser():
     p.add_argument('--out_folder', dest='out_fol', action='store', type=str,
                             help='Output Path')
 
+    p.add_argument('--crop', dest='crop', action='store_true',
+                            help='Only load and normalize the bounding box of the mask, 0 outside of it')
+
     return p
 
 
@@ -53,14 +58,26 @@ def main():
 
     # Load Data
     print('Loading Data')
-    data = nib.load(PATH_IN).get_fdata()
-    aff = nib.load(PATH_IN).affine
-    dims = data.shape
+    img = nib.load(PATH_IN)
+    aff = img.affine
 
     sigmas = nib.load(PATH_SIGMA).get_fdata()
     Ns = nib.load(PATH_N).get_fdata()
+    # on the full map, as without crop
+    mean_N = np.mean(Ns)
 
-    mask = nib.load(PATH_MASK).get_fdata().astype(np.bool)
+    mask = nib.load(PATH_MASK).get_fdata().astype(bool)
+
+    if args.crop:
+        crop = GridCrop.from_mask(mask, aff)
+        print(crop)
+    else:
+        crop = GridCrop.full(img.shape, aff)
+    data = crop.load(PATH_IN)
+    dims = data.shape
+    sigmas = crop.crop(sigmas)
+    Ns = crop.crop(Ns)
+    mask = crop.crop(mask)
 
     bvals = np.genfromtxt(PATH_BVAL)
     bvecs = np.genfromtxt(PATH_BVEC)
@@ -90,7 +107,7 @@ def main():
         # Normalize Data
         data_norm = np.clip(mask[..., None] * (data[..., diff_mask] / data_b0_mean[..., None]), 0, 1)
         # Concatenate mask as fake normalized b0
-        data_norm = np.concatenate((mask.astype(np.float)[...,None], data_norm), axis=3)
+        data_norm = np.concatenate((mask.astype(float)[...,None], data_norm), axis=3)
 
 
         # Clean Data from unwanted values
@@ -108,7 +125,7 @@ def main():
 
 
     # compute stable sigma estimation and normalize
-    sigma_stable = sigmas*Ns / np.mean(Ns)
+    sigma_stable = sigmas*Ns / mean_N
     sigma_norm = sigma_stable / data_b0_mean
 
     # cleanup sigma
@@ -119,10 +136,10 @@ def main():
 
     # Save Data
     print('Saving Data')
-    nib.save(nib.Nifti1Image(np.clip(data_norm, 0, 1).astype(np.float32), aff), PATH_OUT + 'data_norm.nii.gz')
-    nib.save(nib.Nifti1Image(np.clip(data_norm_mean, 0, 1).astype(np.float32), aff), PATH_OUT + 'data_norm_mean.nii.gz')
-    nib.save(nib.Nifti1Image(np.clip(data_norm_std, 0, 1).astype(np.float32), aff), PATH_OUT + 'data_norm_std.nii.gz')
-    nib.save(nib.Nifti1Image(np.clip(sigma_norm, 0, 1).astype(np.float32), aff), PATH_OUT + 'sigma_norm.nii.gz')
+    crop.save(np.clip(data_norm, 0, 1).astype(np.float32), PATH_OUT + 'data_norm.nii.gz')
+    crop.save(np.clip(data_norm_mean, 0, 1).astype(np.float32), PATH_OUT + 'data_norm_mean.nii.gz')
+    crop.save(np.clip(data_norm_std, 0, 1).astype(np.float32), PATH_OUT + 'data_norm_std.nii.gz')
+    crop.save(np.clip(sigma_norm, 0, 1).astype(np.float32), PATH_OUT + 'sigma_norm.nii.gz')
     
     np.savetxt(PATH_OUT + 'data_norm.bval', bvals_norm, fmt = '%.5f')
     np.savetxt(PATH_OUT + 'data_norm.bvec', bvecs_norm, fmt = '%.5f')
@@ -0,0 +1,331 @@
+import numpy as np
+from time import time
+from contextlib import contextmanager
+
+from multiprocessing import cpu_count
+
+from scipy.ndimage import binary_dilation
+
+from dipy.data import get_sphere
+from dipy.reconst.shm import CsaOdfModel, real_sh_tournier, calculate_max_order
+
+from shared_array import SharedArrays, SharedPool, WorkerPool, chunk_bounds, shared_map
+from fit_csa import csa_tournier_matrix, _init_csa_worker, _csa_chunk
+from _sharpen_parallel import SDTSharpener
+from odf_utils import PeakExtractor, true_MD_func
+from compute_aic_all_peaks import _init_aic_worker, _aic_chunk, _aic_worker, aic_block
+from combine_utils import masked_correlate
+from sphere_utils import sh_matrix
+
+
+## IN MEMORY ODF PIPELINE
+# The CSA fit -> sharpening -> peaks -> AIC -> best ratio chain of 14_diff_run_odf.sh
+# without the per-ratio NIfTI round trips. The masked dwi, sigma and CSA coefficients
+# are kept in memory, every ratio is streamed through the persistent sharpening,
+# peak extraction and AIC workers and only the running best AIC, ratio and ODF are kept.
+# Each step is the one of the standalone scripts (fit_csa, sharpen_sh_parallel,
+# peak_extraction, compute_aic_all_peaks, combine_aic(_neigh)), so are the results.
+# All the per-ratio arrays are (Nmask, ...) arrays of the masked voxels.
+# The AIC dwi (float64) is written once in a shared block owned by the engine and stays
+# there for all ratios, the float32 CSA dwi is dropped after the CSA fit.
+
+
+def _aic_rows_chunk(task):
+    # _aic_chunk for a subset of the AIC voxels: the dwi and sigma are read at the indices
+    # arrays['rows'] of the resident buffers, block by block, the other buffers are packed
+    bounds, ratio = task
+    arrays = _aic_worker['arrays']
+    block_size = _aic_worker['block_size']
+    for start in range(bounds[0], bounds[1], block_size):
+        stop = min(start + block_size, bounds[1])
+        rows = arrays['rows'][start:stop]
+        arrays['aic'][start:stop] = aic_block(arrays['data'][rows], arrays['dirs'][start:stop], arrays['lens'][start:stop], arrays['sigma'][rows], arrays['md'][start:stop], ratio, *_aic_worker['gradients'])
+    return bounds
+
+
+class ODFEngine(object):
+    """In memory ODF pipeline over the voxels of a mask.
+
+    data is the normalized dwi (X, Y, Z, Ndata), sigma the normalized noise map,
+    gtab the gradient table of the AIC and gtab_csa the one of the CSA fit
+    (rounded bvals, default gtab). Only the masked voxels are kept.
+    The engine owns shared memory blocks, use it as a context manager (or close it).
+    """
+
+    def __init__(self, data, mask, sigma, gtab, gtab_csa=None, sh_order=6, csa_tau=1e-5, csa_lambda=0.006,
+                 sharpen_tau=0.1, sharpen_lambda=1., r2_term=True,
+                 relative_peak_threshold=0.25, min_separation_angle=25, Npeaks=10, peak_sphere='repulsion724',
+                 nbr_processes=1, verbose=True):
+        self.mask = mask
+        self.gtab = gtab
+        self.gtab_csa = gtab if gtab_csa is None else gtab_csa
+        self.sh_order = sh_order
+        self.csa_tau = csa_tau
+        self.csa_lambda = csa_lambda
+        self.sharpen_tau = sharpen_tau
+        self.sharpen_lambda = sharpen_lambda
+        self.r2_term = r2_term
+        self.relative_peak_threshold = relative_peak_threshold
+        self.min_separation_angle = min_separation_angle
+        self.Npeaks = Npeaks
+        self.peak_sphere = peak_sphere
+        self.nbr_processes = max(1, min(nbr_processes, cpu_count()))
+        self.verbose = verbose
+
+        # the CSA fit works in float32 on the raw data (see fit_csa), dropped after the fit
+        self.dwi_csa = data[mask].astype(np.float32)
+
+        # the AIC uses the cleaned dwi volumes and the voxels with sigma > 0 (see compute_aic_all_peaks)
+        # they are written volume by volume in the shared buffer read by the AIC workers for every ratio
+        sigma = np.clip(sigma, 0, np.inf)
+        sigma[~np.isfinite(sigma)] = 0
+        self.aic_voxels = sigma[mask] > 0
+        aic_mask = np.logical_and(mask, sigma > 0)
+        Naic = int(aic_mask.sum())
+        self.shared = SharedArrays()
+        dwi = self.shared.create('data', (Naic, int((~gtab.b0s_mask).sum())))
+        for i, vol in enumerate(np.flatnonzero(~gtab.b0s_mask)):
+            dwi[:, i] = data[..., vol][aic_mask]
+        np.clip(dwi, 0, 1, out=dwi)
+        dwi[~np.isfinite(dwi)] = 0
+        self.shared.share('sigma', sigma[aic_mask])
+        # the spherical mean does not depend on the ratio
+        self.SM = dwi.mean(axis=1)
+        # per-ratio AIC inputs and outputs, packed at the start for a subset of the voxels
+        self.shared.create('rows', (Naic,), dtype=int)
+        self.shared.create('dirs', (Naic, Npeaks, 3))
+        self.shared.create('lens', (Naic, Npeaks))
+        self.shared.create('md', (Naic,))
+        self.shared.create('aic', (Naic,))
+
+        self.csa = None
+
+    def _print(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def fit_csa(self):
+        # (Nmask, Ncoef) tournier07 CSA coefficients
+        if self.csa is not None:
+            return self.csa
+        csa_model = CsaOdfModel(self.gtab_csa, sh_order_max=self.sh_order, min_signal=self.csa_tau, smooth=self.csa_lambda, assume_normed=False)
+        W, offset = csa_tournier_matrix(csa_model, get_sphere(name='repulsion200'))
+        start_time = time()
+        Nvox = self.dwi_csa.shape[0]
+        with SharedArrays() as shared:
+            shared.share('dwi', self.dwi_csa)
+            shared.create('sh', (Nvox, W.shape[1]))
+            chunks = chunk_bounds(Nvox, 4 * self.nbr_processes)
+            shared_map(_csa_chunk, chunks, shared, _init_csa_worker, (csa_model._where_b0s, csa_model._where_dwi, csa_model.min_signal, W, offset, 4096), nbr_processes=self.nbr_processes)
+            self.csa = shared['sh'].copy()
+        self.dwi_csa = None
+        self._print('Elapsed time (CSA fit) = {:.2f} s'.format(time() - start_time))
+        return self.csa
+
+    @contextmanager
+    def workers(self):
+        # persistent sharpening, peak extraction and AIC workers, yields evaluate(ratio, rows=None, peaks=True)
+        # returning (fodf, peak_dir, peak_len, aic) of the masked voxels rows (default all of them),
+        # aic is 0 for the voxels with sigma = 0, with peaks=False only fodf is computed
+        # the three steps run one after the other on the same nbr_processes worker processes
+        csa = self.fit_csa()
+        Ncoef = csa.shape[1]
+        lmax = calculate_max_order(Ncoef, full_basis=False)
+
+        sphere = get_sphere(name=self.peak_sphere)
+        B = sh_matrix(sphere, lmax, real_sh_tournier)
+
+        bvals = self.gtab.bvals[~self.gtab.b0s_mask]
+        bvecs = self.gtab.bvecs[~self.gtab.b0s_mask]
+        meanbval = bvals.mean()
+        shared = self.shared
+        # index of each masked voxel in the AIC arrays
+        aic_index = np.cumsum(self.aic_voxels) - 1
+
+        with WorkerPool(self.nbr_processes) as workers, \
+             SDTSharpener(get_sphere(name='symmetric362'), self.mask, Ncoef, basis='tournier07', sh_order=lmax,
+                          lambda_=self.sharpen_lambda, tau=self.sharpen_tau, r2_term=self.r2_term,
+                          nbr_processes=self.nbr_processes, pool=workers) as sharpener, \
+             PeakExtractor(B, sphere, self.mask, Ncoef, relative_peak_threshold=self.relative_peak_threshold,
+                           min_separation_angle=self.min_separation_angle, Npeaks=self.Npeaks,
+                           nbr_processes=self.nbr_processes, pool=workers) as extractor:
+            with SharedPool(shared, _init_aic_worker, (bvals, bvecs, 1024), nbr_processes=self.nbr_processes, pool=workers) as pool:
+
+                def evaluate(ratio, rows=None, peaks=True):
+                    start_time = time()
+                    sharpener.load(csa if rows is None else csa[rows])
+                    fodf = sharpener(1/ratio, masked=True)
+                    self._print('Elapsed time (sharpening) = {:.2f} s'.format(time() - start_time))
+                    if not peaks:
+                        return fodf
+
+                    start_time = time()
+                    peak_dir, peak_len, _ = extractor(fodf, voxels=rows)
+                    voxels = self.mask if rows is None else np.unravel_index(extractor.mask_voxels[rows], self.mask.shape)
+                    peak_dir = peak_dir[voxels]
+                    peak_len = peak_len[voxels]
+                    self._print('Elapsed time (peaks) = {:.2f} s'.format(time() - start_time))
+
+                    # all the voxels use the resident dwi and sigma in place, a subset reads them
+                    # at its rows (_aic_rows_chunk), the peaks and MD are packed at the start of the buffers
+                    start_time = time()
+                    if rows is None:
+                        sel = self.aic_voxels
+                        SM = self.SM
+                        chunk = _aic_chunk
+                    else:
+                        sel = self.aic_voxels[rows]
+                        aic_rows = aic_index[rows[sel]]
+                        shared['rows'][:aic_rows.shape[0]] = aic_rows
+                        SM = self.SM[aic_rows]
+                        chunk = _aic_rows_chunk
+                    Nrows = SM.shape[0]
+                    shared['dirs'][:Nrows] = peak_dir[sel]
+                    shared['lens'][:Nrows] = peak_len[sel]
+                    shared['md'][:Nrows] = true_MD_func(meanbval=meanbval, ratio=ratio, minMD=0.01e-3, maxMD=3e-3, N_MD=3000)(SM)
+                    pool.map(chunk, [(bounds, ratio) for bounds in chunk_bounds(Nrows, 4 * self.nbr_processes)])
+                    aic = np.zeros(fodf.shape[0])
+                    aic[sel] = shared['aic'][:Nrows]
+                    self._print('Elapsed time (AIC) = {:.2f} s'.format(time() - start_time))
+                    return fodf, peak_dir, peak_len, aic
+
+                yield evaluate
+
+    def stream(self, ratios):
+        # generator of (ratio, fodf, peak_dir, peak_len, aic) of all the masked voxels for each ratio
+        with self.workers() as evaluate:
+            for ratio in ratios:
+                self._print('Ratio {:}'.format(ratio))
+                yield (ratio,) + evaluate(ratio)
+
+    def select(self, ratios, kernel=None, factors=None, callback=None):
+        # lowest AIC ratio of each voxel, of the neighbourhood AIC if a kernel is given (see combine_utils)
+        # callback(i, ratio, fodf, peak_dir, peak_len, aic) is called for each ratio, e.g. to save the intermediates
+        # returns the best_aic (the AIC of the voxel, not the neighbourhood one), best_ratio,
+        # best_idx and best_odf volumes, 0 outside of mask
+        Nvox = int(self.mask.sum())
+        best_score = np.full(Nvox, np.inf)
+        best_aic = np.zeros(Nvox)
+        best_ratio = np.zeros(Nvox)
+        best_idx = np.zeros(Nvox, dtype=int)
+        best_odf = None
+        aic_vol = np.zeros(self.mask.shape)
+
+        for i, (ratio, fodf, peak_dir, peak_len, aic) in enumerate(self.stream(ratios)):
+            if callback is not None:
+                callback(i, ratio, fodf, peak_dir, peak_len, aic)
+            if kernel is None:
+                score = aic
+            else:
+                aic_vol[self.mask] = aic
+                score = masked_correlate(aic_vol, self.mask, kernel, factors)[self.mask]
+            # strict comparison, ties keep the first ratio like argmin
+            better = score < best_score
+            if best_odf is None:
+                best_odf = np.zeros(fodf.shape)
+            best_score[better] = score[better]
+            best_aic[better] = aic[better]
+            best_ratio[better] = ratio
+            best_idx[better] = i
+            best_odf[better] = fodf[better]
+
+        return (self.unmask(best_aic), self.unmask(best_ratio),
+                self.unmask(best_idx), self.unmask(best_odf))
+
+    def search(self, ratios, kernel=None, factors=None, coarse=3, golden=0.382):
+        # adaptive version of select, for AIC curves unimodal over the ratio list
+        # every voxel is evaluated at coarse ratios evenly spread over the list (first and last included),
+        # then each round evaluates a single ratio per voxel in the larger gap around its current best,
+        # at golden times the gap from the best, until both neighbours of the best in the list are evaluated
+        # with a kernel, a ratio asked by a voxel is also evaluated in its kernel neighbourhood, so the
+        # neighbourhood AIC of the ratios it compares are the full sums of select
+        # returns the select outputs and the number of voxel evaluations
+        Nratio = len(ratios)
+        Nvox = int(self.mask.sum())
+        aics = np.zeros((Nratio, Nvox))
+        evaluated = np.zeros((Nratio, Nvox), dtype=bool)
+        scores = np.full((Nratio, Nvox), np.inf)
+        odf_idx = np.full(Nvox, -1)
+        best_odf = None
+        Nevals = 0
+        support = None if kernel is None else kernel > 0
+
+        todo = {k: np.arange(Nvox) for k in np.unique(np.round(np.linspace(0, Nratio-1, coarse)).astype(int))}
+        with self.workers() as evaluate:
+            while todo:
+                fodfs = {}
+                for k in sorted(todo):
+                    rows = todo[k]
+                    if support is not None:
+                        asked = np.zeros(Nvox, dtype=bool)
+                        asked[rows] = True
+                        asked = binary_dilation(self.unmask(asked), structure=support)[self.mask]
+                        rows = todo[k] = np.flatnonzero(np.logical_and(asked, ~evaluated[k]))
+                        if rows.shape[0] == 0:
+                            continue
+                    self._print('Ratio {:} ({:} voxels)'.format(ratios[k], rows.shape[0]))
+                    fodfs[k], _, _, aics[k, rows] = evaluate(ratios[k], rows)
+                    evaluated[k, rows] = True
+                    Nevals += rows.shape[0]
+                    scores[k] = self._partial_score(aics[k], evaluated[k], kernel, factors, support)
+
+                best = np.argmin(scores, axis=0)
+                for k, fodf in fodfs.items():
+                    if best_odf is None:
+                        best_odf = np.zeros((Nvox, fodf.shape[1]))
+                    picked = best[todo[k]] == k
+                    best_odf[todo[k][picked]] = fodf[picked]
+                    odf_idx[todo[k][picked]] = k
+                todo = self._next_ratios(best, np.isfinite(scores), golden)
+
+            # a ratio completed by the neighbours of a voxel can become its best after its ODF was kept
+            for k in np.unique(best[odf_idx != best]):
+                rows = np.flatnonzero(np.logical_and(best == k, odf_idx != best))
+                best_odf[rows] = evaluate(ratios[k], rows, peaks=False)
+
+        best_aic = aics[best, np.arange(Nvox)]
+        best_ratio = np.asarray(ratios, dtype=float)[best]
+        return (self.unmask(best_aic), self.unmask(best_ratio),
+                self.unmask(best), self.unmask(best_odf)), Nevals
+
+    def _partial_score(self, aic, evaluated, kernel=None, factors=None, support=None):
+        # (Nmask,) score of the voxels evaluated at a ratio, with a kernel only of the voxels
+        # whose whole neighbourhood is evaluated, inf for the others
+        if kernel is None:
+            return np.where(evaluated, aic, np.inf)
+        aic_sum = masked_correlate(self.unmask(aic * evaluated), self.mask, kernel, factors)[self.mask]
+        incomplete = binary_dilation(self.unmask(~evaluated), structure=support)[self.mask]
+        return np.where(np.logical_and(evaluated, ~incomplete), aic_sum, np.inf)
+
+    @staticmethod
+    def _next_ratios(best, evaluated, golden):
+        # dict ratio index -> masked voxels to evaluate at that ratio in the next round
+        idx = np.arange(evaluated.shape[0])[:, None]
+        left = np.where(np.logical_and(evaluated, idx < best), idx, -1).max(axis=0)
+        right = np.where(np.logical_and(evaluated, idx > best), idx, evaluated.shape[0]).min(axis=0)
+        # no evaluated ratio on one side, the best is at the end of the list
+        left = np.where(left < 0, best, left)
+        right = np.where(right >= evaluated.shape[0], best, right)
+        gap_left = best - left
+        gap_right = right - best
+        go_left = gap_left >= gap_right
+        gap = np.where(go_left, gap_left, gap_right)
+        step = np.maximum(1, np.round(golden * gap)).astype(int)
+        new = np.where(go_left, best - step, best + step)
+        active = gap > 1
+        return {k: np.flatnonzero(np.logical_and(active, new == k)) for k in np.unique(new[active])}
+
+    def unmask(self, masked):
+        # (X, Y, Z, ...) volume of a (Nmask, ...) array, 0 outside of mask
+        vol = np.zeros(self.mask.shape + masked.shape[1:], dtype=masked.dtype)
+        vol[self.mask] = masked
+        return vol
+
+    def close(self):
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
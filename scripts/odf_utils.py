@@ -1,7 +1,13 @@
 import numpy as np
-from fury import actor, window
 
-from dipy.direction.peaks import peak_directions
+from time import time
+from multiprocessing import cpu_count
+
+from dipy.data import get_sphere
+
+from shared_array import SharedArrays, attach_shared_arrays, chunk_bounds, start_pool
+from sphere_utils import sphere_neighbours, sphere_spacing, hemisphere_indices, hemisphere_neighbours, sh_matrix
+from matrix_cache import cached
 
 from scipy.special import erf
 from numpy.lib.scimath import sqrt 
@@ -13,55 +19,457 @@ import numbers
 
 ## PEAKS
 
-def peak_directions_vol(odfs, sphere, relative_peak_threshold=0.25, min_separation_angle=15, mask=None):
+def sphere_local_maxima(sf, neighbours, max_greater=0):
+	# local maxima (>= all neighbours) of a block of sphere functions sf (Nvox, Nvertices)
+	# with max_greater > 0, vertices with up to max_greater strictly greater neighbours are also returned
+	# return the vertex indices and values of the maxima of each voxel sorted by decreasing value,
+	# (Nvox, Nmax) arrays padded with index 0 and value -inf, and the number of maxima per voxel
+	Nvox = sf.shape[0]
+
+	# one neighbour column at a time to keep the temporaries at the size of sf
+	# the comparison is done vertex-major so that gathering the neighbours copies contiguous rows
+	# an ODF containing NaN has no peaks
+	sf_t = np.ascontiguousarray(sf.T)
+	if max_greater == 0:
+		is_max_t = np.repeat(~np.isnan(sf).any(axis=1)[None, :], sf.shape[1], axis=0)
+		for k in range(neighbours.shape[1]):
+			is_max_t &= sf_t >= sf_t[neighbours[:, k]]
+	else:
+		greater = np.zeros(sf_t.shape, dtype=np.uint8)
+		for k in range(neighbours.shape[1]):
+			greater += sf_t < sf_t[neighbours[:, k]]
+		is_max_t = (greater <= max_greater) & ~np.isnan(sf).any(axis=1)[None, :]
+
+	count = is_max_t.sum(axis=0)
+	Nmax = count.max() if Nvox > 0 else 0
+
+	max_vert, max_vox = np.nonzero(is_max_t)
+	max_val = sf_t[max_vert, max_vox]
+	order = np.lexsort((-max_val, max_vox))
+	max_vox = max_vox[order]
+	rank = np.arange(max_vox.shape[0]) - (np.cumsum(count) - count)[max_vox]
+
+	max_ind = np.zeros((Nvox, Nmax), dtype=int)
+	max_values = np.full((Nvox, Nmax), -np.inf)
+	max_ind[max_vox, rank] = max_vert[order]
+	max_values[max_vox, rank] = max_val[order]
+
+	return max_ind, max_values, count
+
+
+def select_peaks(cand_dir, cand_val, cand_ind, valid, odf_min, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10):
+	# dipy's peak selection on candidates sorted by decreasing value, (Nvox, Ncand) arrays
+	# no peak if the largest candidate is negative, relative threshold on (value - max(odf_min, 0))
+	# and greedy removal of peaks closer than min_separation_angle (antipodally symmetric)
+	# return peak_dir (Nvox, Npeaks, 3), peak_val (Nvox, Npeaks), peak_ind (Nvox, Npeaks)
+	Nvox = cand_val.shape[0]
+	peak_dir = np.zeros((Nvox, Npeaks, 3))
+	peak_val = np.zeros((Nvox, Npeaks))
+	peak_ind = np.zeros((Nvox, Npeaks), dtype=int)
+	if Nvox == 0 or cand_val.shape[1] == 0:
+		return peak_dir, peak_val, peak_ind
+
+	keep = valid & (cand_val[:, :1] >= 0)
+
+	# relative threshold, the normalization by (odf_max - odf_min) is skipped like in dipy
+	odf_min = np.clip(odf_min, 0, None)
+	values_norm = cand_val - odf_min[:, None]
+	keep &= values_norm >= relative_peak_threshold * values_norm[:, :1]
+
+	Ncand = keep.sum(axis=1).max()
+	keep = keep[:, :Ncand]
+	cand_dir = cand_dir[:, :Ncand]
+	cand_ind = cand_ind[:, :Ncand]
+	cand_val = cand_val[:, :Ncand]
+
+	# remove peaks too close together, greedily in decreasing value order
+	cos_similarity = np.cos(np.pi / 180. * min_separation_angle)
+	too_close = np.abs(np.einsum('vij,vkj->vik', cand_dir, cand_dir)) > cos_similarity
+	for k in range(1, Ncand):
+		keep[:, k] &= ~np.any(keep[:, :k] & too_close[:, k, :k], axis=1)
+
+	# move the surviving peaks to the front
+	order = np.argsort(~keep, axis=1, kind='stable')[:, :Npeaks]
+	sel = np.take_along_axis(keep, order, axis=1)
+	Nout = order.shape[1]
+	peak_ind[:, :Nout] = np.where(sel, np.take_along_axis(cand_ind, order, axis=1), 0)
+	peak_val[:, :Nout] = np.where(sel, np.take_along_axis(cand_val, order, axis=1), 0)
+	peak_dir[:, :Nout] = np.take_along_axis(cand_dir, order[..., None], axis=1) * sel[..., None]
+
+	return peak_dir, peak_val, peak_ind
+
+
+def peak_directions_sf_block(sf, vertices, neighbours, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10):
+	# Vectorized equivalent of dipy's peak_directions for a block of sphere functions sf (Nvox, Nvertices)
+	# return peak_dir (Nvox, Npeaks, 3), peak_val (Nvox, Npeaks), peak_ind (Nvox, Npeaks), sorted by decreasing value
+	max_ind, max_val, count = sphere_local_maxima(sf, neighbours)
+	valid = np.arange(max_ind.shape[1])[None, :] < count[:, None]
+	odf_min = sf.min(axis=1) if sf.shape[0] > 0 else np.zeros(0)
+	return select_peaks(vertices[max_ind], max_val, max_ind, valid, odf_min, relative_peak_threshold, min_separation_angle, Npeaks)
+
+
+## CONTINUOUS PEAKS
+# The even SH of order <= sh_order span, on the sphere, the same space as the
+# homogeneous polynomials of degree sh_order in (x, y, z), both have (sh_order+1)(sh_order+2)/2 elements.
+# Rewriting the ODF as a polynomial gives cheap exact values, gradients and hessians anywhere on the sphere.
+
+def homogeneous_exponents(degree):
+	# (Nmono, 3) exponents of the monomials x^a y^b z^c with a+b+c = degree
+	return np.array([(a, b, degree-a-b) for a in range(degree+1) for b in range(degree+1-a)]).reshape(-1, 3)
+
+
+def sh_to_poly_matrix(sh_order, sh_func, sphere):
+	# return C (Nmono, Ncoef) such that poly_coef = C.dot(sh_coef) and the monomial exponents (Nmono, 3)
+	# sh_func is real_sh_tournier or real_sh_descoteaux, sphere must have more than Ncoef vertices
+	def build():
+		exps = homogeneous_exponents(sh_order)
+		C = np.linalg.lstsq(monomials(sphere.vertices, exps), sh_matrix(sphere, sh_order, sh_func), rcond=None)[0]
+		return C, exps
+	return cached('sh_to_poly_matrix', build, basis=sh_func.__name__, lmax=sh_order, sphere=sphere)
+
+
+def monomials(x, exps):
+	# (Npts, Nmono) values of the monomials with exponents exps at points x (Npts, 3)
+	# powers are stored (coordinate, exponent, point) so that the gathers copy contiguous rows
+	powers = np.ones((3, max(exps.max(), 0) + 1, x.shape[0]))
+	for k in range(1, powers.shape[1]):
+		powers[:, k] = powers[:, k-1] * x.T
+	return (powers[0, exps[:, 0]] * powers[1, exps[:, 1]] * powers[2, exps[:, 2]]).T
+
+
+def poly_derivative_matrix(exps, axes):
+	# D (Nmono_lower, Nmono) mapping polynomial coefficients to the coefficients of the derivative along axes
+	# (a tuple of coordinate indices, e.g. (0,) for d/dx or (0, 2) for d2/dxdz) and the exponents of the derivative
+	lower_exps = homogeneous_exponents(exps[0].sum() - len(axes))
+	index = dict((tuple(e), i) for i, e in enumerate(lower_exps))
+	D = np.zeros((lower_exps.shape[0], exps.shape[0]))
+	for j, e in enumerate(exps):
+		e = e.copy()
+		factor = 1
+		for ax in axes:
+			factor *= e[ax]
+			e[ax] -= 1
+		if factor != 0:
+			D[index[tuple(e)], j] = factor
+	return D, lower_exps
+
+
+def poly_eval(poly_coef, x, exps):
+	# values (Npts,) of the polynomials with coefficients poly_coef (Npts, Nmono) at unit vectors x (Npts, 3)
+	return (monomials(x, exps) * poly_coef).sum(axis=-1)
+
+
+def refine_peaks_poly(poly_coef, peak_dir, exps, max_step=np.pi/18, max_iter=20, tol=1e-5):
+	# local maximization on the sphere of the polynomials poly_coef (Npts, Nmono) starting at the unit vectors peak_dir (Npts, 3)
+	# Riemannian Newton steps in the tangent plane, with a gradient step when the hessian is not negative definite,
+	# steps are limited to max_step radians and halved until the value increases
+	# return the refined directions (Npts, 3) and values (Npts,)
+	# coefficients of the gradient and hessian polynomials, computed once
+	D1, exps1 = zip(*[poly_derivative_matrix(exps, (i,)) for i in range(3)])
+	hess_axes = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+	D2, exps2 = zip(*[poly_derivative_matrix(exps, axes) for axes in hess_axes])
+	grad_coef = np.einsum('pm,ikm->pik', poly_coef, np.array(D1))
+	hess_coef = np.einsum('pm,ikm->pik', poly_coef, np.array(D2))
+	hess_index = np.array([[0, 3, 4], [3, 1, 5], [4, 5, 2]])
+
+	def evaluate(idx, x):
+		value = poly_eval(poly_coef[idx], x, exps)
+		grad = (monomials(x, exps1[0])[:, None, :] * grad_coef[idx]).sum(axis=-1)
+		hess = (monomials(x, exps2[0])[:, None, :] * hess_coef[idx]).sum(axis=-1)[:, hess_index]
+		return value, grad, hess
+
+	x = peak_dir.copy()
+	value, grad, hess = evaluate(np.arange(x.shape[0]), x)
+	step_scale = np.full(x.shape[0], max_step)
+	active = np.ones(x.shape[0], dtype=bool)
+
+	for it in range(max_iter):
+		idx = np.flatnonzero(active)
+		if idx.shape[0] == 0:
+			break
+		xa = x[idx]
+
+		# orthonormal tangent basis
+		ref = np.zeros_like(xa)
+		ref[np.arange(xa.shape[0]), np.argmin(np.abs(xa), axis=1)] = 1
+		e1 = np.cross(xa, ref)
+		e1 /= np.linalg.norm(e1, axis=1)[:, None]
+		e2 = np.cross(xa, e1)
+		basis = np.stack((e1, e2), axis=1) # (Na, 2, 3)
+
+		# Riemannian gradient and hessian expressed in the tangent basis
+		g = np.einsum('aij,aj->ai', basis, grad[idx])
+		radial = np.einsum('ai,ai->a', xa, grad[idx])
+		h = np.matmul(np.matmul(basis, hess[idx]), basis.transpose(0, 2, 1)) - radial[:, None, None] * np.eye(2)[None]
+
+		det = h[:, 0, 0]*h[:, 1, 1] - h[:, 0, 1]*h[:, 1, 0]
+		concave = (det > 0) & (h[:, 0, 0] < 0)
+		safe_det = np.where(concave, det, 1)
+		newton = -np.stack((h[:, 1, 1]*g[:, 0] - h[:, 0, 1]*g[:, 1], -h[:, 1, 0]*g[:, 0] + h[:, 0, 0]*g[:, 1]), axis=1) / safe_det[:, None]
+		gnorm = np.linalg.norm(g, axis=1)
+		gradient = g / np.where(gnorm > 0, gnorm, 1)[:, None] * step_scale[idx, None]
+		v = np.where(concave[:, None], newton, gradient)
+
+		# limit the step length
+		vnorm = np.linalg.norm(v, axis=1)
+		v *= (np.minimum(vnorm, step_scale[idx]) / np.where(vnorm > 0, vnorm, 1))[:, None]
+		vnorm = np.linalg.norm(v, axis=1)
+
+		x_new = xa + np.einsum('ai,aij->aj', v, basis)
+		x_new /= np.linalg.norm(x_new, axis=1)[:, None]
+		value_new, grad_new, hess_new = evaluate(idx, x_new)
+
+		accept = value_new >= value[idx]
+		acc = idx[accept]
+		x[acc] = x_new[accept]
+		value[acc] = value_new[accept]
+		grad[acc] = grad_new[accept]
+		hess[acc] = hess_new[accept]
+		step_scale[idx[~accept]] *= 0.5
+
+		active[idx] = (vnorm > tol) & (step_scale[idx] > tol)
+
+	return x, value
+
+
+def peak_directions_sh_refined_block(odfs_sh, mat, vertices, neighbours, poly_mat, exps, max_step, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10, sf=None):
+	# Peaks of a block of SH odfs_sh (Nvox, Ncoef) detected on a (coarse) sphere and refined continuously on the SH
+	# On a coarse sphere a peak close to a larger one often has no vertex that is a local maxima,
+	# so the seeds are the vertices with at most one greater neighbour that pass half the relative threshold.
+	# Each seed is moved to the maxima of the polynomial form of the SH (see refine_peaks_poly),
+	# then the relative threshold and separation angle are applied to the refined peaks.
+	# peak_ind is the index of the seed vertex
+	# sf is odfs_sh.dot(mat.T) if the caller already has it
+	if sf is None:
+		sf = odfs_sh.dot(mat.T)
+	seed_ind, seed_val, count = sphere_local_maxima(sf, neighbours, max_greater=1)
+	odf_min = np.clip(sf.min(axis=1), 0, None) if sf.shape[0] > 0 else np.zeros(0)
+	values_norm = seed_val - odf_min[:, None]
+	valid = np.arange(seed_ind.shape[1])[None, :] < count[:, None]
+	valid &= values_norm >= 0.5 * relative_peak_threshold * values_norm[:, :1]
+
+	vox, rank = np.nonzero(valid)
+	poly_coef = odfs_sh.dot(poly_mat.T)
+	refined_dir, refined_val = refine_peaks_poly(poly_coef[vox], vertices[seed_ind[vox, rank]], exps, max_step=max_step)
+
+	cand_dir = np.zeros(seed_ind.shape + (3,))
+	cand_val = np.full(seed_ind.shape, -np.inf)
+	cand_dir[vox, rank] = refined_dir
+	cand_val[vox, rank] = refined_val
+
+	# refinement changes the order, seeds converging to the same peak are removed by the separation angle
+	order = np.argsort(-cand_val, axis=1, kind='stable')
+	cand_dir = np.take_along_axis(cand_dir, order[..., None], axis=1)
+	cand_val = np.take_along_axis(cand_val, order, axis=1)
+	seed_ind = np.take_along_axis(seed_ind, order, axis=1)
+	valid = np.take_along_axis(valid, order, axis=1)
+
+	return select_peaks(cand_dir, cand_val, seed_ind, valid, odf_min, relative_peak_threshold, min_separation_angle, Npeaks)
+
+
+def peak_directions_vol(odfs, sphere, relative_peak_threshold=0.25, min_separation_angle=15, mask=None, block_size=4096):
 	vol_shape = odfs.shape[:-1]
 	if mask is None:
-		mask = np.ones(vol_shape, dtype=np.bool)
+		mask = np.ones(vol_shape, dtype=bool)
 
-	peak_dir = np.zeros(vol_shape + (10,3), dtype=np.float)
-	peak_val = np.zeros(vol_shape + (10,), dtype=np.float)
-	peak_ind = np.zeros(vol_shape + (10,), dtype=np.int)
+	peak_dir = np.zeros(vol_shape + (10,3))
+	peak_val = np.zeros(vol_shape + (10,))
+	peak_ind = np.zeros(vol_shape + (10,), dtype=int)
 
-	for idx in np.ndindex(vol_shape):
-		if mask[idx]:
-			single_odf = odfs[idx]
+	neighbours = sphere_neighbours(sphere)
+	odfs_masked = odfs[mask]
+	dir_masked = np.zeros((odfs_masked.shape[0], 10, 3))
+	val_masked = np.zeros((odfs_masked.shape[0], 10))
+	ind_masked = np.zeros((odfs_masked.shape[0], 10), dtype=int)
 
-			single_peak_dir, single_peak_val, single_peak_ind = peak_directions(single_odf, sphere, relative_peak_threshold, min_separation_angle)
+	for start in range(0, odfs_masked.shape[0], block_size):
+		stop = start + block_size
+		dir_masked[start:stop], val_masked[start:stop], ind_masked[start:stop] = peak_directions_sf_block(odfs_masked[start:stop], sphere.vertices, neighbours, relative_peak_threshold, min_separation_angle, 10)
 
-			peak_dir[idx][:single_peak_dir.shape[0]] = single_peak_dir[:peak_dir.shape[-2]]
-			peak_val[idx][:single_peak_val.shape[0]] = single_peak_val[:peak_val.shape[-2]]
-			peak_ind[idx][:single_peak_ind.shape[0]] = single_peak_ind[:peak_ind.shape[-2]]
+	peak_dir[mask] = dir_masked
+	peak_val[mask] = val_masked
+	peak_ind[mask] = ind_masked
 
 	return peak_dir, peak_val, peak_ind
 
 
-def peak_directions_sh_vol(odfs_sh, mat, sphere, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10, mask=None):
+def peak_directions_sh_vol(odfs_sh, mat, sphere, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10, mask=None, block_size=4096, nbr_processes=1):
+	# mat is the (Nvertices, Ncoef) SH to SF matrix on sphere
+	# the SF of each block of masked voxels is computed with a single matrix product
 	vol_shape = odfs_sh.shape[:-1]
 	if mask is None:
-		mask = np.ones(vol_shape, dtype=np.bool)
+		mask = np.ones(vol_shape, dtype=bool)
 
-	peak_dir = np.zeros(vol_shape + (Npeaks,3), dtype=np.float)
-	peak_val = np.zeros(vol_shape + (Npeaks,), dtype=np.float)
-	peak_ind = np.zeros(vol_shape + (Npeaks,), dtype=np.int)
+	with PeakExtractor(mat, sphere, mask, odfs_sh.shape[-1], relative_peak_threshold=relative_peak_threshold, min_separation_angle=min_separation_angle, Npeaks=Npeaks, block_size=block_size, nbr_processes=nbr_processes) as extractor:
+		peak_dir, peak_val, peak_ind = extractor(odfs_sh[mask])
+		peak_dir, peak_val, peak_ind = peak_dir.copy(), peak_val.copy(), peak_ind.copy()
 
-	for idx in np.ndindex(vol_shape):
-		if mask[idx]:
-			single_odf = mat.dot(odfs_sh[idx])
+	return peak_dir, peak_val, peak_ind
 
-			single_peak_dir, single_peak_val, single_peak_ind = peak_directions(single_odf, sphere, relative_peak_threshold, min_separation_angle)
 
-			peak_dir[idx][:single_peak_dir.shape[0]] = single_peak_dir[:peak_dir.shape[-2]]
-			peak_val[idx][:single_peak_val.shape[0]] = single_peak_val[:peak_val.shape[-1]]
-			peak_ind[idx][:single_peak_ind.shape[0]] = single_peak_ind[:peak_ind.shape[-1]]
-
-	return peak_dir, peak_val, peak_ind
+# state of the peak extraction workers, set by the pool initializer
+_peak_worker = {}
+
+def _init_peak_worker(specs, mat, vertices, vertex_index, neighbours, relative_peak_threshold, min_separation_angle, Npeaks, block_size, refine, normalize=False):
+	_peak_worker['arrays'] = attach_shared_arrays(specs)
+	_peak_worker['params'] = (mat, vertices, vertex_index, neighbours, relative_peak_threshold, min_separation_angle, Npeaks, block_size, refine, normalize)
+
+
+def _peak_chunk(bounds):
+	# extract the peaks of the masked voxels [start, stop) and write them in the output volumes
+	start, stop = bounds
+	chunk_start_time = time()
+	arrays = _peak_worker['arrays']
+	mat, vertices, vertex_index, neighbours, relative_peak_threshold, min_separation_angle, Npeaks, block_size, refine, normalize = _peak_worker['params']
+
+	for block_start in range(start, stop, block_size):
+		block_stop = min(block_start + block_size, stop)
+		vox = arrays['voxels'][block_start:block_stop]
+		sh = arrays['sh'][block_start:block_stop]
+		sf = sh.dot(mat.T)
+		if refine is None:
+			peaks = peak_directions_sf_block(sf, vertices, neighbours, relative_peak_threshold, min_separation_angle, Npeaks)
+		else:
+			poly_mat, exps, max_step = refine
+			peaks = peak_directions_sh_refined_block(sh, mat, vertices, neighbours, poly_mat, exps, max_step, relative_peak_threshold, min_separation_angle, Npeaks, sf=sf)
+		arrays['dir'][vox], arrays['val'][vox] = peaks[:2]
+		arrays['ind'][vox] = vertex_index[peaks[2]]
+		if normalize:
+			# max normalization from the same SF, the refined first peak can only be higher
+			sf_maximum = sf.max(axis=1) if sf.shape[0] > 0 else np.zeros(0)
+			if refine is not None:
+				sf_maximum = np.maximum(sf_maximum, peaks[1][:, 0])
+			with np.errstate(divide='ignore', invalid='ignore'):
+				sh /= sf_maximum[:, None]
+			sh[~np.isfinite(sh)] = 0
+
+	return start, stop, time() - chunk_start_time
+
+
+class PeakExtractor(object):
+	# Persistent peak extraction over the voxels of a mask
+	# The masked SH, the voxel indices and the output peak volumes live in shared memory,
+	# the workers get (start, stop) chunks of masked voxels and write their peaks in place.
+	# Calling the extractor with a (Nmask, Ncoef) SH array returns the (dir, val, ind) volumes,
+	# they are views of the shared buffers and are overwritten by the next call.
+	# With sh_func (real_sh_tournier or real_sh_descoteaux), the maxima found on sphere are refined on the SH
+	# (see peak_directions_sh_refined_block), a coarse sphere like repulsion100 is then enough.
+	# By default peak_dir, peak_val and peak_ind are those of dipy's peak_directions on the full sphere.
+	# With hemisphere, on an antipodally symmetric sphere the SH are only evaluated on a hemisphere (see sphere_utils),
+	# the peaks are the same axes but are reported on the vertex of the antipodal pair with the lowest index,
+	# while dipy reports the vertex with the largest value (which of the two is decided by rounding errors).
+	# With normalize, the shared SH are also divided in place by the max of the same SF (as sh_odf_normalize),
+	# normalized_sh() returns them after each call.
+	# With pool (a shared_array.WorkerPool), its processes are used instead of a pool of its own.
+
+	def __init__(self, mat, sphere, mask, Ncoef, relative_peak_threshold=0.25, min_separation_angle=15, Npeaks=10, block_size=4096, nbr_processes=1, chunks_per_process=4, verbose=False, sh_func=None, normalize=False, hemisphere=False, pool=None):
+		self.mask = mask
+		self.normalize = normalize
+		self.verbose = verbose
+		Nvox = int(mask.sum())
+		self.nbr_processes = max(1, min(nbr_processes, cpu_count()))
+
+		self.shared = SharedArrays()
+		self.shared.create('sh', (Nvox, Ncoef))
+		self.mask_voxels = np.flatnonzero(mask)
+		self.shared.share('voxels', self.mask_voxels)
+		self.all_voxels = True
+		Ngrid = mask.size
+		self.shared.create('dir', (Ngrid, Npeaks, 3))
+		self.shared.create('val', (Ngrid, Npeaks))
+		self.shared.create('ind', (Ngrid, Npeaks), dtype=int)
+
+		# chunks of at least one block, several per process for load balancing
+		self.block_size = block_size
+		self.chunks_per_process = chunks_per_process
+		self.Nloaded = Nvox
+		self.chunks = self._chunks(Nvox)
+
+		if sh_func is None:
+			refine = None
+		else:
+			sh_order = int(np.round((np.sqrt(8*Ncoef + 1) - 3) / 2))
+			poly_mat, exps = sh_to_poly_matrix(sh_order, sh_func, sphere if sphere.vertices.shape[0] > 2*Ncoef else get_sphere('repulsion724'))
+			refine = (poly_mat, exps, sphere_spacing(sphere))
+
+		hemi_idx, full_to_hemi = hemisphere_indices(sphere) if hemisphere else (None, None)
+		if hemi_idx is None:
+			params = (mat, sphere.vertices, np.arange(sphere.vertices.shape[0]), sphere_neighbours(sphere))
+		else:
+			params = (mat[hemi_idx], sphere.vertices[hemi_idx], hemi_idx, hemisphere_neighbours(sphere, hemi_idx, full_to_hemi))
+		params += (relative_peak_threshold, min_separation_angle, Npeaks, block_size, refine, normalize)
+		self.pool, self.own_pool = start_pool(self.shared, _init_peak_worker, params, self.nbr_processes, pool)
+
+	def _chunks(self, Nvox):
+		Nchunk = max(1, min(self.nbr_processes * self.chunks_per_process, int(np.ceil(Nvox / float(self.block_size)))))
+		return chunk_bounds(Nvox, Nchunk)
+
+	def __call__(self, odfs_sh_masked, voxels=None):
+		# voxels are the indices in the masked voxels of the rows of odfs_sh_masked (default all of them),
+		# only the peaks of those voxels are updated in the returned volumes
+		Nvox = odfs_sh_masked.shape[0]
+		self.shared['sh'][:Nvox] = odfs_sh_masked
+		if voxels is None:
+			if Nvox != self.mask_voxels.shape[0]:
+				raise ValueError('Need the voxels of a subset of the masked voxels')
+			if not self.all_voxels:
+				self.shared['voxels'][...] = self.mask_voxels
+				self.all_voxels = True
+		else:
+			self.shared['voxels'][:Nvox] = self.mask_voxels[voxels]
+			self.all_voxels = False
+		if Nvox != self.Nloaded:
+			self.Nloaded = Nvox
+			self.chunks = self._chunks(Nvox)
+
+		start_time = time()
+		if self.pool is None:
+			results = map(_peak_chunk, self.chunks)
+		else:
+			results = self.pool.imap_unordered(_peak_chunk, self.chunks)
+		for i, (start, stop, elapsed) in enumerate(results):
+			if self.verbose:
+				print('Chunk {:} / {:}: {:} voxels in {:.2f} s ({:.0f} voxels/s)'.format(i+1, len(self.chunks), stop - start, elapsed, (stop - start) / max(elapsed, 1e-9)))
+		elapsed = time() - start_time
+		if self.verbose:
+			print('{:} voxels in {:.2f} s ({:.0f} voxels/s, {:} processes)'.format(Nvox, elapsed, Nvox / max(elapsed, 1e-9), self.nbr_processes))
+
+		vol_shape = self.mask.shape
+		Npeaks = self.shared['val'].shape[1]
+		return (self.shared['dir'].reshape(vol_shape + (Npeaks, 3)),
+				self.shared['val'].reshape(vol_shape + (Npeaks,)),
+				self.shared['ind'].reshape(vol_shape + (Npeaks,)))
+
+	def normalized_sh(self):
+		# (Nmask, Ncoef) max normalized SH of the last call, a view of the shared buffer
+		if not self.normalize:
+			raise ValueError('PeakExtractor built without normalize')
+		return self.shared['sh'][:self.Nloaded]
+
+	def close(self):
+		if self.own_pool:
+			self.pool.close()
+			self.pool.join()
+		elif self.pool is None:
+			_peak_worker.clear()
+		self.pool = None
+		self.own_pool = False
+		self.shared.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
 
 
 
 
 ## VIZ
+# fury is only imported by the plotting functions, the processing scripts run without it
 
 def plot_single_sf(sf, sphere):
+	from fury import actor, window
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
 	affine = np.eye(4)
@@ -73,6 +481,7 @@ def plot_single_sf(sf, sphere):
 
 def plot_sf(sf, sphere):
 	# sf has shape (X,Y,Nsphere)
+	from fury import actor, window
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
 	affine = np.eye(4)
@@ -84,6 +493,7 @@ def plot_sf(sf, sphere):
 
 def plot_single_peaks(peaks_dir, peaks_val):
 	# peaks_dir has shape (Npeaks, 3)
+	from fury import actor, window
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
 	affine = np.eye(4)
@@ -96,6 +506,7 @@ def plot_single_peaks(peaks_dir, peaks_val):
 
 def plot_peaks(peaks_dir, peaks_val):
 	# peaks_dir has shape (X, Y, Npeaks, 3)
+	from fury import actor, window
 	mask = np.ones((peaks_dir.shape[0], peaks_dir.shape[1],1), dtype=np.bool)
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
@@ -109,6 +520,7 @@ def plot_peaks(peaks_dir, peaks_val):
 
 def plot_single_peaks_and_odf(peaks_dir, peaks_val, sf, sphere):
 	# peaks_dir has shape (Npeaks, 3)
+	from fury import actor, window
 	mask = np.ones((1,1,1), dtype=np.bool)
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
@@ -123,6 +535,7 @@ def plot_single_peaks_and_odf(peaks_dir, peaks_val, sf, sphere):
 
 
 def plot_peaks_and_odf(peaks_dir, peaks_val, sf, sphere):
+	from fury import actor, window
 	mask = np.ones((peaks_dir.shape[0], peaks_dir.shape[1],1), dtype=np.bool)
 	ren = window.Scene()
 	ren.SetBackground(1, 1, 1)
@@ -173,7 +586,7 @@ def Dperp_from_param(MD, ratio):
 def D_Delta_from_param(MD, ratio):
 	Dpar = Dpar_from_param(MD, ratio)
 	Dperp = Dperp_from_param(MD, ratio)
-	return (Dpar-Dperp)/float(Dpar+2*Dperp)
+	return (Dpar-Dperp)/np.float64(Dpar+2*Dperp)
 
 def gfunc(alpha):
 	# return sp.sqrt(np.pi/(4*alpha)) * erf(sp.sqrt(alpha))
@@ -190,9 +603,17 @@ def SM_from_param(b, MD, ratio):
 
 
 ## build "dico"
+# the SM(MD) table is evaluated on the whole MD grid at once
+# and cached (see matrix_cache), the same (meanbval, ratio) is only computed once
+def true_MD_table(meanbval, ratio, minMD, maxMD, N_MD=1000):
+	def build():
+		MDs = np.linspace(minMD, maxMD, N_MD)
+		return SM_from_param(meanbval, MDs, ratio), MDs
+	return cached('true_MD_table', build, bvals=meanbval, ratio=ratio, minMD=minMD, maxMD=maxMD, N_MD=N_MD)
+
 def true_MD_func(meanbval, ratio, minMD, maxMD, N_MD=1000):
-	MDs = np.linspace(minMD, maxMD, N_MD)
-	SMs = np.array([SM_from_param(meanbval, MD, ratio) for MD in MDs])
+	# vectorized, call it on the spherical means of all voxels at once
+	SMs, MDs = true_MD_table(float(meanbval), float(ratio), float(minMD), float(maxMD), int(N_MD))
 	return interp1d(SMs, MDs, bounds_error=False, fill_value=(minMD, maxMD))
 
 
@@ -14,26 +14,59 @@ import numpy as np
 from dipy.data import get_sphere
 from dipy.reconst.shm import real_sh_tournier, real_sh_descoteaux, order_from_ncoef
 
-from odf_utils import peak_directions_sh_vol
+from odf_utils import PeakExtractor
+from peak_store import save_peaks
+from sphere_utils import sh_matrix
 
 
 def _build_args_parser():
     p = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-    p.add_argument('input', metavar='input',
+    p.add_argument('input', metavar='input', nargs='?',
                    help='Path of the input odf SH volume.')
-    p.add_argument('outputnufo', metavar='outputnufo',
+    p.add_argument('outputnufo', metavar='outputnufo', nargs='?',
                    help='Path of the output nufo volume.')
-    p.add_argument('outputdir', metavar='outputdir',
+    p.add_argument('outputdir', metavar='outputdir', nargs='?',
                    help='Path of the output normalized peaks orientation.')
-    p.add_argument('outputlen', metavar='outputlen',
+    p.add_argument('outputlen', metavar='outputlen', nargs='?',
                    help='Path of the output absolute peak lenght.')
+    p.add_argument('--iodf', dest='iodf', metavar='iodf', type=str, nargs='+', default=[],
+                    help='Multi-input mode: paths of the input odf SH volumes (e.g. one per sharpening ratio),\n'
+                         'processed after the positional input if one is given. The mask, sphere, SH matrix\n'
+                         'and worker pool are set up once for all the inputs.')
+    p.add_argument('--onufo', dest='onufo', metavar='onufo', type=str, nargs='+', default=[],
+                    help='Multi-input mode: paths of the output nufo volumes, one per --iodf.')
+    p.add_argument('--odir', dest='odir', metavar='odir', type=str, nargs='+', default=[],
+                    help='Multi-input mode: paths of the output peaks orientation, one per --iodf.')
+    p.add_argument('--olen', dest='olen', metavar='olen', type=str, nargs='+', default=[],
+                    help='Multi-input mode: paths of the output peak lenght, one per --iodf.')
+    p.add_argument('--onorm', dest='onorm', metavar='onorm', type=str, nargs='+', default=[],
+                    help='Optional: paths of the output max-normalized SH, one per input (positional and --iodf).\n'
+                         'The max is taken on the SF evaluated for the peak extraction, replacing\n'
+                         'a separate sh_odf_normalize.py run on the same input.')
+    p.add_argument('--opeaks', dest='opeaks', metavar='opeaks', type=str, nargs='+', default=[],
+                    help='Optional: paths of the output sparse peak files, one per input (positional and --iodf).\n'
+                         'Only the peaks of the masked voxels are kept (see peak_store.py), as int16 indices\n'
+                         'on --sphere or float32 directions with --refine. The nufo, dir and len outputs are then\n'
+                         'optional, peaks_to_nifti.py converts back to them.')
     p.add_argument('--relth', dest='relth', metavar='relth', type=float, default=0.25,
                     help='Relative threshold for peak extraction.')
     p.add_argument('--minsep', dest='minsep', metavar='minsep', type=float, default=15,
                     help='Minimum separation angle in degree for peak extraction.')
     p.add_argument('--maxn', dest='maxn', metavar='maxn', type=int, default=10,
                     help='Maximum number of peak extracted per ODF.')
+    p.add_argument('--sphere', dest='sphere', metavar='sphere', type=str, default='repulsion724',
+                    help='Name of the dipy sphere on which the odf are sampled for peak detection.')
+    p.add_argument('--refine', dest='refine', action='store_true',
+                    help='Refine each peak found on the sphere directly on the SH expansion.\n'
+                         'Gives sub-vertex peak directions, so a coarse sphere (e.g. --sphere repulsion100)\n'
+                         'can be used to cut the SH to SF cost.')
+    p.add_argument('--hemisphere', dest='hemisphere', action='store_true',
+                    help='Evaluate the ODFs on one vertex of each antipodal pair only (half the SH to SF cost).\n'
+                         'The peaks are the same axes, but a peak can be reported as its antipodal vertex\n'
+                         '(opposite direction and index) of the one of the full sphere search.')
+    p.add_argument('--cores', dest='cores', metavar='cores', type=int, default=1,
+                    help='Number of processes, the masked voxels are split in chunks shared between them.')
     p.add_argument(
         '--mask', dest='mask', metavar='mask',
         help='Path to a binary mask.\nOnly data inside the mask will be used '
@@ -45,14 +78,45 @@ def main():
     parser = _build_args_parser()
     args = parser.parse_args()
 
-    odf_fname = args.input
-    nufo_fname = args.outputnufo
-    dir_fname = args.outputdir
-    len_fname = args.outputlen
+    peak_fnames = args.opeaks
+    if args.input is not None:
+        outputs = (args.outputnufo, args.outputdir, args.outputlen)
+        if None in outputs and (len(peak_fnames) == 0 or any(fname is not None for fname in outputs)):
+            print('Need the 3 output names')
+            return None
+        odf_fnames = [args.input] + args.iodf
+        if None in outputs:
+            nufo_fnames, dir_fnames, len_fnames = args.onufo, args.odir, args.olen
+        else:
+            nufo_fnames = [args.outputnufo] + args.onufo
+            dir_fnames = [args.outputdir] + args.odir
+            len_fnames = [args.outputlen] + args.olen
+    else:
+        odf_fnames = args.iodf
+        nufo_fnames = args.onufo
+        dir_fnames = args.odir
+        len_fnames = args.olen
+
+    if len(odf_fnames) == 0:
+        print('Need input name(s)')
+        return None
+    # the dense outputs can be left out when the sparse ones are written
+    dense = len(nufo_fnames) > 0 or len(dir_fnames) > 0 or len(len_fnames) > 0 or len(peak_fnames) == 0
+    if dense and not (len(odf_fnames) == len(nufo_fnames) == len(dir_fnames) == len(len_fnames)):
+        print('Need one nufo, dir and len output per input')
+        return None
+    if len(peak_fnames) not in (0, len(odf_fnames)):
+        print('Need one sparse peak output per input')
+        return None
+    norm_fnames = args.onorm
+    if len(norm_fnames) not in (0, len(odf_fnames)):
+        print('Need one normalized output per input')
+        return None
+    normalize = len(norm_fnames) > 0
 
     N_peaks = args.maxn
     sh_basis = 'tournier07'
-    sphere_name = 'repulsion724'
+    sphere_name = args.sphere
     relative_peak_threshold = args.relth
     min_separation_angle = args.minsep
 
@@ -60,6 +124,7 @@ def main():
     print('max N_peaks = {}'.format(N_peaks))
     print('relative_peak_threshold = {}'.format(relative_peak_threshold))
     print('min_separation_angle = {} deg'.format(min_separation_angle))
+    print('sphere = {}{}'.format(sphere_name, ' (with SH refinement)' if args.refine else ''))
 
     if sh_basis == 'tournier07':
         sh_func = real_sh_tournier
@@ -71,39 +136,62 @@ def main():
 
 
 
-    odf_img = nib.load(odf_fname)
-    odf_sh = odf_img.get_fdata()
+    # everything not depending on the input values is set up once
+    odf_img = nib.load(odf_fnames[0])
+    vol_shape = odf_img.shape
     affine = odf_img.affine
 
+    # every input must have the shape of the first, checked before any work
+    # so that no output is left missing
+    for odf_fname in odf_fnames[1:]:
+        if nib.load(odf_fname).shape != vol_shape:
+            parser.error('{:} has shape {:}, expected {:}'.format(odf_fname, nib.load(odf_fname).shape, vol_shape))
+
     if args.mask is None:
-        mask = np.ones(odf_sh.shape[:3]).astype(np.bool)
+        mask = np.ones(vol_shape[:3], dtype=bool)
     else:
-        mask = nib.load(args.mask).get_fdata().astype(np.bool)
+        mask = nib.load(args.mask).get_fdata().astype(bool)
 
 
 
-    lmax = int(order_from_ncoef(odf_sh.shape[-1], full_basis=False))
+    lmax = int(order_from_ncoef(vol_shape[-1], full_basis=False))
     sphere = get_sphere(sphere_name)
-    B, m, n = sh_func(lmax, sphere.theta, sphere.phi)
-
-
-
-    start_time = time()
-    peak_dir, peak_val, peak_ind = peak_directions_sh_vol(odf_sh, B, sphere, relative_peak_threshold=relative_peak_threshold, min_separation_angle=min_separation_angle, Npeaks=N_peaks, mask=mask)
-    end_time = time()
-    print('Elapsed time = {:.2f} s'.format(end_time - start_time))
-
-
-
-    nufo = (peak_val>0).sum(axis=3)
-    peak_orientation = peak_dir
-    peak_lenght = peak_val
-
-    nib.Nifti1Image(nufo, affine).to_filename(nufo_fname)
-    nib.Nifti1Image(peak_orientation, affine).to_filename(dir_fname)
-    nib.Nifti1Image(peak_lenght, affine).to_filename(len_fname)
-
-
+    B = sh_matrix(sphere, lmax, sh_func)
+
+
+
+    with PeakExtractor(B, sphere, mask, vol_shape[-1], relative_peak_threshold=relative_peak_threshold, min_separation_angle=min_separation_angle, Npeaks=N_peaks, nbr_processes=args.cores, verbose=True, sh_func=sh_func if args.refine else None, normalize=normalize, hemisphere=args.hemisphere) as extractor:
+        for i, odf_fname in enumerate(odf_fnames):
+            print('Extracting peaks from {}'.format(odf_fname))
+            odf_sh = nib.load(odf_fname).get_fdata()
+
+            start_time = time()
+            peak_dir, peak_val, peak_ind = extractor(odf_sh[mask])
+            end_time = time()
+            print('Elapsed time = {:.2f} s'.format(end_time - start_time))
+            del odf_sh
+
+            if dense:
+                nufo = (peak_val>0).sum(axis=3)
+                peak_orientation = peak_dir
+                peak_lenght = peak_val
+
+                nib.Nifti1Image(nufo, affine).to_filename(nufo_fnames[i])
+                nib.Nifti1Image(peak_orientation, affine).to_filename(dir_fnames[i])
+                nib.Nifti1Image(peak_lenght, affine).to_filename(len_fnames[i])
+                del nufo, peak_orientation, peak_lenght
+            if len(peak_fnames) > 0:
+                # the refined peaks are off the sphere vertices
+                if args.refine:
+                    save_peaks(peak_fnames[i], peak_dir, peak_val, mask, affine)
+                else:
+                    save_peaks(peak_fnames[i], peak_dir, peak_val, mask, affine, peak_ind=peak_ind, sphere=sphere_name)
+            if normalize:
+                odf_norm = np.zeros(vol_shape)
+                odf_norm[mask] = extractor.normalized_sh()
+                nib.Nifti1Image(odf_norm, affine).to_filename(norm_fnames[i])
+                del odf_norm
+            del peak_dir, peak_val, peak_ind
 
 
 if __name__ == "__main__":
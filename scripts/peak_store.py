@@ -0,0 +1,142 @@
+import numpy as np
+
+from dipy.data import get_sphere
+
+
+# Sparse (fixel-like) storage of the peaks of peak_extraction.py.
+# The dense NIfTI layout keeps Npeaks (10) float64 directions and lengths in
+# every voxel of the grid, while most of the grid is background and most
+# voxels have 1 to 3 peaks. The store keeps, in a single compressed .npz:
+#   shape, affine      the grid
+#   mask               the masked voxels, np.packbits of the flat (C order) mask
+#   count (Nmask,)     number of peaks of each masked voxel (uint8)
+#   len (Npk,)         float32 peak lengths, the peaks of the voxels one after
+#                      the other in voxel order, by decreasing length
+#   dir (Npk, 3)       float32 unit vectors
+#   or ind (Npk,)      int16 vertex indices and sphere, the name of the dipy
+#                      sphere, when the peaks are sphere vertices (no SH refinement)
+#   max_peaks          Npeaks of the dense layout
+# Loading inflates a few small arrays instead of the whole dense grid.
+
+PEAK_STORE_VERSION = 2
+
+
+def save_peaks(fname, peak_dir, peak_len, mask, affine, peak_ind=None, sphere=None):
+    """Write the peaks (X, Y, Z, Npeaks, 3) and (X, Y, Z, Npeaks) of the masked voxels to fname.
+    With peak_ind (X, Y, Z, Npeaks) and sphere, the name of the dipy sphere of the indices,
+    int16 vertex indices are kept instead of the directions.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    lens = peak_len[mask]
+    present = lens > 0
+    arrays = {'version': np.array(PEAK_STORE_VERSION),
+              'shape': np.array(mask.shape, dtype=np.int64),
+              'affine': np.asarray(affine, dtype=np.float64),
+              'mask': np.packbits(mask.ravel()),
+              'count': present.sum(axis=1).astype(np.uint8),
+              'len': lens[present].astype(np.float32),
+              'max_peaks': np.array(lens.shape[1])}
+    if peak_ind is None:
+        arrays['dir'] = peak_dir[mask][present].astype(np.float32)
+    else:
+        if get_sphere(name=sphere).vertices.shape[0] > np.iinfo(np.int16).max:
+            raise ValueError('Too many sphere vertices for int16 indices')
+        arrays['ind'] = peak_ind[mask][present].astype(np.int16)
+        arrays['sphere'] = np.array(sphere)
+    with open(fname, 'wb') as f:
+        # through a file object, np.savez_compressed would add .npz to the name
+        np.savez_compressed(f, **arrays)
+
+
+def peak_store_shape(fname):
+    """(X, Y, Z) grid of a file of save_peaks, without loading the peaks."""
+    with np.load(fname, allow_pickle=False) as npz:
+        return tuple(int(s) for s in npz['shape'])
+
+
+class PeakStore(object):
+    """Peaks of the masked voxels of a grid, read from a file of save_peaks."""
+
+    def __init__(self, fname):
+        with np.load(fname, allow_pickle=False) as npz:
+            if int(npz['version']) != PEAK_STORE_VERSION:
+                raise ValueError('Unknown peak store version {:} in {:}'.format(int(npz['version']), fname))
+            self.shape = tuple(int(s) for s in npz['shape'])
+            self.affine = npz['affine']
+            # flat offsets of the masked voxels, increasing
+            self.voxels = np.flatnonzero(np.unpackbits(npz['mask'], count=int(np.prod(self.shape))))
+            self.count = npz['count']
+            self.len = npz['len']
+            self.max_peaks = int(npz['max_peaks'])
+            if 'ind' in npz.files:
+                self.ind = npz['ind']
+                self.sphere = str(npz['sphere'])
+                self.vertices = get_sphere(name=self.sphere).vertices
+                self.dir = None
+            else:
+                self.ind = None
+                self.sphere = None
+                self.vertices = None
+                self.dir = npz['dir']
+        # first peak of each stored voxel
+        self.start = np.cumsum(self.count, dtype=np.int64) - self.count
+
+    def directions(self):
+        """(Npk, 3) float32 unit vectors of all the stored peaks."""
+        if self.dir is None:
+            return self.vertices[self.ind].astype(np.float32)
+        return self.dir
+
+    def mask(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.voxels] = True
+        return mask
+
+    def fill(self, mask, peak_dir, peak_len):
+        """Write the peaks of the voxels of mask (same grid) in peak_dir (Nmask, Npeaks, 3) and peak_len (Nmask, Npeaks),
+        e.g. shared buffers. Voxels without stored peaks get none, voxels with more than Npeaks keep the Npeaks largest.
+        """
+        if tuple(mask.shape) != self.shape:
+            raise ValueError('Mask shape {:} differs from the peak grid {:}'.format(mask.shape, self.shape))
+        Npeaks = peak_len.shape[1]
+        peak_dir[...] = 0
+        peak_len[...] = 0
+
+        # position of each voxel of mask in the stored voxels
+        query = np.flatnonzero(mask)
+        pos = np.searchsorted(self.voxels, query)
+        pos[pos == self.voxels.shape[0]] = 0
+        found = self.voxels[pos] == query if self.voxels.shape[0] > 0 else np.zeros(query.shape, dtype=bool)
+        rows = np.flatnonzero(found)
+        pos = pos[found]
+
+        # one (row, rank, stored peak) triplet per copied peak
+        count = np.minimum(self.count[pos], Npeaks).astype(np.int64)
+        rows = np.repeat(rows, count)
+        rank = np.arange(rows.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+        src = np.repeat(self.start[pos], count) + rank
+        peak_len[rows, rank] = self.len[src]
+        if self.dir is None:
+            peak_dir[rows, rank] = self.vertices[self.ind[src]]
+        else:
+            peak_dir[rows, rank] = self.dir[src]
+        return peak_dir, peak_len
+
+    def masked(self, mask, Npeaks=None):
+        """(Nmask, Npeaks, 3) and (Nmask, Npeaks) float64 peaks of the voxels of mask."""
+        Npeaks = self.max_peaks if Npeaks is None else Npeaks
+        Nmask = int(mask.sum())
+        return self.fill(mask, np.zeros((Nmask, Npeaks, 3)), np.zeros((Nmask, Npeaks)))
+
+    def to_dense(self, Npeaks=None):
+        """nufo (X, Y, Z), dir (X, Y, Z, Npeaks, 3) and len (X, Y, Z, Npeaks) float64 volumes of peak_extraction.py."""
+        Npeaks = self.max_peaks if Npeaks is None else Npeaks
+        mask = self.mask()
+        peak_dir, peak_len = self.masked(mask, Npeaks)
+        nufo = np.zeros(self.shape, dtype=int)
+        dirs = np.zeros(self.shape + (Npeaks, 3))
+        lens = np.zeros(self.shape + (Npeaks,))
+        nufo[mask] = (peak_len > 0).sum(axis=1)
+        dirs[mask] = peak_dir
+        lens[mask] = peak_len
+        return nufo, dirs, lens
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import nibabel as nib
+
+from peak_store import PeakStore
+
+
+DESCRIPTION = """
+Convert a sparse peak file (peak_extraction.py --opeaks) to the nufo, dir and len NIfTI volumes
+of peak_extraction.py.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+    p.add_argument('peaks', type=str,
+                            help='Name of the input sparse peak file')
+    p.add_argument('nufo', type=str,
+                            help='Name of the output nufo nii file')
+    p.add_argument('dir', type=str,
+                            help='Name of the output peak orientations nii file')
+    p.add_argument('len', type=str,
+                            help='Name of the output peak lenghts nii file')
+    p.add_argument('--maxn', type=int,
+                            help='Optional: Number of peaks of the output (default: --maxn of the peak extraction)')
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    store = PeakStore(args.peaks)
+    nufo, peak_dir, peak_len = store.to_dense(args.maxn)
+
+    nib.Nifti1Image(nufo, store.affine).to_filename(args.nufo)
+    nib.Nifti1Image(peak_dir, store.affine).to_filename(args.dir)
+    nib.Nifti1Image(peak_len, store.affine).to_filename(args.len)
+
+
+if __name__ == "__main__":
+    main()
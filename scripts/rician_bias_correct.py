@@ -7,6 +7,8 @@ import numpy as np
 import os
 import pylab as plt
 
+from nifti_stream import iter_volumes, NiftiVolumeWriter
+
 
 DESCRIPTION =   'Removal of Rician Bias with simple method of moments. Cornelius Eichner 2020'
 
@@ -25,6 +27,9 @@ def buildArgsParser():
     p.add_argument('--axes', dest='axes', action='store', type=str,
                             help='Correct Sigma along which axes (e.g., 0,2)')
 
+    p.add_argument('--stream', dest='stream', action='store_true',
+                            help='Debias in float32 one volume at a time, each volume is written as soon as it is debiased')
+
     return p
 
 
@@ -42,9 +47,15 @@ def main():
 
     # Load input file and sigma
     print('Loading Input Data {}'.format(PATH_IN))
-    data = nib.load(PATH_IN).get_fdata().astype(np.float)
-    aff = nib.load(PATH_IN).affine
-    dims = data.shape
+    img = nib.load(PATH_IN)
+    aff = img.affine
+    if args.stream:
+        # the volumes are only read while debiasing
+        data = None
+        dims = img.shape
+    else:
+        data = img.get_fdata().astype(np.float64)
+        dims = data.shape
 
     print('Data Dimensions {}'.format(dims))
     
@@ -56,14 +67,32 @@ def main():
 
     # sigma_array = np.repeat(sigma[np.newaxis, :, np.newaxis], np.array(dims[0], dims[2]), axis=(0,2))
     # repeats_array = np.tile(np.tile(sigma, (2, 1)), (3,2) )
-    sigma_array = np.repeat(np.repeat(sigma[: , np.newaxis], dims[AXES[0]], axis=1)[... , np.newaxis], dims[AXES[1]], axis = 2)
-    sigma_array = np.swapaxes(sigma_array, 0,1)
+    # sigma_array = np.repeat(np.repeat(sigma[: , np.newaxis], dims[AXES[0]], axis=1)[... , np.newaxis], dims[AXES[1]], axis = 2)
+    # sigma_array = np.swapaxes(sigma_array, 0,1)
+    # the profile is along the axis not in AXES, repeated along AXES by a read-only broadcast view
+    broadcast_idx = [None]*3
+    for i in set([0,1,2]).difference(set(AXES)):
+        broadcast_idx[i] = slice(0, None)
+    sigma_array = np.broadcast_to(sigma[tuple(broadcast_idx)], dims[:3])
 
     print("Debiasing Data")
-    data_debias = np.sqrt(np.abs(data**2 - sigma_array[..., None]**2))
-
-    data_debias[np.isnan(np.abs(data_debias))] = 0
-    data_debias[np.isinf(np.abs(data_debias))] = 0
+    if args.stream:
+        # a single 3D bias, then each volume is read, debiased and written in turn
+        bias = (sigma_array**2).astype(np.float32)
+        with NiftiVolumeWriter(PATH_OUT, dims, aff) as writer:
+            for t, volume in iter_volumes(PATH_IN):
+                volume_debias = np.sqrt(np.abs(volume**2 - bias))
+                volume_debias[~np.isfinite(volume_debias)] = 0
+                writer.write(volume_debias)
+                # the plots only show the first volume
+                if t == 0:
+                    data, data_debias = volume[..., None], volume_debias[..., None]
+        print("Debiased Data Saved")
+    else:
+        data_debias = np.sqrt(np.abs(data**2 - sigma_array[..., None]**2))
+
+        data_debias[np.isnan(np.abs(data_debias))] = 0
+        data_debias[np.isinf(np.abs(data_debias))] = 0
 
     data_vmin = 0
     data_vmax = np.percentile(data[...,0], 95)
@@ -126,8 +155,9 @@ def main():
     plt.show()
 
 
-    print("Saving Debiased Data")
-    nib.nifti1.Nifti1Image(data_debias.astype(np.float32), aff).to_filename(PATH_OUT)
+    if not args.stream:
+        print("Saving Debiased Data")
+        nib.nifti1.Nifti1Image(data_debias.astype(np.float32), aff).to_filename(PATH_OUT)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import argparse
+import os
+
+from time import time
+
+import nibabel as nib
+import numpy as np
+
+from dipy.data import get_sphere
+from dipy.io import read_bvals_bvecs
+from dipy.core.gradients import gradient_table
+from dipy.reconst.shm import real_sh_tournier, calculate_max_order
+
+from odf_engine import ODFEngine
+from odf_utils import PeakExtractor
+from combine_utils import neighbourhood_kernel, best_idx_labels
+from sphere_utils import sh_matrix
+from matrix_cache import default_cache
+
+
+DESCRIPTION = """
+CSA fit, sharpening, peak extraction, AIC and best ratio selection in a single process.
+The dwi, sigma and CSA coefficients stay in memory and the ratios are streamed one at a time,
+only the running best AIC, ratio and ODF are kept. The per-ratio sharpened ODFs, peaks and AIC
+are only written with --intermediates, with the names used by 14_diff_run_odf.sh.
+The adaptive search evaluates each voxel at a few ratios only (see ODFEngine.search).
+Optionally extracts the peaks of the best ODF and max-normalizes it (see peak_extraction.py).
+"""
+
+
+class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
+    pass
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=CustomFormatter)
+    p.add_argument('--data', type=str, required=True,
+                             help='Path of the normalized dwi.')
+    p.add_argument('--bval', type=str, required=True,
+                             help='Path of the bval (AIC).')
+    p.add_argument('--bval_csa', type=str,
+                             help='Optional: Path of the rounded bval for the CSA fit (default --bval).')
+    p.add_argument('--bvec', type=str, required=True,
+                             help='Path of the bvec.')
+    p.add_argument('--mask', type=str, required=True,
+                             help='Path of the mask.')
+    p.add_argument('--sigma', type=str, required=True,
+                             help='Path of the normalized sigma map.')
+    p.add_argument('--ratios', type=str, nargs='+', required=True,
+                             help='Sharpening ratios, in the order of the selection.')
+
+    p.add_argument('--oodf', type=str, required=True,
+                             help='Path of the output best ODFs.')
+    p.add_argument('--oaic', type=str, required=True,
+                             help='Path of the output best AICs.')
+    p.add_argument('--oratio', type=str, required=True,
+                             help='Path of the output best ratios.')
+    p.add_argument('--oidx', type=str,
+                             help='Optional: Path of the output uint8 label map of the best ratio\n(1 + index in --ratios, 0 outside of mask).')
+    p.add_argument('--ocsa', type=str,
+                             help='Optional: Path of the output CSA ODFs.')
+    p.add_argument('--intermediates', type=str,
+                             help='Optional: Folder of the per-ratio outputs\n(sharpen_ratios/, peaks_ratios/ and aic_ratios/).')
+
+    p.add_argument('--onufo', type=str,
+                             help='Optional: Path of the output nufo of the best ODFs.')
+    p.add_argument('--odir', type=str,
+                             help='Optional: Path of the output peak orientations of the best ODFs.')
+    p.add_argument('--olen', type=str,
+                             help='Optional: Path of the output peak lenghts of the best ODFs.')
+    p.add_argument('--onorm', type=str,
+                             help='Optional: Path of the output max-normalized best ODFs.')
+
+    p.add_argument('--shmax', type=int, default=6,
+                             help='CSA spherical harmonic maximum order.')
+    p.add_argument('--csa_tau', type=float, default=1e-5,
+                             help='CSA minimal signal cutoff.')
+    p.add_argument('--csa_lambda', type=float, default=0.006,
+                             help='CSA laplace-beltrami regularization weight.')
+    p.add_argument('--tau', type=float, default=0.1,
+                             help='Sharpening tau.')
+    p.add_argument('--lambda', dest='lambda_', type=float, default=1.,
+                             help='Sharpening lambda.')
+    p.add_argument('--relth', type=float, default=0.25,
+                             help='Relative threshold for peak extraction.')
+    p.add_argument('--minsep', type=float, default=25,
+                             help='Minimum separation angle in degree for peak extraction.')
+    p.add_argument('--maxn', type=int, default=10,
+                             help='Maximum number of peak extracted per ODF.')
+    p.add_argument('--search', type=str, default='exhaustive', choices=['exhaustive', 'adaptive'],
+                             help='exhaustive: every voxel at every ratio.\n'
+                                  'adaptive: every voxel at --coarse ratios, then golden section bracketing\n'
+                                  'over the ratio list around the best ratio of each voxel (unimodal AIC).')
+    p.add_argument('--coarse', type=int, default=3,
+                             help='Number of ratios evaluated in every voxel by the adaptive search.')
+    p.add_argument('--compare', action='store_true',
+                             help='With --search adaptive, also run the exhaustive search and report\n'
+                                  'the voxels ending up at a different ratio.')
+    p.add_argument('--voxelwise', action='store_true',
+                             help='Pick the lowest AIC of each voxel instead of the lowest neighborhood AIC.')
+    p.add_argument('--kernel_size', type=int, default=3,
+                             help='Size (odd) in voxels of the neighborhood kernel.')
+    p.add_argument('--kernel_width', type=float, default=0.5,
+                             help='Width of the neighborhood kernel.')
+    p.add_argument('--kernel_shape', type=str, default='exponential', choices=['exponential', 'gaussian'],
+                             help='exponential: exp(-1/2 (r^2/width)^(1/2)), gaussian: exp(-1/2 r^2/width) (separable).')
+    p.add_argument('--cores', type=int, default=1,
+                             help='Number of processes, the sharpening, peak and AIC steps run one after\n'
+                                  'the other on the same worker processes.')
+    p.add_argument('--cache_stats', action='store_true',
+                             help='Print the hits and misses of the matrix cache at the end (see matrix_cache.py).')
+    return p
+
+
+def load_gtab(bval_fname, bvec_fname):
+    bvals, bvecs = read_bvals_bvecs(bval_fname, bvec_fname)
+    # fix flips
+    bvecs[:, 0] *= -1
+    return gradient_table(bvals, bvecs)
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.kernel_size % 2 == 0:
+        parser.error('--kernel_size must be odd')
+    if args.search == 'adaptive' and args.intermediates is not None:
+        parser.error('--intermediates needs the exhaustive search')
+    peak_outputs = (args.onufo, args.odir, args.olen)
+    if any(fname is not None for fname in peak_outputs) and None in peak_outputs:
+        parser.error('--onufo, --odir and --olen go together')
+
+    # the ratios are kept as given for the intermediate file names
+    ratio_names = args.ratios
+    ratios = [float(ratio) for ratio in ratio_names]
+
+    print('Load data')
+    data_img = nib.load(args.data)
+    data = data_img.get_fdata()
+    affine = data_img.affine
+    mask = nib.load(args.mask).get_fdata().astype(bool)
+    sigma = nib.load(args.sigma).get_fdata()
+
+    gtab = load_gtab(args.bval, args.bvec)
+    gtab_csa = None if args.bval_csa is None else load_gtab(args.bval_csa, args.bvec)
+
+    engine = ODFEngine(data, mask, sigma, gtab, gtab_csa=gtab_csa, sh_order=args.shmax, csa_tau=args.csa_tau, csa_lambda=args.csa_lambda,
+                       sharpen_tau=args.tau, sharpen_lambda=args.lambda_, r2_term=True,
+                       relative_peak_threshold=args.relth, min_separation_angle=args.minsep, Npeaks=args.maxn,
+                       nbr_processes=args.cores)
+    del data, sigma
+
+    print('Fit CSA odf')
+    engine.fit_csa()
+    if args.ocsa is not None:
+        nib.Nifti1Image(engine.unmask(engine.csa), affine).to_filename(args.ocsa)
+
+    callback = None
+    if args.intermediates is not None:
+        for folder in ('sharpen_ratios', 'peaks_ratios', 'aic_ratios'):
+            os.makedirs(os.path.join(args.intermediates, folder), exist_ok=True)
+
+        def callback(i, ratio, fodf, peak_dir, peak_len, aic):
+            name = 'csa_sharp_r{:}.nii.gz'.format(ratio_names[i])
+            nib.Nifti1Image(engine.unmask(fodf), affine).to_filename(os.path.join(args.intermediates, 'sharpen_ratios', name))
+            nib.Nifti1Image(engine.unmask((peak_len>0).sum(axis=1)), affine).to_filename(os.path.join(args.intermediates, 'peaks_ratios', 'nufo_' + name))
+            nib.Nifti1Image(engine.unmask(peak_dir), affine).to_filename(os.path.join(args.intermediates, 'peaks_ratios', 'dir_' + name))
+            nib.Nifti1Image(engine.unmask(peak_len), affine).to_filename(os.path.join(args.intermediates, 'peaks_ratios', 'len_' + name))
+            nib.Nifti1Image(engine.unmask(aic), affine).to_filename(os.path.join(args.intermediates, 'aic_ratios', 'aic_' + name))
+
+    if args.voxelwise:
+        kernel, factors = None, None
+    else:
+        kernel, factors = neighbourhood_kernel(args.kernel_size, args.kernel_width, args.kernel_shape)
+
+    start_time = time()
+    if args.search == 'adaptive':
+        (best_aic, best_ratio, best_idx, best_odf), Nevals = engine.search(ratios, kernel, factors, coarse=args.coarse)
+    else:
+        best_aic, best_ratio, best_idx, best_odf = engine.select(ratios, kernel, factors, callback=callback)
+    print('Elapsed time (all ratios) = {:.2f} s'.format(time() - start_time))
+
+    if args.search == 'adaptive':
+        Nvox = mask.sum()
+        print('Adaptive search: {:} voxel evaluations for {:} voxels ({:.2f} ratios per voxel, x{:.2f} less than all {:} ratios)'.format(
+              Nevals, Nvox, Nevals / Nvox, len(ratios) * Nvox / Nevals, len(ratios)))
+        if args.compare:
+            print('Exhaustive search for comparison')
+            start_time = time()
+            full_idx = engine.select(ratios, kernel, factors)[2]
+            print('Elapsed time (all ratios) = {:.2f} s'.format(time() - start_time))
+            diff = np.abs(best_idx[mask] - full_idx[mask])
+            print('{:} voxels ({:.2f} %) at a different ratio than the exhaustive search'.format((diff > 0).sum(), 100 * np.mean(diff > 0)))
+            for step in np.unique(diff[diff > 0]):
+                print('    {:} voxels {:} ratio(s) away'.format((diff == step).sum(), step))
+
+    # release the shared buffers of the engine, engine.unmask only needs the mask
+    engine.close()
+
+    nib.Nifti1Image(best_aic, affine).to_filename(args.oaic)
+    nib.Nifti1Image(best_ratio, affine).to_filename(args.oratio)
+    nib.Nifti1Image(best_odf, affine).to_filename(args.oodf)
+    if args.oidx is not None:
+        nib.Nifti1Image(best_idx_labels(best_idx, mask), affine).to_filename(args.oidx)
+
+    if args.onufo is not None or args.onorm is not None:
+        print('Extracting peaks from best AIC ODFs')
+        sphere = get_sphere(name='repulsion724')
+        B = sh_matrix(sphere, calculate_max_order(best_odf.shape[3], full_basis=False), real_sh_tournier)
+        normalize = args.onorm is not None
+        with PeakExtractor(B, sphere, mask, best_odf.shape[3], relative_peak_threshold=args.relth, min_separation_angle=args.minsep, Npeaks=args.maxn, nbr_processes=args.cores, normalize=normalize) as extractor:
+            peak_dir, peak_val, _ = extractor(best_odf[mask])
+            if args.onufo is not None:
+                nib.Nifti1Image((peak_val>0).sum(axis=3), affine).to_filename(args.onufo)
+                nib.Nifti1Image(peak_dir, affine).to_filename(args.odir)
+                nib.Nifti1Image(peak_val, affine).to_filename(args.olen)
+            if normalize:
+                nib.Nifti1Image(engine.unmask(extractor.normalized_sh()), affine).to_filename(args.onorm)
+
+    if args.cache_stats:
+        print(default_cache())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,136 @@
+import argparse
 import numpy as np
 import nibabel as nib
 from time import time
 
+from multiprocessing import cpu_count
+
 from dipy.data import get_sphere
 from dipy.reconst.shm import real_sh_tournier
 from dipy.reconst.shm import calculate_max_order
 
+from sphere_utils import hemisphere_sh_matrix, sphere_spacing
+from odf_utils import sh_to_poly_matrix, refine_peaks_poly
+from shared_array import SharedArrays, attach_shared_arrays, chunk_bounds, shared_map
+from crop_utils import GridCrop
+
+
+DESCRIPTION = """
+Normalize SH ODFs by their maximum (tournier07 basis).
+The maximum is taken in float32 on the masked voxels only, by chunks over several cores,
+optionally refined on the SH around the best vertex.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+    p.add_argument('sh_fname', type=str,
+                            help='Name of the input SH nii file')
+    p.add_argument('sh_norm_fname', type=str,
+                            help='Name of the max-normalized output SH nii file')
+    p.add_argument('--mask', type=str,
+                            help='Optional: Name of mask nii file (default: voxels with non-zero SH)')
+    p.add_argument('--cores', type=int, default=1,
+                            help='Number of processes')
+    p.add_argument('--refine', action='store_true',
+                            help='Refine the maximum on the SH around the best vertex')
+    p.add_argument('--chunk', type=int, default=4096,
+                            help='Number of voxels evaluated at once')
+    p.add_argument('--crop', action='store_true',
+                            help='Only load the bounding box of --mask')
+    return p
+
+
+_norm_worker = {}
+
+
+def _init_norm_worker(specs, B, refine, block_size):
+    _norm_worker['arrays'] = attach_shared_arrays(specs)
+    _norm_worker['params'] = (B, refine, block_size)
+
+
+def _norm_chunk(bounds):
+    # divide the masked SH [start, stop) by their maximum, in place
+    chunk_start_time = time()
+    sh = _norm_worker['arrays']['sh']
+    B, refine, block_size = _norm_worker['params']
+    for start in range(bounds[0], bounds[1], block_size):
+        stop = min(start + block_size, bounds[1])
+        sf = sh[start:stop].astype(np.float32).dot(B.T)
+        sf_maximum = sf.max(axis=1).astype(np.float64)
+        if refine is not None:
+            poly_mat, exps, vertices, max_step = refine
+            _, refined = refine_peaks_poly(sh[start:stop].dot(poly_mat.T), vertices[np.argmax(sf, axis=1)], exps, max_step=max_step)
+            sf_maximum = np.maximum(sf_maximum, refined)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sh[start:stop] /= sf_maximum[:, None]
+        sh[start:stop][~np.isfinite(sh[start:stop])] = 0
+    return bounds[0], bounds[1], time() - chunk_start_time
+
+
+def sh_max_normalize(sh, mask, sphere, nbr_processes=1, refine=False, block_size=4096, chunks_per_process=4):
+    # normalize sh (X, Y, Z, Ncoef) in place by the max of the SF on sphere
+    # the even order SH are antipodally symmetric, the max on half of the sphere is the max
+    lmax = calculate_max_order(sh.shape[3], full_basis=False)
+    B, hemi_idx = hemisphere_sh_matrix(sphere, lmax, real_sh_tournier)
+    B = B.astype(np.float32)
+    refine_params = None
+    if refine:
+        poly_mat, exps = sh_to_poly_matrix(lmax, real_sh_tournier, sphere)
+        refine_params = (poly_mat, exps, sphere.vertices[hemi_idx], sphere_spacing(sphere))
+
+    nbr_processes = max(1, min(nbr_processes, cpu_count()))
+    with SharedArrays() as shared:
+        shared.share('sh', sh[mask])
+        Nvox = shared['sh'].shape[0]
+        chunks = chunk_bounds(Nvox, min(nbr_processes * chunks_per_process, int(np.ceil(Nvox / float(block_size)))))
+        start_time = time()
+        for i, (start, stop, elapsed) in enumerate(shared_map(_norm_chunk, chunks, shared, _init_norm_worker, (B, refine_params, block_size), nbr_processes=nbr_processes)):
+            print('Chunk {:} / {:}: {:} voxels in {:.2f} s ({:.0f} voxels/s)'.format(i+1, len(chunks), stop - start, elapsed, (stop - start) / max(elapsed, 1e-9)))
+        elapsed = time() - start_time
+        print('{:} voxels in {:.2f} s ({:.0f} voxels/s, {:} processes)'.format(Nvox, elapsed, Nvox / max(elapsed, 1e-9), nbr_processes))
+        _norm_worker.clear()
+
+        sh[mask] = shared['sh']
+        sh[~mask] = 0
+    return sh
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.crop and args.mask is None:
+        parser.error('--crop needs --mask')
+
+    sh_img = nib.load(args.sh_fname)
+    affine = sh_img.affine
 
-def main(sh_fname, sh_norm_fname):
+    if args.mask is not None:
+        mask = nib.load(args.mask).get_fdata().astype(bool)
 
-    sh_img = nib.load(sh_fname)
-    sh = sh_img.get_fdata()
-    affine = sh_img.affine
+    if args.crop:
+        crop = GridCrop.from_mask(mask, affine)
+        print(crop)
+    else:
+        crop = GridCrop.full(sh_img.shape, affine)
+    sh = crop.load(args.sh_fname)
 
-    lmax = calculate_max_order(sh.shape[3], False)
+    if args.mask is None:
+        mask = np.any(sh != 0, axis=3)
+    else:
+        mask = crop.crop(mask)
 
     sphere = get_sphere('repulsion724')
     # sphere = get_sphere('repulsion100')
-    B, m, n = real_sh_tournier(lmax, sphere.theta, sphere.phi)
-
-
-    sf_maximum = np.zeros(sh.shape[:3])
 
     start_time = time()
-    for Z in range(sh.shape[2]):
-        print('Processing Z slice {:} / {:}'.format(Z, sh.shape[2]))
-
-        tmp = sh[:,:,Z,:].dot(B.T)
-        sf_maximum[:,:,Z] = tmp.max(axis=2)
-
-
-    sh_maxnorm = sh / sf_maximum[:,:,:,None]
-    sh_maxnorm[np.isnan(sh_maxnorm)] = 0
-    sh_maxnorm[np.isinf(sh_maxnorm)] = 0
-
+    sh_max_normalize(sh, mask, sphere, nbr_processes=args.cores, refine=args.refine, block_size=args.chunk)
     end_time = time()
     print('Elapsed time (sh normalization) = {:.2f} s'.format(end_time - start_time))
 
-    nib.Nifti1Image(sh_maxnorm, affine).to_filename(sh_norm_fname)
+    crop.save(sh, args.sh_norm_fname)
 
 
 if __name__ == "__main__":
-    import sys
-    main(*sys.argv[1:])
-
-
+    main()
@@ -0,0 +1,190 @@
+import numpy as np
+from multiprocessing import shared_memory, Pool
+
+
+# Numpy arrays backed by multiprocessing.shared_memory blocks.
+# The parent process owns the blocks (SharedArrays) and hands the specs
+# (name, shape, dtype) to the pool initializer, the workers attach to
+# the same memory (attach_shared_arrays) and read/write slices in place.
+# Nothing but the specs and the slice bounds is ever pickled.
+
+
+class SharedArrays(object):
+    """Registry of shared memory arrays owned by the calling process.
+    Use as a context manager, the blocks are unlinked on exit.
+    """
+
+    def __init__(self):
+        self._blocks = {}
+        self._arrays = {}
+
+    def create(self, key, shape, dtype=np.float64):
+        """Allocate a zero-filled shared array under key."""
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array[...] = 0
+        self._blocks[key] = shm
+        self._arrays[key] = array
+        return array
+
+    def share(self, key, array):
+        """Copy array into a new shared array under key."""
+        shared = self.create(key, array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def __getitem__(self, key):
+        return self._arrays[key]
+
+    def arrays(self):
+        """Dict key -> ndarray, accepted by attach_shared_arrays in place of the specs."""
+        return dict(self._arrays)
+
+    def specs(self):
+        """Picklable description of the arrays for attach_shared_arrays."""
+        return {key: (self._blocks[key].name, array.shape, array.dtype.str)
+                for key, array in self._arrays.items()}
+
+    def close(self):
+        # drop the numpy views first, the buffer can't be closed while exported
+        self._arrays = {}
+        for shm in self._blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                # views still held by the caller, the mapping is
+                # released when they are garbage collected
+                pass
+            shm.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# keep the worker side SharedMemory objects alive as long as the process
+_attached_blocks = []
+
+
+def attach_shared_arrays(specs):
+    """Attach to the arrays described by SharedArrays.specs().
+    Returns a dict key -> ndarray viewing the shared memory.
+    Arrays given in place of specs (single process runs) are returned as is.
+    """
+    arrays = {}
+    for key, spec in specs.items():
+        if isinstance(spec, np.ndarray):
+            arrays[key] = spec
+            continue
+        name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        _attached_blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return arrays
+
+
+def chunk_bounds(Nitems, Nchunks):
+    """(start, stop) of at most Nchunks contiguous non-empty chunks covering range(Nitems)."""
+    edges = np.linspace(0, Nitems, max(1, Nchunks) + 1).astype(int)
+    return [(edges[i], edges[i+1]) for i in range(len(edges) - 1) if edges[i+1] > edges[i]]
+
+
+def _run_initializers(initializers):
+    for initializer, initargs in initializers:
+        initializer(*initargs)
+
+
+class WorkerPool(object):
+    """Worker processes shared by several persistent pools (SharedPool, SDTSharpener,
+    PeakExtractor) that run one after the other, instead of one set of processes each.
+    Each user registers its initializer before the first task (add_initializer),
+    the processes are started on the first task and run all of them.
+    The users don't close it, use it as a context manager around them.
+    """
+
+    def __init__(self, nbr_processes):
+        self.nbr_processes = nbr_processes
+        self.initializers = []
+        self.pool = None
+
+    def add_initializer(self, initializer, initargs=()):
+        if self.pool is not None:
+            raise ValueError('The worker processes are already started')
+        self.initializers.append((initializer, tuple(initargs)))
+
+    def imap_unordered(self, func, tasks):
+        if self.pool is None:
+            self.pool = Pool(processes=self.nbr_processes, initializer=_run_initializers, initargs=(self.initializers,))
+        return self.pool.imap_unordered(func, tasks)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.initializers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def start_pool(shared, initializer, initargs, nbr_processes, pool=None):
+    """Pool for the initializer over shared, None with a single process (initialized in
+    the calling process on the arrays themselves), or the WorkerPool pool if given.
+    Returns the pool and whether the caller owns it.
+    """
+    if nbr_processes <= 1:
+        initializer(shared.arrays(), *initargs)
+        return None, False
+    if pool is None:
+        return Pool(processes=nbr_processes, initializer=initializer, initargs=(shared.specs(),) + tuple(initargs)), True
+    pool.add_initializer(initializer, (shared.specs(),) + tuple(initargs))
+    return pool, False
+
+
+class SharedPool(object):
+    """Persistent worker pool over the arrays of a SharedArrays.
+    initializer(specs, *initargs) is called once per worker, it should
+    attach_shared_arrays(specs) and keep them in a module global read by the
+    task functions. With a single process everything runs in the calling
+    process on the arrays themselves. With pool (a WorkerPool), its processes
+    are used. Use as a context manager.
+    """
+
+    def __init__(self, shared, initializer, initargs=(), nbr_processes=1, pool=None):
+        self.pool, self.own_pool = start_pool(shared, initializer, initargs, nbr_processes, pool)
+
+    def map(self, func, tasks):
+        """Results of func over tasks, in completion order."""
+        if self.pool is None:
+            return [func(task) for task in tasks]
+        return list(self.pool.imap_unordered(func, tasks))
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+        self.own_pool = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def shared_map(func, chunks, shared, initializer, initargs=(), nbr_processes=1):
+    """Run func over chunks with a one-off SharedPool.
+    Returns the list of func results in completion order.
+    """
+    with SharedPool(shared, initializer, initargs, nbr_processes) as pool:
+        return pool.map(func, chunks)
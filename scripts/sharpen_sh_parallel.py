@@ -10,7 +10,7 @@ from dipy.reconst.csdeconv import odf_sh_to_sharp
 from dipy.reconst.shm import calculate_max_order
 
 from shconv import convert_sh_basis
-from _sharpen_parallel import odf_sh_to_sharp_parallel
+from _sharpen_parallel import SDTSharpener
 
 
 DESCRIPTION =   """
@@ -23,14 +23,14 @@ def buildArgsParser():
     p.add_argument('--in', dest='sh_fname', action='store', type=str,
                             help='Name of the input nii file')
 
-    p.add_argument('--out', dest='sh_sharp_fname', action='store', type=str,
-                            help='Name of the sharpened output nii file')
+    p.add_argument('--out', dest='sh_sharp_fname', action='store', type=str, nargs='+',
+                            help='Name of the sharpened output nii file, one per ratio')
 
     p.add_argument('--mask', dest='mask', action='store', type=str,
                             help='Optional: Name of mask nii file')
 
-    p.add_argument('--ratio', dest='ratio', action='store', type=float, default = 2., 
-                            help='ratio of ODF sharpening')
+    p.add_argument('--ratio', dest='ratio', action='store', type=float, nargs='+', default = [2.], 
+                            help='ratio(s) of ODF sharpening, the input, mask and worker pool are shared by all ratios')
     
     p.add_argument('--tau', dest='tau', action='store', type=float, default = 0.1, 
                             help='Sharpening with tau')
@@ -71,7 +71,9 @@ def main():
 
 
     # sharpend CSD model
-    ratio_csd_sharp = args.ratio
+    ratios_csd_sharp = args.ratio
+    if len(ratios_csd_sharp) != len(args.sh_sharp_fname):
+        parser.error('--out needs one file per --ratio')
 
     tau_csd_sharp = args.tau # default = 0.1
     lambda_csd_sharp = args.lambda_ # default = 1
@@ -79,24 +81,29 @@ def main():
     solid_angle_norm = args.csa_norm # default True
     # solid_angle_norm = False # qball
 
-    print('Sharpening with ratio = {:}'.format(ratio_csd_sharp))
+    print('Sharpening with ratios = {:}'.format(ratios_csd_sharp))
     print('Sharpening with tau = {:}'.format(tau_csd_sharp))
     print('Sharpening with lambda_ = {:}'.format(lambda_csd_sharp))
     print('Sharpening with lmax = {:}'.format(sh_order_sharp))
     print('Sharpening with r2_term = {:}'.format(solid_angle_norm))
 
-    start_time = time()
-    sh_csd_sharp = odf_sh_to_sharp_parallel(sh, reg_sphere, mask=mask, basis='tournier07', ratio=1/ratio_csd_sharp, sh_order=sh_order_sharp, lambda_=lambda_csd_sharp, tau=tau_csd_sharp, r2_term=solid_angle_norm, maxprocess=NCORE)
-    end_time = time()
-    print('Elapsed time = {:.2f} s'.format(end_time - start_time))
-
-
-
-    # start_time = time()
-    # tournier_sh_enh = convert_sh_basis(sh_coef_enh, sphere_conv, input_basis='descoteaux07', nbr_processes=NCORE)
-    nib.Nifti1Image(sh_csd_sharp, affine).to_filename(args.sh_sharp_fname)
-    # end_time = time()
-    # print('Conversion to MRTRIX sh ({} cores) = {:.2f} s'.format(NCORE, end_time - start_time))
+    with SDTSharpener(reg_sphere, mask, sh.shape[3], basis='tournier07', sh_order=sh_order_sharp, lambda_=lambda_csd_sharp, tau=tau_csd_sharp, r2_term=solid_angle_norm, nbr_processes=NCORE) as sharpener:
+        sharpener.load(sh[mask])
+        del sh
+
+        for ratio_csd_sharp, sh_sharp_fname in zip(ratios_csd_sharp, args.sh_sharp_fname):
+            print('Ratio {:}'.format(ratio_csd_sharp))
+            start_time = time()
+            sh_csd_sharp = sharpener(1/ratio_csd_sharp)
+            end_time = time()
+            print('Elapsed time = {:.2f} s'.format(end_time - start_time))
+
+            # start_time = time()
+            # tournier_sh_enh = convert_sh_basis(sh_coef_enh, sphere_conv, input_basis='descoteaux07', nbr_processes=NCORE)
+            nib.Nifti1Image(sh_csd_sharp, affine).to_filename(sh_sharp_fname)
+            # end_time = time()
+            # print('Conversion to MRTRIX sh ({} cores) = {:.2f} s'.format(NCORE, end_time - start_time))
+            del sh_csd_sharp
 
 
 if __name__ == "__main__":
@@ -1,23 +1,40 @@
+import warnings
+
 import numpy as np
-import itertools
-import multiprocessing
 from dipy.reconst.shm import sh_to_sf_matrix, order_from_ncoef
 
-def convert_sh_basis_parallel(args):
-    sh = args[0]
-    B_in = args[1]
-    invB_out = args[2]
-    chunk_id = args[3]
+from matrix_cache import cached
 
-    for idx in range(sh.shape[0]):
-        if sh[idx].any():
-            sf = np.dot(sh[idx], B_in)
-            sh[idx] = np.dot(sf, invB_out)
+def sh_basis_conversion_matrix(sh_order, sphere, input_basis='descoteaux07'):
+    """Linear map (Ncoef, Ncoef) from input_basis to the other basis,
+    converted = shm_coeff.dot(M), through the SF on sphere.
+    """
+    output_basis = 'descoteaux07' if input_basis == 'tournier07' else 'tournier07'
+
+    def build():
+        B_in, _ = sh_to_sf_matrix(sphere, sh_order_max=sh_order, basis_type=input_basis)
+        _, invB_out = sh_to_sf_matrix(sphere, sh_order_max=sh_order, basis_type=output_basis)
+        return np.dot(B_in, invB_out)
+    return cached('sh_basis_conversion_matrix', build, basis=input_basis, lmax=sh_order, sphere=sphere)
+
+
+def scaled_permutation(M, tol=1e-6):
+    """(perm, scale) such that shm_coeff.dot(M) == shm_coeff[..., perm] * scale,
+    None if M has more than one non-zero per column.
+    Between descoteaux07 and tournier07 the coefficients are only reordered
+    (m -> -m) and rescaled (sqrt(2) for m != 0).
+    """
+    nonzero = np.abs(M) > tol * np.abs(M).max()
+    if np.any(nonzero.sum(axis=0) != 1):
+        return None
+    perm = np.argmax(nonzero, axis=0)
+    scale = M[perm, np.arange(M.shape[1])]
+    return perm, scale
 
-    return chunk_id, sh
 
 def convert_sh_basis(shm_coeff, sphere, mask=None,
-                     input_basis='descoteaux07', nbr_processes=None):
+                     input_basis='descoteaux07', nbr_processes=None,
+                     inplace=False, block_size=65536):
     """Converts spherical harmonic coefficients between two bases
     Parameters
     ----------
@@ -33,53 +50,46 @@ def convert_sh_basis(shm_coeff, sphere, mask=None,
         `descoteaux07` or `tournier07`.
         Default: `descoteaux07`
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        Deprecated and ignored, a DeprecationWarning is raised when given.
+        The conversion is a single linear map applied in the calling process.
+    inplace : bool, optional
+        Write the converted coefficients in `shm_coeff`, which must be
+        C contiguous (ValueError otherwise), and return it, voxels
+        outside of `mask` are left untouched.
+        Default: False
+    block_size : int, optional
+        Number of voxels converted at once.
     Returns
     -------
     shm_coeff_array : np.ndarray
         Spherical harmonic coefficients in the desired basis.
     """
-    output_basis = 'descoteaux07' if input_basis == 'tournier07' else 'tournier07'
+    if nbr_processes is not None:
+        warnings.warn('convert_sh_basis ignores nbr_processes, the argument will be removed',
+                      DeprecationWarning, stacklevel=2)
+    # the flat view of a non contiguous array is a copy, the result would be lost
+    if inplace and not shm_coeff.flags.c_contiguous:
+        raise ValueError('inplace conversion needs a C contiguous shm_coeff')
 
     sh_order = order_from_ncoef(shm_coeff.shape[-1])
-    B_in, _ = sh_to_sf_matrix(sphere, sh_order, input_basis)
-    _, invB_out = sh_to_sf_matrix(sphere, sh_order, output_basis)
+    M = sh_basis_conversion_matrix(sh_order, sphere, input_basis)
+    table = scaled_permutation(M)
 
     data_shape = shm_coeff.shape
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    nbr_processes = multiprocessing.cpu_count() if nbr_processes is None \
-        or nbr_processes < 0 else nbr_processes
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels. Then separate it in chunks of len(nbr_processes).
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-    shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-    chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-
-    pool = multiprocessing.Pool(nbr_processes)
-    results = pool.map(convert_sh_basis_parallel,
-                       zip(shm_coeff_chunks,
-                           itertools.repeat(B_in),
-                           itertools.repeat(invB_out),
-                           np.arange(len(shm_coeff_chunks))))
-    pool.close()
-    pool.join()
-
-    # Re-assemble the chunk together in the original shape.
-    shm_coeff_array = np.zeros(data_shape)
-    tmp_shm_coeff_array = np.zeros((np.count_nonzero(mask), data_shape[3]))
-    for i, new_shm_coeff in results:
-        tmp_shm_coeff_array[chunk_len[i]:chunk_len[i+1], :] = new_shm_coeff
-
-    shm_coeff_array[mask] = tmp_shm_coeff_array
+    # masked voxels as a list of 1D coefficient vectors, converted by blocks
+    # to bound the temporaries, with the permutation table or a single GEMM
+    shm_coeff_array = shm_coeff if inplace else np.zeros(data_shape)
+    coeff_flat = shm_coeff.reshape((-1, data_shape[3]))
+    out_flat = shm_coeff_array.reshape((-1, data_shape[3]))
+    voxels = np.flatnonzero(mask)
+    for start in range(0, voxels.shape[0], block_size):
+        vox = voxels[start:start+block_size]
+        if table is None:
+            out_flat[vox] = np.dot(coeff_flat[vox], M)
+        else:
+            out_flat[vox] = coeff_flat[vox][:, table[0]] * table[1]
 
     return shm_coeff_array
-
-
-
-
-
@@ -8,6 +8,8 @@ import dipy.reconst.dti as dti
 import nibabel as nib
 import numpy as np
 import pylab as pl
+
+from crop_utils import GridCrop
 # from scilpy.utils.bvec_bval_tools import (normalize_bvecs, is_normalized_bvecs)
 
 
@@ -35,6 +37,7 @@ def _build_args_parser():
     group.add_argument('--last', metavar='last', type=int, help='Number of non-b0 volume to include starting from the end.')
 
     p.add_argument('--mask', metavar='mask', help='Path of the brain mask for normalization.')
+    p.add_argument('--crop', action='store_true', help='Only load and correct the bounding box of --mask, 0 outside of it.')
 
     return p
 
@@ -43,10 +46,28 @@ def main():
     parser = _build_args_parser()
     args = parser.parse_args()
 
+    if args.crop and args.mask is None:
+        parser.error('--crop needs --mask')
+
     print('LOADING DATA')
     # load data
     img = nib.load(args.data)
-    data = img.get_fdata()
+    if args.mask is None:
+        mask = np.ones(img.shape[:3], dtype=bool)
+    else:
+        mask = nib.load(args.mask).get_fdata().astype(bool)
+
+    totalVoxel = np.prod(mask.shape)
+    voxelInMask = mask.sum()
+    print('{} voxels out of {} inside mask ({:.1f}%)'.format(voxelInMask, totalVoxel, 100*voxelInMask/totalVoxel))
+
+    if args.crop:
+        crop = GridCrop.from_mask(mask, img.affine)
+        print(crop)
+    else:
+        crop = GridCrop.full(img.shape, img.affine)
+    data = crop.load(args.data)
+    mask = crop.crop(mask)
 
     # load bval bvec
     bval, bvec = read_bvals_bvecs(args.bval, args.bvec)
@@ -57,7 +78,7 @@ def main():
 
     # build include index
     if args.index is None:
-        index = np.zeros(bval.shape[0], dtype=np.bool)
+        index = np.zeros(bval.shape[0], dtype=bool)
         # include the last args.last non-b0
         N = args.last
         # list of non-zero index
@@ -66,21 +87,12 @@ def main():
         # include all b0s
         index[b0_index] = True
     else:
-        index = np.genfromtxt(args.index).astype(np.bool)
+        index = np.genfromtxt(args.index).astype(bool)
 
     if index.shape[0] != bval.shape[0]:
         print('index length different from bval length')
         return None 
 
-    if args.mask is None:
-        mask = np.ones(data.shape[:3], dtype=np.bool)
-    else:
-        mask = nib.load(args.mask).get_fdata().astype(np.bool)
-
-    totalVoxel = np.prod(mask.shape)
-    voxelInMask = mask.sum()
-    print('{} voxels out of {} inside mask ({:.1f}%)'.format(voxelInMask, totalVoxel, 100*voxelInMask/totalVoxel))
-
 
 
     print('COMPUTING TIME CURVES')
@@ -158,7 +170,8 @@ def main():
     ks[np.isinf(ks)] = 1
 
     # save the diffusivity multiplier map
-    nib.nifti1.Nifti1Image(ks, img.affine).to_filename(args.outputks)
+    # the multiplier is 1 where it is not estimated
+    crop.save(ks, args.outputks, fill=1)
 
 
     mean_directional_k = np.median(ks[mask], axis=(0,))
@@ -206,7 +219,7 @@ def main():
 
 
     print('SAVING CORRECTED NIFTI')
-    nib.nifti1.Nifti1Image(data_meank_fix, img.affine).to_filename(args.output)
+    crop.save(data_meank_fix, args.output)
 
 
 
@@ -0,0 +1,77 @@
+import numpy as np
+
+from matrix_cache import cached
+
+
+## NEIGHBOURS
+
+def sphere_neighbours(sphere):
+	# table (Nvertices, max_degree) of the neighbours of each vertex built from the sphere edges
+	# rows of vertices with fewer neighbours are padded with the vertex itself, which is a no-op for the local maxima test
+	Nvert = sphere.vertices.shape[0]
+	edges = np.asarray(sphere.edges, dtype=np.intp)
+	src = np.concatenate((edges[:, 0], edges[:, 1]))
+	dst = np.concatenate((edges[:, 1], edges[:, 0]))
+	order = np.argsort(src, kind='stable')
+	src = src[order]
+	dst = dst[order]
+
+	degree = np.bincount(src, minlength=Nvert)
+	start = np.cumsum(degree) - degree
+	slot = np.arange(src.shape[0]) - start[src]
+
+	neighbours = np.repeat(np.arange(Nvert)[:, None], degree.max(), axis=1)
+	neighbours[src, slot] = dst
+	return neighbours
+
+
+def sphere_spacing(sphere):
+	# mean angle in radian between neighbouring vertices
+	v = sphere.vertices
+	edges = sphere.edges
+	return np.arccos(np.clip(np.abs((v[edges[:, 0]] * v[edges[:, 1]]).sum(axis=1)), -1, 1)).mean()
+
+
+## HEMISPHERE
+# Even order SH are antipodally symmetric, f(-x) = f(x), so on a sphere made of antipodal pairs
+# (all the dipy spheres we use: repulsion100/200/724, symmetric362) half of the SH to SF product is redundant.
+# The hemisphere keeps the first vertex of each pair, its neighbour table wraps around the equator
+# (the neighbours of a vertex and of its antipode map to the same hemisphere vertices),
+# so local maxima, maxima and minima on the hemisphere are those of the full sphere.
+
+def hemisphere_indices(sphere, tol=1e-8):
+	# return hemi_idx (Nvertices/2,) the full sphere index of one vertex per antipodal pair (the lowest)
+	# and full_to_hemi (Nvertices,) the hemisphere index of every full sphere vertex
+	# return None, None if the sphere is not made of antipodal pairs
+	v = sphere.vertices
+	antipode = np.argmin(v.dot(v.T), axis=1)
+	if np.abs(v + v[antipode]).max() > tol or np.any(antipode == np.arange(v.shape[0])):
+		return None, None
+	representative = np.minimum(np.arange(v.shape[0]), antipode)
+	hemi_idx, full_to_hemi = np.unique(representative, return_inverse=True)
+	return hemi_idx, full_to_hemi
+
+
+def hemisphere_neighbours(sphere, hemi_idx, full_to_hemi):
+	# neighbour table of the hemisphere, in hemisphere indices
+	return full_to_hemi[sphere_neighbours(sphere)[hemi_idx]]
+
+
+def hemisphere_sh_matrix(sphere, sh_order, sh_func):
+	# SH to SF matrix (Nvertices/2, Ncoef) of sh_func (real_sh_tournier or real_sh_descoteaux) on the hemisphere
+	# and hemi_idx, the full sphere index of its rows
+	# falls back to the full sphere (hemi_idx = all vertices) if the sphere is not antipodally symmetric
+	def build():
+		hemi_idx, full_to_hemi = hemisphere_indices(sphere)
+		if hemi_idx is None:
+			hemi_idx = np.arange(sphere.vertices.shape[0])
+		B, m, n = sh_func(sh_order, sphere.theta[hemi_idx], sphere.phi[hemi_idx])
+		return B, hemi_idx
+	return cached('hemisphere_sh_matrix', build, basis=sh_func.__name__, lmax=sh_order, sphere=sphere)
+
+
+## SH MATRICES
+
+def sh_matrix(sphere, sh_order, sh_func):
+	# SH to SF matrix (Nvertices, Ncoef) of sh_func (real_sh_tournier or real_sh_descoteaux) on sphere
+	return cached('sh_matrix', lambda: sh_func(sh_order, sphere.theta, sphere.phi)[0], basis=sh_func.__name__, lmax=sh_order, sphere=sphere)
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the scripts are run from the scripts folder and import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+from dipy.data import get_sphere
+from dipy.reconst.shm import real_sh_tournier
+
+from odf_utils import sphPDF_sym
+
+
+@pytest.fixture(scope='session')
+def sphere():
+    return get_sphere(name='repulsion724')
+
+
+@pytest.fixture(scope='session')
+def sh_mat(sphere):
+    return real_sh_tournier(8, sphere.theta, sphere.phi)[0]
+
+
+@pytest.fixture(scope='session')
+def odf_sh(sphere, sh_mat):
+    # (6, 5, 4, 45) tournier07 lmax 8 SH of noisy ODFs of 1 to 3 fibres
+    rng = np.random.default_rng(0)
+    shape = (6, 5, 4)
+    sf = np.zeros((int(np.prod(shape)), sphere.vertices.shape[0]))
+    for i in range(sf.shape[0]):
+        for _ in range(rng.integers(1, 4)):
+            mu = rng.normal(size=3)
+            mu /= np.linalg.norm(mu)
+            sf[i] += rng.uniform(0.3, 1) * sphPDF_sym(rng.uniform(5, 30), mu, sphere.vertices)
+    sf += 0.02 * rng.normal(size=sf.shape) * sf.max(axis=1, keepdims=True)
+    sh = np.linalg.lstsq(sh_mat, sf.T, rcond=None)[0].T
+    return sh.reshape(shape + (sh.shape[1],))
+
+
+@pytest.fixture(scope='session')
+def dwi():
+    # normalized single shell dwi (5, 4, 3, 62) of random tensors, its bvals, bvecs and mask
+    rng = np.random.default_rng(0)
+    bvecs = np.r_[np.zeros((2, 3)), get_sphere(name='repulsion100').vertices[:60]]
+    bvals = np.r_[0, 0, np.full(60, 1000.)]
+    shape = (5, 4, 3)
+    evecs = np.linalg.qr(rng.normal(size=shape + (3, 3)))[0]
+    evals = rng.uniform(0.2e-3, 2e-3, shape + (3,))
+    D = np.einsum('...ij,...j,...kj->...ik', evecs, evals, evecs)
+    data = np.exp(-bvals * np.einsum('gi,...ij,gj->...g', bvecs, D, bvecs))
+    data = np.clip(data + 0.01 * rng.normal(size=data.shape), 0, 1)
+    return data, bvals, bvecs, rng.random(shape) > 0.3
+
+
+@pytest.fixture(scope='session')
+def mask(odf_sh):
+    return np.random.default_rng(1).random(odf_sh.shape[:3]) > 0.3
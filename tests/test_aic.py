@@ -0,0 +1,118 @@
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.sims.voxel import multi_tensor
+from scipy.interpolate import interp1d
+
+import compute_aic_all_peaks
+from compute_aic_all_peaks import aic, aic_block, multigaussian_log_likelihood
+from odf_utils import SM_from_param, true_MD_func
+
+
+@pytest.fixture(scope='module')
+def gtab():
+    vertices = get_sphere(name='repulsion100').vertices
+    bvals = np.r_[0, 0, np.full(50, 1000.), np.full(50, 2000.)]
+    return gradient_table(bvals, bvecs=np.r_[np.zeros((2, 3)), vertices])
+
+
+@pytest.fixture(scope='module')
+def peaks():
+    # 40 voxels of 0 to 3 peaks (of 10), noise dwi, sigma and kernel MD
+    rng = np.random.default_rng(0)
+    Nvox, Npeaks = 40, 10
+    peak_dir = rng.normal(size=(Nvox, Npeaks, 3))
+    peak_dir /= np.linalg.norm(peak_dir, axis=2, keepdims=True)
+    count = rng.integers(0, 4, Nvox)
+    peak_len = np.sort(rng.random((Nvox, Npeaks)), axis=1)[:, ::-1].copy()
+    peak_len[np.arange(Npeaks)[None, :] >= count[:, None]] = 0
+    peak_dir[peak_len == 0] = 0
+    data = rng.random((Nvox, 100))
+    sigma = rng.uniform(0.02, 0.1, Nvox)
+    MD_est = rng.uniform(0.5e-3, 1e-3, Nvox)
+    return data, peak_dir, peak_len, sigma, MD_est
+
+
+def multi_tensor_aic(gtab, data, peak_dir, peak_len, sigma, MD_est, ratio):
+    # per voxel AIC of the original compute_aic_all_peaks.py loop, with dipy multi_tensor
+    aic_value = np.zeros(data.shape[0])
+    for i in range(data.shape[0]):
+        Npeaks = int((peak_len[i] > 0).sum())
+        K = MD_est[i] / ((1+2/ratio)/3)
+        mevals = np.repeat(K * np.array([[1.0, 1/ratio, 1/ratio]]), Npeaks, axis=0)
+        if Npeaks > 0:
+            signal, _ = multi_tensor(gtab, mevals=mevals, S0=1, angles=peak_dir[i, :Npeaks], fractions=100*peak_len[i, :Npeaks]/peak_len[i, :Npeaks].sum(), snr=None)
+        else:
+            # no peaks, no signal
+            signal = np.zeros(gtab.bvals.shape[0])
+        aic_value[i] = aic(multigaussian_log_likelihood(data[i] - signal[~gtab.b0s_mask], sigma[i]), dof=3*Npeaks)
+    return aic_value
+
+
+@pytest.mark.parametrize('ratio', [1.5, 4.])
+def test_aic_block_matches_multi_tensor(gtab, peaks, ratio):
+    aic_value = aic_block(*peaks, ratio, gtab.bvals[~gtab.b0s_mask], gtab.bvecs[~gtab.b0s_mask])
+    np.testing.assert_allclose(aic_value, multi_tensor_aic(gtab, *peaks, ratio), rtol=1e-12, atol=0)
+
+
+def test_true_MD_func_matches_scalar_table():
+    # the original table, one SM_from_param call per MD
+    MDs = np.linspace(0.01e-3, 3e-3, 3000)
+    SMs = np.array([SM_from_param(1500., MD, 2.5) for MD in MDs])
+    ref = interp1d(SMs, MDs, bounds_error=False, fill_value=(0.01e-3, 3e-3))
+    SM = np.random.default_rng(0).uniform(0, 1, 500)
+    MD_from_SM = true_MD_func(meanbval=1500., ratio=2.5, minMD=0.01e-3, maxMD=3e-3, N_MD=3000)
+    np.testing.assert_allclose(MD_from_SM(SM), ref(SM), rtol=1e-12, atol=0)
+    # the spherical mean of a kernel of known MD gives it back
+    np.testing.assert_allclose(MD_from_SM(SM_from_param(1500., np.array([0.5e-3, 1e-3, 2e-3]), 2.5)), [0.5e-3, 1e-3, 2e-3], rtol=1e-5)
+
+
+@pytest.fixture
+def aic_files(tmp_path, gtab, peaks):
+    # inputs of compute_aic_all_peaks.py on a (4, 5, 2) grid, the dense peaks of two ratios
+    data, peak_dir, peak_len, sigma, _ = peaks
+    shape = (4, 5, 2)
+    affine = np.eye(4)
+    dwi = np.zeros(shape + (gtab.bvals.shape[0],))
+    dwi[..., gtab.b0s_mask] = 1
+    dwi[..., ~gtab.b0s_mask] = data.reshape(shape + (-1,))
+    nib.Nifti1Image(dwi, affine).to_filename(str(tmp_path / 'data.nii.gz'))
+    nib.Nifti1Image(sigma.reshape(shape), affine).to_filename(str(tmp_path / 'sigma.nii.gz'))
+    np.savetxt(str(tmp_path / 'bval'), gtab.bvals[None])
+    np.savetxt(str(tmp_path / 'bvec'), gtab.bvecs.T)
+    for i, shift in enumerate([0, 7]):
+        nib.Nifti1Image(np.roll(peak_dir, shift, axis=0).reshape(shape + peak_dir.shape[1:]), affine).to_filename(str(tmp_path / 'dirs{:}.nii.gz'.format(i)))
+        nib.Nifti1Image(np.roll(peak_len, shift, axis=0).reshape(shape + peak_len.shape[1:]), affine).to_filename(str(tmp_path / 'len{:}.nii.gz'.format(i)))
+    return tmp_path
+
+
+def run_compute_aic(monkeypatch, folder, *args):
+    base = ['--data', 'data.nii.gz', '--bval', 'bval', '--bvec', 'bvec', '--sigma', 'sigma.nii.gz']
+    monkeypatch.chdir(folder)
+    monkeypatch.setattr(sys, 'argv', ['compute_aic_all_peaks.py'] + base + list(args))
+    compute_aic_all_peaks.main()
+
+
+def test_compute_aic_all_ratios_in_one_run(monkeypatch, aic_files):
+    run_compute_aic(monkeypatch, aic_files, '--idirs', 'dirs0.nii.gz', 'dirs1.nii.gz', '--ilen', 'len0.nii.gz', 'len1.nii.gz',
+                    '--ratio', '1.5', '4', '--oaic', 'both0.nii.gz', 'both1.nii.gz')
+    for i, ratio in enumerate(['1.5', '4']):
+        run_compute_aic(monkeypatch, aic_files, '--idirs', 'dirs{:}.nii.gz'.format(i), '--ilen', 'len{:}.nii.gz'.format(i),
+                        '--ratio', ratio, '--oaic', 'single{:}.nii.gz'.format(i))
+        aic_value = nib.load(str(aic_files / 'both{:}.nii.gz'.format(i))).get_fdata()
+        assert aic_value.all()
+        np.testing.assert_array_equal(aic_value, nib.load(str(aic_files / 'single{:}.nii.gz'.format(i))).get_fdata())
+
+
+def test_compute_aic_rejects_peaks_off_grid(monkeypatch, aic_files):
+    peak_len = nib.load(str(aic_files / 'len0.nii.gz'))
+    nib.Nifti1Image(peak_len.get_fdata()[:3], peak_len.affine).to_filename(str(aic_files / 'len_crop.nii.gz'))
+    with pytest.raises(SystemExit) as exit_info:
+        run_compute_aic(monkeypatch, aic_files, '--idirs', 'dirs0.nii.gz', '--ilen', 'len_crop.nii.gz', '--ratio', '2', '--oaic', 'aic.nii.gz')
+    assert exit_info.value.code == 2
+    assert not (aic_files / 'aic.nii.gz').exists()
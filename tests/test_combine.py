@@ -0,0 +1,95 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from combine_utils import best_idx_labels, gather_best, gather_best_odf, load_odf_stack, masked_correlate, neighbourhood_aic, neighbourhood_kernel, stream_best_odf
+from crop_utils import GridCrop
+from odf_utils import extract_patches
+
+
+@pytest.fixture(scope='module')
+def aics():
+    rng = np.random.default_rng(0)
+    aics = rng.normal(size=(9, 8, 7, 4))
+    mask = rng.random(aics.shape[:3]) > 0.3
+    return aics, mask
+
+
+@pytest.fixture(scope='module')
+def odfs(aics):
+    # (X, Y, Z, Ncoef, Nratio) ODF stack
+    return np.random.default_rng(1).normal(size=aics[0].shape[:3] + (15, aics[0].shape[3]))
+
+
+def patch_neighbourhood_aic(data_aics, mask):
+    # original combine_aic_neigh.py loop over the 3x3x3 patches of the masked voxels
+    kn = 3
+    padsize = 1
+    XX, YY, ZZ = np.meshgrid(range(kn), range(kn), range(kn))
+    kernel = np.exp(-(1/2)*((((XX-padsize)**2 + (YY-padsize)**2 + (ZZ-padsize)**2)/0.5)**0.5))
+    kernel = kernel[..., None] / kernel.sum()
+    data_patches = extract_patches(np.pad(data_aics, ((padsize,), (padsize,), (padsize,), (0,))), (kn, kn, kn, data_aics.shape[3]), (1, 1, 1, 1), flatten=False)
+    mask_patches = extract_patches(np.pad(mask, padsize), (kn, kn, kn), (1, 1, 1), flatten=False)
+    neigh_sum_aic = np.zeros(data_aics.shape)
+    for xyz in np.ndindex(data_aics.shape[:3]):
+        if mask[xyz]:
+            neigh_sum_aic[xyz] = np.sum((data_patches[xyz+(0,)] * kernel)[mask_patches[xyz]], axis=0)
+    return neigh_sum_aic
+
+
+@pytest.mark.parametrize('nbr_processes', [1, 2])
+def test_neighbourhood_aic_matches_patch_loop(aics, nbr_processes):
+    data_aics, mask = aics
+    neigh = neighbourhood_aic(data_aics, mask, *neighbourhood_kernel(), nbr_processes=nbr_processes)
+    np.testing.assert_allclose(neigh, patch_neighbourhood_aic(data_aics, mask), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('shape', ['exponential', 'gaussian'])
+def test_masked_correlate_large_kernel(aics, shape):
+    # the separable and FFT paths give the direct correlation
+    data_aics, mask = aics
+    kernel, factors = neighbourhood_kernel(size=7, width=2., shape=shape)
+    direct = masked_correlate(data_aics[..., 0], mask, kernel, direct_max_size=7)
+    np.testing.assert_allclose(masked_correlate(data_aics[..., 0], mask, kernel, factors), direct, rtol=0, atol=1e-12)
+
+
+def test_gather_best_matches_repack_loop(aics, odfs):
+    data_aics, mask = aics
+    ratios = np.array([1.1, 2., 3.5, 5.])
+    best_idx = np.argmin(data_aics, axis=3)
+    best_aic, best_ratio = gather_best(best_idx, mask, data_aics, ratios)
+    best_odf = gather_best_odf(best_idx, mask, odfs)
+    # original loop, the outputs are now 0 outside of the mask
+    for xyz in np.ndindex(mask.shape):
+        if mask[xyz]:
+            assert best_aic[xyz] == data_aics[xyz][best_idx[xyz]]
+            assert best_ratio[xyz] == ratios[best_idx[xyz]]
+            np.testing.assert_array_equal(best_odf[xyz], odfs[xyz][:, best_idx[xyz]])
+    assert not best_aic[~mask].any() and not best_ratio[~mask].any() and not best_odf[~mask].any()
+    labels = best_idx_labels(best_idx, mask)
+    np.testing.assert_array_equal(labels, np.where(mask, best_idx + 1, 0))
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('slab', [0, 1, 3])
+def test_stream_best_odf_matches_gather(tmp_path, aics, odfs, ext, slab):
+    data_aics, mask = aics
+    # no voxel picks the last ratio, its file is not read
+    best_idx = np.argmin(data_aics[..., :-1], axis=3)
+    fnames = []
+    for i in range(odfs.shape[4]):
+        fnames.append(str(tmp_path / 'odf{:}{:}'.format(i, ext)))
+        nib.Nifti1Image(odfs[..., i], np.eye(4)).to_filename(fnames[-1])
+    np.testing.assert_array_equal(load_odf_stack(fnames), odfs)
+    os.remove(fnames[-1])
+    ref = gather_best_odf(best_idx, mask, odfs)
+    np.testing.assert_array_equal(stream_best_odf(best_idx, mask, fnames, slab=slab), ref)
+
+    # on the mask bounding box
+    box_mask = np.zeros(mask.shape, dtype=bool)
+    box_mask[2:7, 1:5, 2:6] = mask[2:7, 1:5, 2:6]
+    crop = GridCrop.from_mask(box_mask, np.eye(4))
+    best_odf = stream_best_odf(crop.crop(best_idx), crop.crop(box_mask), fnames, slab=slab, crop=crop)
+    np.testing.assert_array_equal(crop.uncrop(best_odf), gather_best_odf(best_idx, box_mask, odfs))
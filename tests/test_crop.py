@@ -0,0 +1,72 @@
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import drift_corr_data
+import sh_odf_normalize
+from crop_utils import GridCrop
+
+
+AFFINE = np.array([[-2., 0, 0, 30], [0, 1.5, 0.5, -20], [0, 0, 3, 10], [0, 0, 0, 1]])
+
+
+def test_grid_crop_box_and_affine():
+    mask = np.zeros((8, 7, 6), dtype=bool)
+    mask[2:5, 3, 1:4] = True
+    crop = GridCrop.from_mask(mask, AFFINE, margin=1)
+    assert crop.slices == (slice(1, 6), slice(2, 5), slice(0, 5))
+    # the box voxel (i, j, k) is at the world position of the grid voxel (start + (i, j, k))
+    ijk = np.array([2., 1., 3.])
+    start = np.array([s.start for s in crop.slices])
+    np.testing.assert_allclose(nib.affines.apply_affine(crop.cropped_affine, ijk), nib.affines.apply_affine(AFFINE, start + ijk))
+
+    data = np.random.default_rng(0).random(mask.shape + (2,))
+    full = crop.uncrop(crop.crop(data))
+    np.testing.assert_array_equal(full[crop.slices], data[crop.slices])
+    assert not full[0].any() and not full[:, :, 5].any()
+    with pytest.raises(ValueError):
+        GridCrop.from_mask(np.zeros_like(mask), AFFINE)
+
+
+def test_sh_odf_normalize_crop_matches_full_grid(tmp_path, odf_sh, mask, monkeypatch):
+    # the mask only covers part of the grid, --crop only reads its bounding box
+    box_mask = np.zeros_like(mask)
+    box_mask[1:4, 2:5, 1:3] = mask[1:4, 2:5, 1:3]
+    nib.Nifti1Image(odf_sh, AFFINE).to_filename(str(tmp_path / 'sh.nii.gz'))
+    nib.Nifti1Image(box_mask.astype(np.uint8), AFFINE).to_filename(str(tmp_path / 'mask.nii.gz'))
+    monkeypatch.chdir(tmp_path)
+    outputs = {}
+    for name, extra in [('full', []), ('crop', ['--crop'])]:
+        monkeypatch.setattr(sys, 'argv', ['sh_odf_normalize.py', 'sh.nii.gz', name + '.nii.gz', '--mask', 'mask.nii.gz'] + extra)
+        sh_odf_normalize.main()
+        img = nib.load(name + '.nii.gz')
+        np.testing.assert_allclose(img.affine, AFFINE)
+        outputs[name] = img.get_fdata()
+    assert outputs['crop'].shape == odf_sh.shape
+    np.testing.assert_array_equal(outputs['crop'], outputs['full'])
+    assert not outputs['crop'][~box_mask].any()
+
+
+def test_drift_corr_crop_matches_full_grid(tmp_path, mask, monkeypatch):
+    # b0s drifting over the series, the correction is the same inside the box, 0 outside of it
+    rng = np.random.default_rng(2)
+    bvals = np.array([0, 1000, 1000, 0, 1000, 2000, 0])
+    data = rng.uniform(0.5, 1, mask.shape + (bvals.size,)) * np.linspace(1, 0.8, bvals.size)
+    box_mask = np.zeros_like(mask)
+    box_mask[1:5, 1:3, 1:4] = mask[1:5, 1:3, 1:4]
+    nib.Nifti1Image(data, AFFINE).to_filename(str(tmp_path / 'data.nii.gz'))
+    nib.Nifti1Image(box_mask.astype(np.uint8), AFFINE).to_filename(str(tmp_path / 'mask.nii.gz'))
+    np.savetxt(str(tmp_path / 'data.bval'), bvals[None], fmt='%d')
+    monkeypatch.chdir(tmp_path)
+    outputs = {}
+    for name, extra in [('full', []), ('crop', ['--crop'])]:
+        monkeypatch.setattr(sys, 'argv', ['drift_corr_data.py', '--in', 'data.nii.gz', '--mask', 'mask.nii.gz', '--bval', 'data.bval', '--out', name + '.nii.gz'] + extra)
+        drift_corr_data.main()
+        outputs[name] = nib.load(name + '.nii.gz').get_fdata()
+    crop = GridCrop.from_mask(box_mask, AFFINE)
+    assert outputs['crop'].shape == data.shape
+    np.testing.assert_allclose(crop.crop(outputs['crop']), crop.crop(outputs['full']), rtol=1e-6)
+    outputs['crop'][crop.slices] = 0
+    assert not outputs['crop'].any()
@@ -0,0 +1,30 @@
+import nibabel as nib
+import numpy as np
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.reconst.shm import CsaOdfModel, sh_to_sf_matrix
+
+import fit_csa
+
+
+def test_fit_csa_matches_dipy_and_conversion(tmp_path, dwi):
+    data, bvals, bvecs, mask = dwi
+    nib.Nifti1Image(data, np.eye(4)).to_filename(str(tmp_path / 'dwi.nii.gz'))
+    nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(str(tmp_path / 'mask.nii.gz'))
+    np.savetxt(str(tmp_path / 'bval'), bvals[None])
+    np.savetxt(str(tmp_path / 'bvec'), bvecs.T)
+
+    fit_csa.main(str(tmp_path / 'dwi.nii.gz'), str(tmp_path / 'bval'), str(tmp_path / 'bvec'), str(tmp_path / 'mask.nii.gz'), str(tmp_path / 'sh.nii.gz'), 2, 1e-5, 0.006, 6)
+    tournier_sh = nib.load(str(tmp_path / 'sh.nii.gz')).get_fdata()
+
+    # dipy CSA fit then the descoteaux07 -> tournier07 SF round trip on repulsion200, with the X flip of fit_csa
+    bvecs = bvecs * [-1, 1, 1]
+    csa_model = CsaOdfModel(gradient_table(bvals, bvecs=bvecs), sh_order_max=6, min_signal=1e-5, smooth=0.006, assume_normed=False)
+    descoteaux_sh = csa_model.fit(data.astype(np.float32), mask=mask).shm_coeff
+    sphere = get_sphere(name='repulsion200')
+    B_in, _ = sh_to_sf_matrix(sphere, sh_order_max=6, basis_type='descoteaux07')
+    _, invB_out = sh_to_sf_matrix(sphere, sh_order_max=6, basis_type='tournier07')
+    ref = descoteaux_sh.dot(B_in).dot(invB_out)
+    ref[~mask] = 0
+    np.testing.assert_allclose(tournier_sh, ref, rtol=0, atol=1e-12)
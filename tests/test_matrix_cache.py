@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+import matrix_cache
+from matrix_cache import MatrixCache
+
+
+def test_lru_hits_and_evictions():
+    cache = MatrixCache(max_items=2)
+    builds = []
+
+    def build(n):
+        builds.append(n)
+        return np.eye(n), np.ones(n)
+
+    first = cache.get('eye', lambda: build(2), n=2)
+    assert cache.get('eye', lambda: build(2), n=2) is first
+    cache.get('eye', lambda: build(3), n=3)
+    cache.get('eye', lambda: build(4), n=4)
+    cache.get('eye', lambda: build(2), n=2)
+    assert builds == [2, 3, 4, 2]
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 4 and cache.stats()['evictions'] == 2
+    # the cached arrays are read-only
+    with pytest.raises(ValueError):
+        first[0][0, 0] = 2
+
+
+def test_disk_store_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(matrix_cache, '_default_cache', None)
+    monkeypatch.delenv('EBC_MATRIX_CACHE', raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    matrix_cache.cached('eye', lambda: np.eye(2), n=2)
+    assert matrix_cache.default_cache().directory is None
+    assert not (tmp_path / 'home').exists()
+
+    monkeypatch.setattr(matrix_cache, '_default_cache', None)
+    monkeypatch.setenv('EBC_MATRIX_CACHE', str(tmp_path / 'store'))
+    matrix_cache.cached('eye', lambda: np.eye(2), n=2)
+    directory = matrix_cache.default_cache().directory
+    assert len(os.listdir(directory)) == 1
+    # a new process finds the entry on disk
+    cache = MatrixCache(str(tmp_path / 'store'))
+    np.testing.assert_array_equal(cache.get('eye', lambda: np.zeros(2), n=2), np.eye(2))
+    assert cache.stats()['disk_hits'] == 1 and cache.stats()['misses'] == 0
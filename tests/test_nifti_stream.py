@@ -0,0 +1,58 @@
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from nifti_stream import NiftiVolumeWriter, iter_volumes
+
+
+AFFINE = np.diag([1.5, 1.5, 2., 1.])
+
+
+@pytest.fixture(scope='module')
+def series():
+    return np.random.default_rng(0).random((6, 5, 4, 3)).astype(np.float32)
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_volume_writer_matches_nifti1image(tmp_path, series, ext):
+    ref_fname = str(tmp_path / ('ref' + ext))
+    fname = str(tmp_path / ('stream' + ext))
+    nib.Nifti1Image(series, AFFINE).to_filename(ref_fname)
+    with NiftiVolumeWriter(fname, series.shape, AFFINE) as writer:
+        for t, volume in iter_volumes(ref_fname):
+            writer.write(volume)
+    ref, img = nib.load(ref_fname), nib.load(fname)
+    assert img.header.binaryblock == ref.header.binaryblock
+    np.testing.assert_array_equal(img.get_fdata(), ref.get_fdata())
+
+    # box of each volume, as read with --crop
+    slices = (slice(1, 4), slice(0, 5), slice(2, 4))
+    for t, volume in iter_volumes(ref_fname, slices):
+        np.testing.assert_array_equal(volume, series[slices + (t,)])
+
+    writer = NiftiVolumeWriter(str(tmp_path / ('short' + ext)), series.shape, AFFINE)
+    writer.write(series[..., 0])
+    with pytest.raises(ValueError):
+        writer.write(series[:-1, ..., 1])
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_rician_stream_matches_in_memory(tmp_path, series, monkeypatch):
+    # the script shows its QA plots with pylab
+    plt = pytest.importorskip('pylab')
+    import rician_bias_correct
+    monkeypatch.setattr(plt, 'show', lambda: None)
+    data = 10 * series
+    nib.Nifti1Image(data, AFFINE).to_filename(str(tmp_path / 'data.nii.gz'))
+    # sigma profile along y, larger than the signal in some voxels
+    np.savetxt(str(tmp_path / 'sigma.txt'), np.linspace(0.5, 6, data.shape[1]))
+    monkeypatch.chdir(tmp_path)
+    for name, extra in [('ref', []), ('stream', ['--stream'])]:
+        monkeypatch.setattr(sys, 'argv', ['rician_bias_correct.py', '--in', 'data.nii.gz', '--out', name + '.nii.gz', '--sigma', 'sigma.txt', '--axes', '0,2'] + extra)
+        rician_bias_correct.main()
+    ref, img = nib.load('ref.nii.gz'), nib.load('stream.nii.gz')
+    assert img.header.binaryblock == ref.header.binaryblock
+    np.testing.assert_allclose(img.get_fdata(), ref.get_fdata(), rtol=1e-5, atol=1e-5)
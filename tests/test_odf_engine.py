@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+import _sharpen_parallel
+import odf_engine
+import odf_utils
+import shared_array
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.reconst.csdeconv import odf_sh_to_sharp
+from dipy.reconst.shm import CsaOdfModel, real_sh_tournier, sh_to_sf_matrix
+
+from combine_utils import gather_best, neighbourhood_aic, neighbourhood_kernel
+from compute_aic_all_peaks import aic_block
+from odf_engine import ODFEngine
+from odf_utils import peak_directions_sh_vol, true_MD_func
+
+
+RATIOS = [1.5, 2.5, 4.]
+
+
+@pytest.fixture(scope='module')
+def engine_inputs(dwi):
+    data, bvals, bvecs, mask = dwi
+    sigma = np.full(mask.shape, 0.02)
+    # voxels with sigma = 0 have no AIC
+    sigma[0, 0] = 0
+    return data, mask, sigma, gradient_table(bvals, bvecs=bvecs)
+
+
+@pytest.fixture(scope='module')
+def chain_aics(engine_inputs):
+    # the per step chain of 14_diff_run_odf.sh: dipy CSA fit and basis conversion, dipy sharpening,
+    # peak extraction and AIC of each ratio, (Nratio, X, Y, Z) AIC and (Nratio, X, Y, Z, Ncoef) ODFs
+    data, mask, sigma, gtab = engine_inputs
+    csa_model = CsaOdfModel(gtab, sh_order_max=6, min_signal=1e-5, smooth=0.006, assume_normed=False)
+    sphere_conv = get_sphere(name='repulsion200')
+    B_in, _ = sh_to_sf_matrix(sphere_conv, sh_order_max=6, basis_type='descoteaux07')
+    _, invB_out = sh_to_sf_matrix(sphere_conv, sh_order_max=6, basis_type='tournier07')
+    csa = csa_model.fit(data.astype(np.float32), mask=mask).shm_coeff.dot(B_in).dot(invB_out)
+
+    sphere = get_sphere(name='repulsion724')
+    B = real_sh_tournier(6, sphere.theta, sphere.phi)[0]
+    aic_mask = np.logical_and(mask, sigma > 0)
+    dwi = np.clip(data[aic_mask][:, ~gtab.b0s_mask], 0, 1)
+    bvals, bvecs = gtab.bvals[~gtab.b0s_mask], gtab.bvecs[~gtab.b0s_mask]
+    aics, odfs = [], []
+    for ratio in RATIOS:
+        fodf = np.zeros(csa.shape)
+        fodf[mask] = odf_sh_to_sharp(csa[mask], get_sphere(name='symmetric362'), basis='tournier07', ratio=1/ratio, sh_order_max=6, r2_term=True)
+        peak_dir, peak_len, _ = peak_directions_sh_vol(fodf, B, sphere, 0.25, 25, 10, mask=mask)
+        MD_est = true_MD_func(meanbval=bvals.mean(), ratio=ratio, minMD=0.01e-3, maxMD=3e-3, N_MD=3000)(dwi.mean(axis=1))
+        aic = np.zeros(mask.shape)
+        aic[aic_mask] = aic_block(dwi, peak_dir[aic_mask], peak_len[aic_mask], sigma[aic_mask], MD_est, ratio, bvals, bvecs)
+        aics.append(aic)
+        odfs.append(fodf)
+    return np.array(aics), np.array(odfs)
+
+
+@pytest.mark.parametrize('neighbourhood', [False, True])
+def test_engine_select_matches_chain(engine_inputs, chain_aics, neighbourhood):
+    data, mask, sigma, gtab = engine_inputs
+    aics, odfs = chain_aics
+    kernel, factors = neighbourhood_kernel() if neighbourhood else (None, None)
+    score = np.moveaxis(aics, 0, 3)
+    if neighbourhood:
+        score = neighbourhood_aic(score, mask, kernel, factors)
+    best_idx = np.argmin(score, axis=3)
+
+    with ODFEngine(data, mask, sigma, gtab, nbr_processes=1, verbose=False) as engine:
+        best_aic, best_ratio, engine_idx, best_odf = engine.select(RATIOS, kernel, factors)
+    np.testing.assert_array_equal(engine_idx[mask], best_idx[mask])
+    ref_aic, ref_ratio = gather_best(best_idx, mask, np.moveaxis(aics, 0, 3), RATIOS)
+    np.testing.assert_allclose(best_aic, ref_aic, rtol=1e-10)
+    np.testing.assert_array_equal(best_ratio, ref_ratio)
+    np.testing.assert_allclose(best_odf[mask], odfs[best_idx[mask], mask], rtol=0, atol=1e-10)
+
+
+def test_engine_steps_share_one_worker_pool(engine_inputs, chain_aics, monkeypatch):
+    # with 2 processes, the CSA fit has its pool and the sharpening, peaks and AIC share another one
+    data, mask, sigma, gtab = engine_inputs
+    for module in (odf_engine, _sharpen_parallel, odf_utils):
+        monkeypatch.setattr(module, 'cpu_count', lambda: 2)
+    pools = []
+    def counted_pool(*args, **kwargs):
+        pools.append(kwargs['processes'])
+        return shared_array_pool(*args, **kwargs)
+    shared_array_pool = shared_array.Pool
+    monkeypatch.setattr(shared_array, 'Pool', counted_pool)
+
+    with ODFEngine(data, mask, sigma, gtab, nbr_processes=2, verbose=False) as engine:
+        best_aic, best_ratio, best_idx, best_odf = engine.select(RATIOS)
+    assert pools == [2, 2]
+    aics, odfs = chain_aics
+    ref_idx = np.argmin(aics, axis=0)
+    np.testing.assert_array_equal(best_idx[mask], ref_idx[mask])
+    np.testing.assert_allclose(best_odf[mask], odfs[ref_idx[mask], mask], rtol=0, atol=1e-10)
+
+
+def test_engine_search_matches_select_on_unimodal_voxels(engine_inputs):
+    data, mask, sigma, gtab = engine_inputs
+    ratios = list(np.linspace(1.2, 6., 11))
+    aics = []
+    with ODFEngine(data, mask, sigma, gtab, nbr_processes=1, verbose=False) as engine:
+        selected = engine.select(ratios, callback=lambda i, ratio, fodf, peak_dir, peak_len, aic: aics.append(aic))
+        searched, Nevals = engine.search(ratios)
+    Nvox = int(mask.sum())
+    assert Nevals < Nvox * len(ratios)
+    # the exhaustive best AIC is the lowest, the search finds it for the AIC curves unimodal over the ratios
+    # (the AIC of a subset of the voxels can differ by rounding)
+    assert (searched[0][mask] >= selected[0][mask] - 1e-10 * np.abs(selected[0][mask])).all()
+    steps = np.sign(np.diff(np.array(aics), axis=0))
+    unimodal = np.all(np.diff(steps, axis=0) >= 0, axis=0)
+    assert np.logical_and(unimodal, sigma[mask] > 0).sum() >= 5
+    best_aic, best_ratio, best_idx, best_odf = searched
+    np.testing.assert_array_equal(best_idx[mask][unimodal], selected[2][mask][unimodal])
+    np.testing.assert_array_equal(best_ratio[mask][unimodal], selected[1][mask][unimodal])
+    np.testing.assert_allclose(best_aic[mask][unimodal], selected[0][mask][unimodal], rtol=1e-10)
+    np.testing.assert_allclose(best_odf[mask][unimodal], selected[3][mask][unimodal], rtol=0, atol=1e-10)
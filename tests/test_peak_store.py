@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from odf_utils import peak_directions_sh_vol
+from peak_store import PeakStore, peak_store_shape, save_peaks
+
+
+@pytest.fixture(scope='module')
+def peaks(odf_sh, sh_mat, sphere, mask):
+    return peak_directions_sh_vol(odf_sh, sh_mat, sphere, 0.25, 25, 10, mask=mask)
+
+
+def test_sphere_indices_round_trip(tmp_path, peaks, mask):
+    peak_dir, peak_len, peak_ind = peaks
+    fname = str(tmp_path / 'peaks.npz')
+    save_peaks(fname, peak_dir, peak_len, mask, np.eye(4), peak_ind=peak_ind, sphere='repulsion724')
+    assert peak_store_shape(fname) == mask.shape
+    store = PeakStore(fname)
+    assert store.sphere == 'repulsion724' and store.dir is None
+    np.testing.assert_array_equal(store.mask(), mask)
+    nufo, dirs, lens = store.to_dense()
+    np.testing.assert_array_equal(nufo, (peak_len > 0).sum(axis=3))
+    np.testing.assert_array_equal(dirs, peak_dir)
+    np.testing.assert_allclose(lens, peak_len, rtol=1e-7)
+
+
+def test_fill_other_mask(tmp_path, peaks, mask):
+    # refined (float32 directions), read for another mask and fewer peaks
+    peak_dir, peak_len, _ = peaks
+    fname = str(tmp_path / 'peaks.npz')
+    save_peaks(fname, peak_dir, peak_len, mask, np.eye(4))
+    other = np.ones(mask.shape, dtype=bool)
+    other[0] = False
+    dirs, lens = PeakStore(fname).masked(other, Npeaks=2)
+    ref_len = np.where(mask[..., None], peak_len, 0)[other][:, :2]
+    np.testing.assert_allclose(lens, ref_len, rtol=1e-7)
+    np.testing.assert_allclose(dirs, np.where(mask[..., None, None], peak_dir, 0)[other][:, :2], rtol=0, atol=1e-7)
+    with pytest.raises(ValueError):
+        PeakStore(fname).masked(other[1:])
@@ -0,0 +1,111 @@
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from dipy.data import get_sphere
+from dipy.direction.peaks import peak_directions
+from dipy.reconst.shm import real_sh_tournier
+
+import odf_utils
+import peak_extraction
+from odf_utils import PeakExtractor, peak_directions_sh_vol, sphPDF_sym
+
+
+def dipy_peaks(sf, sphere, relative_peak_threshold, min_separation_angle, Npeaks=10):
+    # per voxel dipy peak_directions, padded like the peak volumes
+    peak_val = np.zeros((sf.shape[0], Npeaks))
+    peak_ind = np.zeros((sf.shape[0], Npeaks), dtype=int)
+    for i in range(sf.shape[0]):
+        _, val, ind = peak_directions(sf[i], sphere, relative_peak_threshold=relative_peak_threshold, min_separation_angle=min_separation_angle)
+        peak_val[i, :len(val)] = val[:Npeaks]
+        peak_ind[i, :len(ind)] = ind[:Npeaks]
+    return peak_val, peak_ind
+
+
+def test_peak_directions_sh_vol_matches_dipy(odf_sh, sh_mat, sphere, mask):
+    peak_dir, peak_val, peak_ind = peak_directions_sh_vol(odf_sh, sh_mat, sphere, 0.25, 25, 10, mask=mask)
+    ref_val, ref_ind = dipy_peaks(odf_sh[mask].dot(sh_mat.T), sphere, 0.25, 25)
+    np.testing.assert_array_equal(peak_ind[mask], ref_ind)
+    np.testing.assert_array_equal(peak_val[mask], ref_val)
+    np.testing.assert_array_equal(peak_dir[mask], sphere.vertices[ref_ind] * (ref_val > 0)[..., None])
+    assert not peak_val[~mask].any()
+
+
+def test_peak_directions_sh_vol_parallel_chunks(odf_sh, sh_mat, sphere, mask, monkeypatch):
+    # small blocks over several workers give the single process peaks
+    ref = peak_directions_sh_vol(odf_sh, sh_mat, sphere, 0.25, 25, 10, mask=mask)
+    monkeypatch.setattr(odf_utils, 'cpu_count', lambda: 3)
+    peaks = peak_directions_sh_vol(odf_sh, sh_mat, sphere, 0.25, 25, 10, mask=mask, block_size=7, nbr_processes=3)
+    for array, ref_array in zip(peaks, ref):
+        np.testing.assert_array_equal(array, ref_array)
+
+
+def test_peak_extractor_reused_over_inputs(odf_sh, sh_mat, sphere, mask):
+    # one extractor for several ratios gives the peaks of a separate run per ratio
+    odfs = [odf_sh, odf_sh * np.linspace(1, 2, odf_sh.shape[-1]), odf_sh[::-1]]
+    refs = [peak_directions_sh_vol(odf, sh_mat, sphere, 0.25, 25, 10, mask=mask) for odf in odfs]
+    with PeakExtractor(sh_mat, sphere, mask, odf_sh.shape[-1], 0.25, 25, 10) as extractor:
+        for odf, ref in zip(odfs, refs):
+            peaks = extractor(odf[mask])
+            for array, ref_array in zip(peaks, ref):
+                np.testing.assert_array_equal(array, ref_array)
+
+
+def test_peak_extraction_rejects_other_shapes(tmp_path, odf_sh, monkeypatch):
+    # an input off the grid of the first fails before any output is written
+    nib.Nifti1Image(odf_sh, np.eye(4)).to_filename(str(tmp_path / 'r1.nii.gz'))
+    nib.Nifti1Image(odf_sh[1:], np.eye(4)).to_filename(str(tmp_path / 'r2.nii.gz'))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['peak_extraction.py', '--iodf', 'r1.nii.gz', 'r2.nii.gz',
+                                      '--onufo', 'n1.nii.gz', 'n2.nii.gz', '--odir', 'd1.nii.gz', 'd2.nii.gz',
+                                      '--olen', 'l1.nii.gz', 'l2.nii.gz'])
+    with pytest.raises(SystemExit) as exit_info:
+        peak_extraction.main()
+    assert exit_info.value.code == 2
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['r1.nii.gz', 'r2.nii.gz']
+
+
+def test_refined_peaks_on_coarse_sphere(sphere, sh_mat):
+    # single fibre ODFs: the SH refined peak from repulsion100 is closer to the fibre
+    # than the dipy peak on the repulsion724 vertices
+    rng = np.random.default_rng(2)
+    mu = rng.normal(size=(50, 3))
+    mu /= np.linalg.norm(mu, axis=1)[:, None]
+    sf = np.array([sphPDF_sym(20, m, sphere.vertices) for m in mu])
+    odf_sh = np.linalg.lstsq(sh_mat, sf.T, rcond=None)[0].T
+    mask = np.ones((mu.shape[0], 1, 1), dtype=bool)
+
+    coarse = get_sphere(name='repulsion100')
+    with PeakExtractor(real_sh_tournier(8, coarse.theta, coarse.phi)[0], coarse, mask, odf_sh.shape[-1], 0.25, 25, 10, sh_func=real_sh_tournier) as extractor:
+        peak_dir, peak_val, _ = extractor(odf_sh)
+        refined = np.rad2deg(np.arccos(np.clip(np.abs(np.einsum('vj,vj->v', peak_dir[:, 0, 0, 0], mu)), 0, 1)))
+        assert ((peak_val[:, 0, 0] > 0).sum(axis=1) == 1).all()
+
+    sampled = np.array([np.rad2deg(np.arccos(min(1, abs(peak_directions(s, sphere, relative_peak_threshold=0.25, min_separation_angle=25)[0][0].dot(m))))) for s, m in zip(odf_sh.dot(sh_mat.T), mu)])
+    assert refined.max() < 0.1
+    assert refined.mean() < sampled.mean()
+
+
+def test_hemisphere_peaks_match_dipy_axes(odf_sh, sh_mat, sphere, mask):
+    # same peak axes as dipy, possibly reported on the antipodal vertex
+    ref_val, ref_ind = dipy_peaks(odf_sh[mask].dot(sh_mat.T), sphere, 0.25, 25)
+    with PeakExtractor(sh_mat, sphere, mask, odf_sh.shape[-1], 0.25, 25, 10, hemisphere=True) as extractor:
+        peak_dir, peak_val, peak_ind = [array[mask] for array in extractor(odf_sh[mask])]
+    antipode = np.argmin(sphere.vertices.dot(sphere.vertices.T), axis=1)
+    present = ref_val > 0
+    np.testing.assert_array_equal(peak_val > 0, present)
+    np.testing.assert_allclose(peak_val, ref_val, rtol=1e-12)
+    assert ((peak_ind == ref_ind) | (peak_ind == antipode[ref_ind]))[present].all()
+    np.testing.assert_allclose(np.abs(np.einsum('vpj,vpj->vp', peak_dir, sphere.vertices[ref_ind]))[present], 1)
+
+
+def test_peak_extractor_normalized_sh(odf_sh, sh_mat, sphere, mask):
+    # the max normalization of sh_odf_normalize.py from the peak extraction SF, same peaks
+    ref = peak_directions_sh_vol(odf_sh, sh_mat, sphere, 0.25, 25, 10, mask=mask)
+    with PeakExtractor(sh_mat, sphere, mask, odf_sh.shape[-1], 0.25, 25, 10, normalize=True) as extractor:
+        peaks = extractor(odf_sh[mask])
+        for array, ref_array in zip(peaks, ref):
+            np.testing.assert_array_equal(array, ref_array)
+        np.testing.assert_allclose(extractor.normalized_sh(), odf_sh[mask] / odf_sh[mask].dot(sh_mat.T).max(axis=1)[:, None], rtol=1e-12)
@@ -0,0 +1,32 @@
+import numpy as np
+
+from dipy.core.sphere import unit_icosahedron
+from dipy.reconst.shm import real_sh_tournier
+
+import sh_odf_normalize
+from sh_odf_normalize import sh_max_normalize
+
+
+def max_normalized(sh, sh_mat):
+    # original sh_odf_normalize.py, max of the SF on repulsion724
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sh_maxnorm = sh / sh.dot(sh_mat.T).max(axis=3)[..., None]
+    sh_maxnorm[~np.isfinite(sh_maxnorm)] = 0
+    return sh_maxnorm
+
+
+def test_sh_max_normalize_matches_full_volume(odf_sh, sh_mat, sphere, mask, monkeypatch):
+    monkeypatch.setattr(sh_odf_normalize, 'cpu_count', lambda: 2)
+    ref = max_normalized(odf_sh, sh_mat)
+    ref[~mask] = 0
+    sh = sh_max_normalize(odf_sh.copy(), mask, sphere, nbr_processes=2, block_size=16)
+    # the SF is evaluated in float32
+    np.testing.assert_allclose(sh, ref, rtol=1e-5, atol=1e-7)
+
+    # the refined maximum is at least the maximum on the vertices, and that of a 40962 vertices sphere
+    refined = sh_max_normalize(odf_sh.copy(), mask, sphere, refine=True, block_size=16)
+    refined_max = odf_sh[mask][:, 0] / refined[mask][:, 0]
+    fine = unit_icosahedron.subdivide(n=6)
+    fine_max = odf_sh[mask].dot(real_sh_tournier(8, fine.theta, fine.phi)[0].T).max(axis=1)
+    assert (refined_max >= odf_sh[mask].dot(sh_mat.T).max(axis=1) * (1 - 1e-6)).all()
+    np.testing.assert_allclose(refined_max, fine_max, rtol=2e-3)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from multiprocessing import shared_memory
+
+from shared_array import SharedArrays, SharedPool, attach_shared_arrays, chunk_bounds, shared_map
+
+
+_worker = {}
+
+
+def _init_worker(specs, scale):
+    _worker['arrays'] = attach_shared_arrays(specs)
+    _worker['scale'] = scale
+
+
+def _scale_chunk(bounds):
+    arrays = _worker['arrays']
+    arrays['out'][bounds[0]:bounds[1]] = _worker['scale'] * arrays['in'][bounds[0]:bounds[1]].sum(axis=1)
+    return bounds
+
+
+def test_chunk_bounds_cover_range():
+    for Nitems, Nchunks in [(10, 3), (3, 10), (0, 4), (1000, 7)]:
+        bounds = chunk_bounds(Nitems, Nchunks)
+        assert len(bounds) <= Nchunks
+        assert all(stop > start for start, stop in bounds)
+        np.testing.assert_array_equal(np.concatenate([np.arange(start, stop) for start, stop in bounds] + [np.zeros(0, dtype=int)]), np.arange(Nitems))
+
+
+@pytest.mark.parametrize('nbr_processes', [1, 2])
+def test_shared_map_writes_in_place(nbr_processes):
+    data = np.random.default_rng(0).random((100, 5))
+    with SharedArrays() as shared:
+        shared.share('in', data)
+        shared.create('out', (100,))
+        bounds = shared_map(_scale_chunk, chunk_bounds(100, 8), shared, _init_worker, (3.,), nbr_processes=nbr_processes)
+        assert sorted(bounds) == chunk_bounds(100, 8)
+        np.testing.assert_array_equal(shared['out'], 3. * data.sum(axis=1))
+        name = shared.specs()['in'][0]
+    _worker.clear()
+    # the blocks are unlinked on exit
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+@pytest.mark.parametrize('nbr_processes', [1, 2])
+def test_shared_pool_writes_in_place(nbr_processes):
+    data = np.random.default_rng(0).random((100, 5))
+    with SharedArrays() as shared:
+        shared.share('in', data)
+        shared.create('out', (100,))
+        with SharedPool(shared, _init_worker, (3.,), nbr_processes=nbr_processes) as pool:
+            bounds = pool.map(_scale_chunk, chunk_bounds(100, 8))
+        assert sorted(bounds) == chunk_bounds(100, 8)
+        np.testing.assert_array_equal(shared['out'], 3. * data.sum(axis=1))
+        name = shared.specs()['in'][0]
+    _worker.clear()
+    # the blocks are unlinked on exit
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
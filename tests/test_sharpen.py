@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from dipy.data import get_sphere
+from dipy.reconst.csdeconv import odf_sh_to_sharp
+
+import _sharpen_parallel
+from _sharpen_parallel import SDTSharpener, odf_sh_to_sharp_parallel
+
+
+@pytest.fixture(scope='module')
+def reg_sphere():
+    return get_sphere(name='symmetric362')
+
+
+def test_sharpen_matches_dipy(odf_sh, reg_sphere):
+    ref = odf_sh_to_sharp(odf_sh, reg_sphere, basis='tournier07', ratio=1/2., sh_order_max=8, lambda_=1., tau=0.1)
+    fodf_sh = odf_sh_to_sharp_parallel(odf_sh, reg_sphere, basis='tournier07', ratio=1/2., sh_order=8, block_size=16)
+    np.testing.assert_allclose(fodf_sh, ref, rtol=0, atol=1e-10)
+
+
+def test_sharpener_over_ratios_matches_dipy(odf_sh, mask, reg_sphere, monkeypatch):
+    # one sharpener (as sharpen_sh_parallel.py --ratio ...) gives dipy's result for each ratio
+    monkeypatch.setattr(_sharpen_parallel, 'cpu_count', lambda: 2)
+    with SDTSharpener(reg_sphere, mask, odf_sh.shape[-1], basis='tournier07', sh_order=8, r2_term=True, nbr_processes=2, block_size=16) as sharpener:
+        sharpener.load(odf_sh[mask])
+        for ratio in [1.5, 2., 4.]:
+            ref = odf_sh_to_sharp(odf_sh[mask], reg_sphere, basis='tournier07', ratio=1/ratio, sh_order_max=8, r2_term=True)
+            fodf_sh = sharpener(1/ratio)
+            np.testing.assert_allclose(fodf_sh[mask], ref, rtol=0, atol=1e-10)
+            assert not fodf_sh[~mask].any()
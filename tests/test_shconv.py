@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from dipy.data import get_sphere
+from dipy.reconst.shm import sh_to_sf_matrix
+
+from shconv import convert_sh_basis
+
+
+def sf_round_trip(shm_coeff, sphere, input_basis):
+    # original convert_sh_basis loop, through the SF of each voxel with any non-zero coefficient
+    output_basis = 'descoteaux07' if input_basis == 'tournier07' else 'tournier07'
+    B_in, _ = sh_to_sf_matrix(sphere, sh_order_max=8, basis_type=input_basis)
+    _, invB_out = sh_to_sf_matrix(sphere, sh_order_max=8, basis_type=output_basis)
+    out = np.zeros(shm_coeff.shape)
+    mask = np.sum(shm_coeff, axis=3).astype(bool)
+    for xyz in zip(*np.nonzero(mask)):
+        if shm_coeff[xyz].any():
+            out[xyz] = np.dot(np.dot(shm_coeff[xyz], B_in), invB_out)
+    return out
+
+
+@pytest.mark.parametrize('input_basis', ['descoteaux07', 'tournier07'])
+def test_convert_sh_basis_matches_sf_round_trip(odf_sh, mask, input_basis):
+    sphere = get_sphere(name='repulsion100')
+    shm_coeff = odf_sh * mask[..., None]
+    ref = sf_round_trip(shm_coeff, sphere, input_basis)
+    np.testing.assert_allclose(convert_sh_basis(shm_coeff, sphere, input_basis=input_basis, block_size=7), ref, rtol=0, atol=1e-12)
+    inplace = shm_coeff.copy()
+    assert convert_sh_basis(inplace, sphere, input_basis=input_basis, inplace=True) is inplace
+    np.testing.assert_allclose(inplace, ref, rtol=0, atol=1e-12)
+
+
+def test_convert_sh_basis_arguments(odf_sh):
+    sphere = get_sphere(name='repulsion100')
+    with pytest.raises(ValueError):
+        convert_sh_basis(np.asfortranarray(odf_sh), sphere, inplace=True)
+    with pytest.warns(DeprecationWarning):
+        convert_sh_basis(odf_sh, sphere, nbr_processes=2)